@@ -1,13 +1,16 @@
+import asyncio
 import azure.functions as func
 import base64
 import json
 import logging
-from container_instance_util import exec_whisper_process, save_audio_to_blob, get_terminated_container_groups, list_blob_names, get_container_state, stop_container, delete_blob, save_to_blob, start_container, update_blob_metadata, blob_exists, list_container_names, list_blob_segments, get_running_container_groups, get_container_log
+from container_instance_util import exec_whisper_process, save_audio_to_blob, get_terminated_container_groups, list_blob_names, get_container_state, stop_container, delete_blob, save_to_blob, start_container, update_blob_metadata, blob_exists, list_blob_segments, get_running_container_groups, get_container_log, CONTAINER_FLEET, list_blobs_with_metadata, index_blobs_by_job, copy_blob, move_blob
 import uuid
 import os
 from azure.storage.blob import BlobServiceClient, BlobClient
 from config import VARIABLE_LIST, ENVIRONMENT_SELECTED
 from util import send_email
+from utils.chunked_upload import CHUNKED_UPLOAD_STORE, CHUNK_SIZE_LIMIT, ChunkedUploadError, PURPOSE_AU_AUDIO_UPLOAD
+from utils.clients import CLIENT_REGISTRY
 import random
 import datetime
 from dateutil import tz
@@ -135,18 +138,8 @@ def au_audio_upload(req: func.HttpRequest) -> func.HttpResponse:
     }
 
     # 起動可能なコンテナが存在するか確認
-    terminated_container_groups = get_terminated_container_groups(
-        name_prefix="whisper")
-
-    # 現在処理中の音声データBLOB数
-    existing_audio_blob_names = list_blob_names(
-        storage_container_name=STORAGE_CONTAINER_NAME,
-        prefix=f"{BLOB_PREFIX_AUDIO_MONITOR}/"
-    )
-
-    # 起動可能なコンテナが存在しない or コンテナ数に余裕がない場合
-    if (len(terminated_container_groups) == 0) | (len(existing_audio_blob_names) > max_containers * 0.8):
-        logging.critical("au_audio_upload: No available containers.")
+    terminated_container_groups = _get_available_container_groups()
+    if len(terminated_container_groups) == 0:
         response = {
             "status": 500,
             "error": "現在アクセスが集中しています。時間をおいてお試しください。"
@@ -176,6 +169,178 @@ def au_audio_upload(req: func.HttpRequest) -> func.HttpResponse:
         }
         return func.HttpResponse(json.dumps(response), mimetype="application/json")
 
+    return _start_transcription(
+        audio_blob_name_for_monitor=audio_blob_name_for_monitor,
+        file_name=file_name,
+        terminated_container_groups=terminated_container_groups
+    )
+
+
+# 音声ファイルを分割してアップロードする場合
+# 1. genie/au_audio_upload/sessions でアップロードを開始 (upn, mail, from, file_nameはau_audio_uploadと同じ)
+# 2. genie/upload/sessions/{upload_id}/chunks/{index} にバイナリのチャンクを順に送信
+# 3. genie/au_audio_upload/sessions/{upload_id}/commit で確定し、文字起こし処理を開始
+@bp.function_name(name="au_audio_upload_session")
+@bp.route(route="genie/au_audio_upload/sessions", methods=("POST",))
+def au_audio_upload_session(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('au_audio_upload_session: process started')
+
+    try:
+        req_json = req.get_json()
+        upn = req_json["upn"]
+        mail = req_json["mail"]
+        file_name = req_json["file_name"]
+        try:
+            sendFrom = req_json["from"]
+            assert sendFrom in ["web", "teams", "mail", "agent"]
+        except Exception:
+            sendFrom = "web"
+    except Exception as e:
+        logging.critical(
+            f"au_audio_upload_session: The data format of the request is invalid.{e}")
+        response = {
+            "status": 500,
+            "error": "リクエストの形式が不正です。"
+        }
+        return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+    # ファイル名からファイル拡張子取得
+    suffix = ("." + file_name.split(".")[-1]).lower()
+    if suffix not in allowed_suffixes:
+        response = {
+            "status": 500,
+            "error": "対応していないファイル拡張子です。'mp3', 'wav', 'm4a'形式にファイルを変換してください。"
+        }
+        return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+    # データサイズの確認（事前に申告されたサイズ。実際のサイズはチャンクの受信ごとに確認する）
+    data_size_limit = VARIABLE_LIST[ENVIRONMENT_SELECTED]["data_size"]
+    if int(req_json.get("size", 0)) > data_size_limit * 1024 * 1024:
+        response = {
+            "status": 500,
+            "error": f"音声データのサイズが大きすぎます。アップロードするデータサイズを{data_size_limit}MB以下にしてください。"
+        }
+        return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+    # 起動可能なコンテナが存在するか確認（アップロード前に混雑を知らせる）
+    if len(_get_available_container_groups()) == 0:
+        response = {
+            "status": 500,
+            "error": "現在アクセスが集中しています。時間をおいてお試しください。"
+        }
+        return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+    # モニタリング用音声BLOBとして確定するまで、ステージしたチャンクは一覧・トリガーに現れない
+    audio_blob_name_for_monitor = f"{BLOB_PREFIX_AUDIO_MONITOR}/{uuid.uuid4()}{suffix}"
+    session = CHUNKED_UPLOAD_STORE.create(
+        container_name=STORAGE_CONTAINER_NAME,
+        blob_name=audio_blob_name_for_monitor,
+        max_size=data_size_limit * 1024 * 1024,
+        metadata={
+            "upn": upn,
+            "mail": mail,
+            "file_name": base64.b64encode(file_name.encode("utf-8")).decode("utf-8"),
+            "suffix": suffix,
+            "from": sendFrom,
+            "audio_blob_name_for_monitor": audio_blob_name_for_monitor,
+            "status": "Audio data saved."
+        },
+        purpose=PURPOSE_AU_AUDIO_UPLOAD
+    )
+    logging.info(
+        f"au_audio_upload_session: User info, upn:{upn}, mail:{mail}, file_name:{file_name}, upload_id:{session['upload_id']}")
+
+    response = {
+        "status": 200,
+        "upload_id": session["upload_id"],
+        "max_size": session["max_size"],
+        "chunk_size_limit": CHUNK_SIZE_LIMIT
+    }
+    return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+
+@bp.function_name(name="au_audio_upload_commit")
+@bp.route(route="genie/au_audio_upload/sessions/{upload_id}/commit", methods=("POST",))
+def au_audio_upload_commit(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    送信済みのチャンクを結合してモニタリング用音声BLOBとして確定し、文字起こし処理を開始する
+    input: {"chunks": チャンク数}
+    """
+    upload_id = req.route_params.get("upload_id")
+    logging.info(f'au_audio_upload_commit: process started. upload_id:{upload_id}')
+
+    # 起動可能なコンテナが存在するか確認（混雑時は確定せず、同じupload_idで再度確定できる）
+    terminated_container_groups = _get_available_container_groups()
+    if len(terminated_container_groups) == 0:
+        response = {
+            "status": 500,
+            "error": "現在アクセスが集中しています。時間をおいてお試しください。"
+        }
+        return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+    try:
+        # au_audio_upload/sessionsで作成した、モニタリング用音声BLOBへのアップロードのみ確定する
+        session = CHUNKED_UPLOAD_STORE.get(upload_id, PURPOSE_AU_AUDIO_UPLOAD)
+        if (session["container_name"] != STORAGE_CONTAINER_NAME
+                or not session["blob_name"].startswith(f"{BLOB_PREFIX_AUDIO_MONITOR}/")):
+            logging.critical(
+                f"au_audio_upload_commit: Invalid upload target {session['container_name']}/{session['blob_name']}")
+            raise ChunkedUploadError("アップロードが見つかりません。最初からアップロードしてください。", status=404)
+
+        session = CHUNKED_UPLOAD_STORE.commit(
+            upload_id, int(req.get_json()["chunks"]), PURPOSE_AU_AUDIO_UPLOAD)
+    except ChunkedUploadError as e:
+        response = {
+            "status": 500,
+            "error": e.message
+        }
+        return func.HttpResponse(json.dumps(response), mimetype="application/json")
+    except Exception as e:
+        logging.critical(f"au_audio_upload_commit: Failed to save the audio. {e}")
+        response = {
+            "status": 500,
+            "error": "音声ファイルのアップロードに失敗しました。時間をおいてお試しください。"
+        }
+        return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+    logging.info(
+        f"au_audio_upload_commit: Audio file uploaded to blob {session['blob_name']}.")
+    return _start_transcription(
+        audio_blob_name_for_monitor=session["blob_name"],
+        file_name=session["blob_name"].split("/")[-1],
+        terminated_container_groups=terminated_container_groups
+    )
+
+
+def _get_available_container_groups() -> list:
+    """
+    起動可能なコンテナグループ名を返す
+    起動可能なコンテナが存在しない or コンテナ数に余裕がない場合は空のリストを返す
+    """
+    terminated_container_groups = get_terminated_container_groups(
+        name_prefix="whisper")
+
+    # 現在処理中の音声データBLOB数
+    existing_audio_blob_names = list_blob_names(
+        storage_container_name=STORAGE_CONTAINER_NAME,
+        prefix=f"{BLOB_PREFIX_AUDIO_MONITOR}/"
+    )
+
+    if (len(terminated_container_groups) == 0) | (len(existing_audio_blob_names) > max_containers * 0.8):
+        logging.critical("au_audio_upload: No available containers.")
+        return []
+    return terminated_container_groups
+
+
+def _start_transcription(
+    audio_blob_name_for_monitor: str,
+    file_name: str,
+    terminated_container_groups: list
+) -> func.HttpResponse:
+    """
+    Whisperコンテナを起動して文字起こし処理を開始する
+    起動に失敗した場合はモニタリング用音声BLOBを削除する
+    """
     # コンテナリストをシャッフル (ターゲットコンテナの重複を回避する)
     random.shuffle(terminated_container_groups)
 
@@ -426,30 +591,21 @@ async def au_summarize_and_send_mail(blob: func.InputStream):
         try:
             audio_blob_name_for_monitor = metadata.get(
                 "audio_blob_name_for_monitor")
-            blob_client_audio = blob_service_client.get_blob_client(
-                container=STORAGE_CONTAINER_NAME,
-                blob=audio_blob_name_for_monitor
-            )
-            blob_properties = blob_client_audio.get_blob_properties()
-            metadata = blob_properties.metadata
-            binary_audio = blob_client_audio.download_blob().readall()
 
             # 一時保存用のBLOBパス
             audio_blob_name_tmp = audio_blob_name_for_monitor.replace(
                 BLOB_PREFIX_AUDIO_MONITOR, BLOB_PREFIX_AUDIO_TMP)
 
-            # 音声データの一時保存
-            save_to_blob(
-                data=binary_audio,
+            # 音声データの一時保存 & モニタリング用音声データの削除（サーバー側でコピーし、メタデータを引き継ぐ）
+            # 完了を待つ間にイベントループを止めないよう、別スレッドで実行する
+            metadata = await asyncio.to_thread(
+                move_blob,
                 storage_container_name=STORAGE_CONTAINER_NAME,
-                blob_name=audio_blob_name_tmp,
-                metadata=metadata
+                source_blob_name=audio_blob_name_for_monitor,
+                destination_blob_name=audio_blob_name_tmp
             )
-
-            # モニタリング用音声データの削除
-            blob_client_audio.delete_blob()
             logging.info(
-                f"Blob '{blob_client_audio.blob_name}' was deleted successfully.")
+                f"Blob '{audio_blob_name_for_monitor}' was moved to '{audio_blob_name_tmp}' successfully.")
 
         except Exception as e:
             logging.critical(
@@ -518,20 +674,21 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
             - 元の音声の削除
     """
 
-    # モニタリング用のBLOB名を取得
-    blob_names = list_blob_names(
+    # モニタリング用のBLOBをメタデータ付きで取得（BLOBごとのプロパティ取得は行わない）
+    monitor_blobs = {blob.name: blob for blob in list_blobs_with_metadata(
         storage_container_name=STORAGE_CONTAINER_NAME,
         prefix=f"{BLOB_PREFIX_AUDIO_MONITOR}/"
-    )
+    )}
+    blob_names = list(monitor_blobs.keys())
 
     if len(blob_names) == 0:
         logging.info("au_monitor_blob_state : No processes running.")
         return
 
-    blob_service_client = BlobServiceClient.from_connection_string(
-        AZURE_STORAGE_CONNECTION_STRING)
+    container_client = CLIENT_REGISTRY.blob_container(STORAGE_CONTAINER_NAME)
     try:
-        # 稼働中のコンテナ名の取得
+        # 稼働中のコンテナ名の取得（コンテナの状態はスナップショットを最新化し、以降の処理で使い回す）
+        CONTAINER_FLEET.snapshot(name_prefix="whisper", refresh=True)
         running_container_names = get_running_container_groups(
             name_prefix="whisper")
 
@@ -583,22 +740,19 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
         # blobのメタデータの確認、更新
         abnormal_blob_names = []
         for blob_name in terminated_blob_names:
-            blob_client = blob_service_client.get_blob_client(
-                container=STORAGE_CONTAINER_NAME, blob=blob_name)
-
-            if blob_client.exists():
-                blob_properties = blob_client.get_blob_properties()
-                metadata = blob_properties.metadata
-                if metadata.get("status") == "Transcribe Started":
-                    abnormal_blob_names.append(blob_name)
-                    # 異常終了した可能性のあるBLOBのStatusを "Container Started" に変更することで、再処理が走るようにする
-                    update_blob_metadata(
-                        storage_container_name=STORAGE_CONTAINER_NAME,
-                        blob_name=blob_name,
-                        new_metadata={
-                            "status": "Container Started"
-                        }
-                    )
+            metadata = monitor_blobs[blob_name].metadata
+            if metadata.get("status") == "Transcribe Started":
+                abnormal_blob_names.append(blob_name)
+                # 異常終了した可能性のあるBLOBのStatusを "Container Started" に変更することで、再処理が走るようにする
+                update_blob_metadata(
+                    storage_container_name=STORAGE_CONTAINER_NAME,
+                    blob_name=blob_name,
+                    new_metadata={
+                        "status": "Container Started"
+                    }
+                )
+                # 以降の確認で再処理の対象となるよう、一覧取得時のメタデータも更新
+                metadata["status"] = "Container Started"
 
         if len(abnormal_blob_names) != 0:
             logging.warning(
@@ -611,13 +765,10 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
     # blobの確認
     for blob_name in blob_names:
         try:
-            blob_client = blob_service_client.get_blob_client(
-                container=STORAGE_CONTAINER_NAME,
-                blob=blob_name
-            )
+            blob_client = container_client.get_blob_client(blob_name)
 
             # 作成された時間を取得
-            creation_time = blob_client.get_blob_properties()['creation_time']
+            creation_time = monitor_blobs[blob_name].creation_time
             creation_time = creation_time.replace(tzinfo=tz.tzutc())
 
             # 時間差を計算
@@ -625,7 +776,7 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
             time_difference = current_time - creation_time
 
             # メタデータの取得
-            metadata = blob_client.get_blob_properties().metadata
+            metadata = monitor_blobs[blob_name].metadata
             status = metadata.get("status")
             num_retry = int(metadata.get("num_retry"))
             is_segment = int(metadata.get("is_segment", 0))
@@ -660,7 +811,7 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
 
         if is_continue:
             # Whisperコンテナの起動 & 処理実行
-            # 起動可能なコンテナが存在するか確認
+            # 起動可能なコンテナが存在するか確認（スナップショットから取得し、起動済みのコンテナは除外される）
             terminated_container_groups = get_terminated_container_groups(
                 name_prefix="whisper")
 
@@ -692,17 +843,16 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
 
         else:
             try:
-                # 音声データを一時保存
-                binary_audio = blob_client.download_blob().readall()
+                # 音声データを一時保存（サーバー側でコピー）
                 audio_blob_name_tmp = blob_name.replace(
                     BLOB_PREFIX_AUDIO_MONITOR, BLOB_PREFIX_AUDIO_TMP)
                 metadata.update({
                     "status": terminate_reason
                 })
-                save_to_blob(
-                    data=binary_audio,
+                copy_blob(
                     storage_container_name=STORAGE_CONTAINER_NAME,
-                    blob_name=audio_blob_name_tmp,
+                    source_blob_name=blob_name,
+                    destination_blob_name=audio_blob_name_tmp,
                     metadata=metadata
                 )
             except Exception as e:
@@ -759,6 +909,7 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
                     f"au_monitor_blob_state : Unable to delete and send mail {blob_name}. {e}")
 
     logging.info(f"au_monitor_blob_state: Existing all blob is checked")
+    logging.info(f"au_monitor_blob_state: Container fleet stats {CONTAINER_FLEET.stats()}")
 
 
 # 定期的に出力された文字起こしセグメントを確認して結果が揃っていれば、トリガー用BLOBに結果を保存する
@@ -767,74 +918,40 @@ def au_monitor_blob_state(mytimer: func.TimerRequest) -> None:
 def au_monitor_text_segment(mytimer: func.TimerRequest) -> None:
     logging.info(f"au_monitor_text_segment: Called")
 
-    # 全てのテキストセグメント格納BLOB名を取得
-    blob_names = list_blob_names(
+    # 全てのテキストセグメント格納BLOBをメタデータ付きで取得し、元のモニター用音声BLOB名ごとにまとめる
+    text_segment_index = index_blobs_by_job(list_blobs_with_metadata(
         storage_container_name=STORAGE_CONTAINER_NAME,
         prefix=f"{BLOB_PREFIX_TEXT_SEGMENTS}/"
-    )
+    ))
 
-    if len(blob_names) == 0:
+    if len(text_segment_index) == 0:
         logging.info(
             f"au_monitor_text_segment: No existing blob text segments")
         return
 
     logging.info(
-        f"au_monitor_text_segment: Existing BLOB text segments: {blob_names}")
-    state_dict = {}
-    for blob_name in blob_names:
-        blob_service_client = BlobServiceClient.from_connection_string(
-            AZURE_STORAGE_CONNECTION_STRING)
-        blob_client = blob_service_client.get_blob_client(
-            container=STORAGE_CONTAINER_NAME,
-            blob=blob_name
-        )
-        metadata = blob_client.get_blob_properties().metadata
-
-        # 元のモニター用音声BLOB名をキーとして、メタデータを辞書形式に整理
-        if metadata["audio_blob_name_for_monitor"] not in state_dict.keys():
-            state_dict[metadata["audio_blob_name_for_monitor"]] = {
-                "num_segments": int(metadata["num_segments"]),
-                "segment_ids": [int(metadata["segment_id"])],
-                "blob_segments": [blob_name],
-                "metadata": metadata
-            }
-        else:
-            state_dict[metadata["audio_blob_name_for_monitor"]
-                       ]["blob_segments"].append(blob_name)
-            state_dict[metadata["audio_blob_name_for_monitor"]
-                       ]["segment_ids"].append(int(metadata["segment_id"]))
-
-    for monitor_blob in state_dict.keys():
-
-        # ID順になるようにBLOB名をソート
-        blob_segments = state_dict[monitor_blob]["blob_segments"]
-        segment_ids = state_dict[monitor_blob]["segment_ids"]
-
-        zipped_lists = zip(segment_ids, blob_segments)
-        sorted_zipped_lists = sorted(zipped_lists)
-        segment_ids, blob_segments = zip(*sorted_zipped_lists)
-        blob_segments = list(blob_segments)
-
-        # BLOBセグメントのテキストデータを読み込み
-        all_texts = []
-        creation_times = []
-        for blob_name in blob_segments:
-            blob_service_client = BlobServiceClient.from_connection_string(
-                AZURE_STORAGE_CONNECTION_STRING)
-            blob_client = blob_service_client.get_blob_client(
-                container=STORAGE_CONTAINER_NAME,
-                blob=blob_name
-            )
+        f"au_monitor_text_segment: Existing BLOB text segments: {[blob.name for blobs in text_segment_index.values() for blob in blobs]}")
+
+    # トリガー用音声BLOBも1回の一覧取得でまとめておき、ジョブごとの確認は辞書の参照で行う
+    audio_segment_index = index_blobs_by_job(list_blobs_with_metadata(
+        storage_container_name=STORAGE_CONTAINER_NAME,
+        prefix=f"{BLOB_PREFIX_AUDIO_MONITOR}/"
+    ))
+    container_client = CLIENT_REGISTRY.blob_container(STORAGE_CONTAINER_NAME)
 
-            # 文字起こしテキストの取得 & 結合
-            blob_data = blob_client.download_blob()
-            text = blob_data.content_as_text()
-            all_texts.append(text)
+    for monitor_blob, text_segments in text_segment_index.items():
+        # 最初に見つかったセグメントのメタデータを使用
+        metadata = text_segments[0].metadata
+        num_segments = int(metadata["num_segments"])
 
-            # 作成日時の取得
-            creation_time = blob_client.get_blob_properties()['creation_time']
-            creation_time = creation_time.replace(tzinfo=tz.tzutc())
-            creation_times.append(creation_time)
+        # ID順になるようにBLOBをソート
+        text_segments = sorted(
+            text_segments, key=lambda blob: int(blob.metadata["segment_id"]))
+        blob_segments = [blob.name for blob in text_segments]
+
+        # 作成日時の取得
+        creation_times = [blob.creation_time.replace(
+            tzinfo=tz.tzutc()) for blob in text_segments]
 
         # 現在のUTC時刻をタイムゾーン付きで取得
         current_time = datetime.datetime.now(tz=tz.tzutc())
@@ -843,15 +960,11 @@ def au_monitor_text_segment(mytimer: func.TimerRequest) -> None:
         time_difference = current_time - max(creation_times)
 
         # 分割数が存在するBLOBセグメント数と同じ場合 (文字起こし完了シグナル)
-        is_finished = state_dict[monitor_blob]["num_segments"] == len(
-            blob_segments)
+        is_finished = num_segments == len(blob_segments)
 
         # トリガー用音声BLOBの存在確認
-        blob_audio_segments = list_blob_segments(
-            storage_container_name=STORAGE_CONTAINER_NAME,
-            prefix=f"{BLOB_PREFIX_AUDIO_MONITOR}/",
-            audio_blob_name_for_monitor=monitor_blob
-        )
+        blob_audio_segments = [
+            blob.name for blob in audio_segment_index.get(monitor_blob, [])]
 
         # 音声データが存在しない場合、テキストセグメントも削除する (既にメールが送信されている)
         if len(blob_audio_segments) == 0:
@@ -873,7 +986,12 @@ def au_monitor_text_segment(mytimer: func.TimerRequest) -> None:
 
         # 正常終了 or 異常終了の場合、文字起こし結果を結合し、トリガー用BLOBに保存する
         if is_finished | is_abnormal:
-            # 文字起こし結果の結合
+            # BLOBセグメントのテキストデータを読み込み、結合（結合する場合のみダウンロードする）
+            all_texts = []
+            for blob_name in blob_segments:
+                blob_data = container_client.get_blob_client(
+                    blob_name).download_blob()
+                all_texts.append(blob_data.content_as_text())
             all_text = "\n".join(all_texts)
 
             # トリガー用BLOBに文字起こし結果を保存
@@ -887,7 +1005,7 @@ def au_monitor_text_segment(mytimer: func.TimerRequest) -> None:
                 data=all_text.encode('utf-8'),
                 storage_container_name=STORAGE_CONTAINER_NAME,
                 blob_name=output_text_blob_name,
-                metadata=state_dict[monitor_blob]["metadata"],
+                metadata=metadata,
                 overwrite=False
             )
 
@@ -933,12 +1051,14 @@ def au_reset_container_state(mytimer: func.TimerRequest) -> None:
 
     # モニタリング用BLOBが存在しない場合、停止していないコンテナを停止する
     if len(blob_names) == 0:
-        # 全whisperコンテナ名を取得
-        container_names = list_container_names(name_prefix="whisper")
-
-        # コンテナを停止
-        for container_name in container_names:
-            stop_container(container_name)
+        # 全whisperコンテナの状態を取得
+        container_states = CONTAINER_FLEET.snapshot(
+            name_prefix="whisper", refresh=True)
+
+        # 停止していないコンテナを停止
+        for container_name, state in container_states.items():
+            if state != "Terminated":
+                stop_container(container_name)
 
         logging.info(
             "Since there is no audio data being processed, all containers will be stopped.")
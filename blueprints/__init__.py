@@ -1,3 +1,4 @@
 from blueprints.download_blob import bp as blob_dl_bp
 from blueprints.hanabi import bp as hanabi_bp
 from blueprints.word_bp import bp as word_bp
+from blueprints.chunked_upload import bp as chunked_upload_bp
@@ -0,0 +1,102 @@
+import azure.functions as func
+import azure.durable_functions as d_func
+
+import json
+import logging
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from config import VARIABLE_LIST, ENVIRONMENT_SELECTED
+from utils.chunked_upload import CHUNKED_UPLOAD_STORE, CHUNK_SIZE_LIMIT, ChunkedUploadError, PURPOSE_UPLOAD, PURPOSE_WHISPER
+
+bp = d_func.Blueprint()
+
+# genie/whisperで文字起こしAPIに送信できる上限(MB)
+WHISPER_SIZE_LIMIT = 25
+
+
+@bp.route(route="genie/upload/sessions", methods=("POST",))
+def create_upload_session(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    genie/upload, genie/whisper用の分割アップロードを開始する
+    input:
+    - purpose: "upload" | "whisper"
+    - upn: ユーザーを識別するID
+    - container_name, file_name: アップロード先(uploadの場合)
+    output:
+    - upload_id: チャンクの送信、genie/upload・genie/whisperの呼び出しに使用する
+    - chunk_size_limit: 1チャンクの上限(バイト)
+    """
+    logging.info('create_upload_session processed a request.')
+    try:
+        req_json = req.get_json()
+        purpose = req_json["purpose"]
+        upn = req_json["upn"]
+
+        if purpose == PURPOSE_UPLOAD:
+            container_name = req_json["container_name"]
+            blob_name = req_json["file_name"]
+            max_size = VARIABLE_LIST[ENVIRONMENT_SELECTED]["data_size"] * 1024 * 1024
+        elif purpose == PURPOSE_WHISPER:
+            # genie/whisperがアップロードしていた保存先と同じ
+            formatted_time = datetime.now(ZoneInfo("Asia/Tokyo")).strftime('%Y-%m-%d/%H:%M:%S')
+            container_name = "audio-data"
+            blob_name = f"{upn}/{formatted_time}.mp3"
+            max_size = WHISPER_SIZE_LIMIT * 1024 * 1024
+        else:
+            raise ChunkedUploadError("purposeが不正です。")
+
+        session = CHUNKED_UPLOAD_STORE.create(
+            container_name=container_name,
+            blob_name=blob_name,
+            max_size=max_size,
+            purpose=purpose,
+            extra={"upn": upn}
+        )
+    except ChunkedUploadError as e:
+        return func.HttpResponse(json.dumps({"status": e.status, "error": e.message}), status_code=e.status)
+    except Exception as e:
+        logging.error(f"create_upload_session: {e}")
+        return func.HttpResponse(json.dumps({"status": 400, "error": "リクエストの形式が不正です。"}), status_code=400)
+
+    response = {
+        "status": 200,
+        "upload_id": session["upload_id"],
+        "max_size": session["max_size"],
+        "chunk_size_limit": CHUNK_SIZE_LIMIT,
+    }
+    return func.HttpResponse(json.dumps(response), mimetype="application/json")
+
+
+@bp.route(route="genie/upload/sessions/{upload_id}/chunks/{index:int}", methods=("PUT",))
+def put_upload_chunk(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    チャンク(バイナリ)をリクエストボディで受け取り、ステージする
+    genie/upload/sessions, genie/au_audio_upload/sessionsのどちらで作成したアップロードにも使用する
+    同じindexを再送した場合は上書きされるため、失敗したチャンクのみ再送すればよい
+    """
+    upload_id = req.route_params.get("upload_id")
+    index = int(req.route_params.get("index"))
+    try:
+        status = CHUNKED_UPLOAD_STORE.stage(upload_id, index, req.get_body())
+    except ChunkedUploadError as e:
+        return func.HttpResponse(json.dumps({"status": e.status, "error": e.message}), status_code=e.status)
+    except Exception as e:
+        logging.error(f"put_upload_chunk: {upload_id}, {index}, {e}")
+        return func.HttpResponse(json.dumps({"status": 500, "error": "アップロードに失敗しました。時間をおいて再送してください。"}), status_code=500)
+
+    return func.HttpResponse(json.dumps({"status": 200, **status}), mimetype="application/json")
+
+
+@bp.route(route="genie/upload/sessions/{upload_id}", methods=("GET",))
+def get_upload_session(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    受信済みのチャンクの番号と合計サイズを返す（中断したアップロードの再開に使う）
+    """
+    upload_id = req.route_params.get("upload_id")
+    try:
+        status = CHUNKED_UPLOAD_STORE.status(upload_id)
+    except ChunkedUploadError as e:
+        return func.HttpResponse(json.dumps({"status": e.status, "error": e.message}), status_code=e.status)
+
+    return func.HttpResponse(json.dumps({"status": 200, **status}), mimetype="application/json")
@@ -5,11 +5,9 @@ import json
 import base64
 import logging
 
-from config import BLOB_SERVICE_CLIENT, FILE_CONTAINER_NAME
-from utils.token import decode_id_token
-
-from i_style.aiohttp import AsyncHttpClient
-from i_style.token import EntraIDTokenManager
+from config import FILE_CONTAINER_NAME
+from utils.token import decode_id_token, get_openid_keys
+from utils.clients import CLIENT_REGISTRY
 
 bp = d_func.Blueprint()
 
@@ -21,13 +19,13 @@ async def download_blob(req: func.HttpRequest) -> func.HttpResponse:
     id tokenの検証と id tokenから取得したupnがblobの持ち主か（命名ルールで判断）の検証を行う。
     """
     logging.info('download_blob processed a request.')
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     blob_name: str = req.params.get("blob_name")
     # IDトークンによる認証処理
     try:
         id_token = req.params.get("id_token")
-        keys = await EntraIDTokenManager.get_entra_openid_keys(async_http_client)
+        keys = await get_openid_keys(async_http_client, id_token)
         upn, _, _ = decode_id_token(id_token, keys)
 
         if not blob_name.startswith(upn):
@@ -45,7 +43,7 @@ async def download_blob(req: func.HttpRequest) -> func.HttpResponse:
     logging.info(f"blob_name: {blob_name}")
 
     try:
-        container_client = BLOB_SERVICE_CLIENT.get_container_client(
+        container_client = CLIENT_REGISTRY.async_blob_container(
             FILE_CONTAINER_NAME)
 
         blob_client = container_client.get_blob_client(blob_name)
@@ -11,9 +11,8 @@ from config import VARIABLE_LIST, ENVIRONMENT_SELECTED
 from util import error_response, convert_url_to_a
 from urllib.parse import quote
 
-from utils.token import decode_id_token
+from utils.token import decode_id_token, get_openid_keys
 from i_style.aiohttp import AsyncHttpClient
-from i_style.token import EntraIDTokenManager
 
 # Box APIのOAuth設定値
 CLIENT_ID = os.environ.get("BOX_CLIENT_ID")
@@ -368,7 +367,7 @@ async def box_initial_message(req: func.HttpRequest) -> func.HttpResponse:
     async_http_client = AsyncHttpClient()
     try:
         id_token = req.params.get("id_token")
-        keys = await EntraIDTokenManager.get_entra_openid_keys(async_http_client)
+        keys = await get_openid_keys(async_http_client, id_token)
         _, user_id, user_name = decode_id_token(id_token, keys)
         user_name += "さん"
     except Exception as e:
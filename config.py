@@ -70,10 +70,26 @@ for model_name, config in _models_data.items():
         if config.get("key"):
             NON_CHAT_REGISTRY.models[model_name] = ModelConfig(**config)
 
+# モデルごとの同時実行数の上限（デプロイのクォータに合わせて NON_CHAT_<モデル>_MAX_CONCURRENCY で調整する）
+# 例: gpt4.1-mini -> NON_CHAT_GPT4_1_MINI_MAX_CONCURRENCY
+NON_CHAT_MAX_CONCURRENCY = {
+    model_name: int(os.environ.get(
+        f"NON_CHAT_{model_name.upper().replace('.', '_').replace('-', '_')}_MAX_CONCURRENCY", 8))
+    for model_name in _models_data
+}
+
+# 議事録の作成方法（"map_reduce": チャンクごとに並列に作成して統合する / "refine": チャンクごとに順に作成し直す）
+MINUTES_MODE = os.environ.get("MINUTES_MODE", "map_reduce")
+# map_reduceで1回に議事録を作成する文字起こしのトークン数
+MINUTES_MAP_CHUNK_TOKENS = int(os.environ.get("MINUTES_MAP_CHUNK_TOKENS", 30_000))
+
 GPT_API_VERSION = os.environ.get("GPT_API_VERSION")
 GPT4O_TRANSCRIBE_API_ENDPOINT = os.environ.get("GPT4O_TRANSCRIBE_API_ENDPOINT")
 GPT4O_TRANSCRIBE_API_KEY = os.environ.get("GPT4O_TRANSCRIBE_API_KEY")
 GPT4O_TRANSCRIBE_DEPLOYMENT_NAME = os.environ.get("GPT4O_TRANSCRIBE_DEPLOYMENT_NAME")
+# 文字起こしのデプロイのレート制限(1分あたりのリクエスト数)と同時実行数
+GPT4O_TRANSCRIBE_RPM = int(os.environ.get("GPT4O_TRANSCRIBE_RPM", 60))
+GPT4O_TRANSCRIBE_MAX_CONCURRENCY = int(os.environ.get("GPT4O_TRANSCRIBE_MAX_CONCURRENCY", 8))
 
 # blob
 BLOB_CONNECTION_STRING = os.environ.get("BLOB_CONNECTION_STRING")
@@ -83,6 +99,9 @@ AUDIO_CONTAINER_NAME = "audio-data"
 
 FILE_CONTAINER_NAME = "file-data"
 
+# Excelの生成に使うプロセス数（0の場合はスレッドで生成する）
+WORKBOOK_RENDER_PROCESSES = int(os.environ.get("WORKBOOK_RENDER_PROCESSES", min(2, os.cpu_count() or 1)))
+
 
 # Durableの環境変数
 MCP_AGENT_URL = os.environ.get("MCP_AGENT_URL")
@@ -2,12 +2,15 @@ import logging
 import os
 import time
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.containerinstance import ContainerInstanceManagementClient
 from azure.mgmt.containerinstance.models import ContainerExecRequest, ContainerExecRequestTerminalSize
-from azure.storage.blob import BlobServiceClient, BlobClient
+from azure.storage.blob import BlobClient
 import websocket
 import random
+from collections import defaultdict
+
+from utils import blob_copy
+from utils.clients import CLIENT_REGISTRY
+from utils.container_fleet import ContainerFleetState
 
 
 # 環境変数から情報を取得
@@ -23,6 +26,9 @@ BLOB_PREFIX_TEXT_TRIGGER = "audio_upload/text_for_trigger"
 # 　コンテナーグループ内のコンテナ名
 INNER_CONTAINER_NAME = "whisper-container"
 
+# コンテナグループの状態のスナップショット（クライアントも共有する）
+CONTAINER_FLEET = ContainerFleetState(SUBSCRIPTION_ID, RESOURCE_GROUP_NAME)
+
 # whisperコンテナを立ち上げて文字起こし処理をコマンド実行する関数
 
 
@@ -36,12 +42,6 @@ def exec_whisper_process(
     audio_file_blob_name_for_monitor = audio_file_blob_name.replace(
         BLOB_PREFIX_AUDIO_TRIGGER, BLOB_PREFIX_AUDIO_MONITOR)
 
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
-
     # 停止しているコンテナの取得
     terminated_container_groups_names = get_terminated_container_groups(
         name_prefix=name_prefix)
@@ -80,27 +80,24 @@ def exec_whisper_process(
 
     # コンテナの状態を取得し、Running状態になるのを待ち、コマンド実行
     while True:
-        container = client.container_groups.get(
-            RESOURCE_GROUP_NAME, selected_container_group_name).containers[0]
-        if container.instance_view != None:
-            if container.instance_view.current_state.state == "Running":
-
-                # コンテナ内でコマンド実行
-                command_exec_in_container(
-                    container_name=selected_container_group_name,
-                    python_command=python_command
-                )
-
-                # モニタリング用音声BLOBのメタデータを更新
-                update_blob_metadata(
-                    storage_container_name=storage_container_name,
-                    blob_name=audio_file_blob_name_for_monitor,
-                    new_metadata={
-                        "status": "Command executed"
-                    }
-                )
-                logging.info("Command executed.")
-                break
+        if get_container_state(selected_container_group_name) == "Running":
+
+            # コンテナ内でコマンド実行
+            command_exec_in_container(
+                container_name=selected_container_group_name,
+                python_command=python_command
+            )
+
+            # モニタリング用音声BLOBのメタデータを更新
+            update_blob_metadata(
+                storage_container_name=storage_container_name,
+                blob_name=audio_file_blob_name_for_monitor,
+                new_metadata={
+                    "status": "Command executed"
+                }
+            )
+            logging.info("Command executed.")
+            break
         time.sleep(10)
 
 
@@ -140,8 +137,7 @@ def save_to_blob(
     metadata=None,
     overwrite=False
 ):
-    blob_service_client = BlobServiceClient.from_connection_string(
-        AZURE_STORAGE_CONNECTION_STRING)
+    blob_service_client = CLIENT_REGISTRY.blob_service()
     blob_client = blob_service_client.get_blob_client(
         container=storage_container_name,
         blob=blob_name
@@ -153,6 +149,41 @@ def save_to_blob(
     )
     return
 
+# BLOBをサーバー側でコピーする関数（データを関数のメモリに読み込まない）
+# 完了までtime.sleepで待つため、非同期の処理からはasyncio.to_threadで呼び出す
+def copy_blob(
+    storage_container_name: str,
+    source_blob_name: str,
+    destination_blob_name: str,
+    metadata: dict = None,
+    timeout: float = 300,
+    poll_interval: float = 1
+):
+    return blob_copy.copy_blob(
+        CLIENT_REGISTRY.blob_container(storage_container_name),
+        source_blob_name,
+        destination_blob_name,
+        metadata=metadata,
+        timeout=timeout,
+        poll_interval=poll_interval
+    )
+
+
+# BLOBをサーバー側で移動する関数（コピーの完了後に元のBLOBを削除する）
+def move_blob(
+    storage_container_name: str,
+    source_blob_name: str,
+    destination_blob_name: str,
+    metadata: dict = None
+):
+    return blob_copy.move_blob(
+        CLIENT_REGISTRY.blob_container(storage_container_name),
+        source_blob_name,
+        destination_blob_name,
+        metadata=metadata
+    )
+
+
 # BLOBを削除する関数
 
 
@@ -160,8 +191,7 @@ def delete_blob(
     storage_container_name,
     blob_name
 ):
-    blob_service_client = BlobServiceClient.from_connection_string(
-        AZURE_STORAGE_CONNECTION_STRING)
+    blob_service_client = CLIENT_REGISTRY.blob_service()
     blob_client = blob_service_client.get_blob_client(
         container=storage_container_name,
         blob=blob_name
@@ -175,95 +205,52 @@ def delete_blob(
 
 # 稼働していないコンテナグループ名を取得
 def get_terminated_container_groups(name_prefix="whisper"):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
-
-    # 現在のコンテナーグループを取得
-    container_groups = client.container_groups.list_by_resource_group(
-        resource_group_name=RESOURCE_GROUP_NAME
-    )
-
-    # コンテナグループの状態を確認し、稼働していないコンテナグループ名を取得
-    terminated_container_groups_names = []
-    for container_group in container_groups:
-        if (name_prefix in container_group.name):
-            # コンテナーを取得
-            container = client.container_groups.get(
-                RESOURCE_GROUP_NAME, container_group.name).containers[0]
-            if (container.instance_view != None):
-                if container.instance_view.current_state.state == "Terminated":
-                    terminated_container_groups_names.append(
-                        container_group.name)
-
-    return terminated_container_groups_names
+    # コンテナグループの状態のスナップショットから、稼働していないコンテナグループ名を取得
+    return CONTAINER_FLEET.names_in_state("Terminated", name_prefix=name_prefix)
 
 
 # コンテナグループの名前をリストで取得する関数
 def list_container_names(
     name_prefix="whisper"
 ):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
-
-    # 現在のコンテナーグループを取得
-    container_groups = client.container_groups.list_by_resource_group(
-        resource_group_name=RESOURCE_GROUP_NAME
-    )
-
-    # コンテナグループの名前を確認
-    container_groups_names = []
-    for container_group in container_groups:
-        if (name_prefix in container_group.name):
-            container_groups_names.append(container_group.name)
-
-    return container_groups_names
+    # コンテナグループの状態のスナップショットから名前を取得
+    return list(CONTAINER_FLEET.snapshot(name_prefix=name_prefix).keys())
 
 
 # コンテナグループを起動する関数
 def start_container(container_name):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
+    # 共有のクライアントを取得
+    client = CONTAINER_FLEET.client()
 
     # コンテナを起動
     response = client.container_groups.begin_start(
         resource_group_name=RESOURCE_GROUP_NAME,
         container_group_name=container_name
     )
+
+    # 起動を開始したコンテナが他の処理で選ばれないよう、スナップショットを更新
+    CONTAINER_FLEET.mark_state(container_name, "Starting")
     return response
 
 
 # コンテナグループを停止する関数
 def stop_container(container_name):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
+    # 共有のクライアントを取得
+    client = CONTAINER_FLEET.client()
 
     # コンテナを停止
     client.container_groups.stop(
         resource_group_name=RESOURCE_GROUP_NAME,
         container_group_name=container_name
     )
+    CONTAINER_FLEET.mark_state(container_name, "Terminated")
     return
 
 
 # コンテナを指定してコマンドを実行する関数
 def command_exec_in_container(container_name, python_command):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
+    # 共有のクライアントを取得
+    client = CONTAINER_FLEET.client()
 
     terminalsize = os.terminal_size((80, 24))
     terminal_size = ContainerExecRequestTerminalSize(
@@ -291,8 +278,7 @@ def update_blob_metadata(
     blob_name: str,
     new_metadata: dict
 ):
-    blob_service_client = BlobServiceClient.from_connection_string(
-        AZURE_STORAGE_CONNECTION_STRING)
+    blob_service_client = CLIENT_REGISTRY.blob_service()
 
     # BlobClientのインスタンスを作成
     blob_client_audio = blob_service_client.get_blob_client(
@@ -314,8 +300,7 @@ def blob_exists(
     blob_name: str
 ):
 
-    blob_service_client = BlobServiceClient.from_connection_string(
-        AZURE_STORAGE_CONNECTION_STRING)
+    blob_service_client = CLIENT_REGISTRY.blob_service()
     # BlobClientのインスタンスを作成
     blob_client = blob_service_client.get_blob_client(
         container=storage_container_name, blob=blob_name)
@@ -329,8 +314,7 @@ def list_blob_names(
     prefix: str = 'audio/'
 ):
 
-    blob_service_client = BlobServiceClient.from_connection_string(
-        AZURE_STORAGE_CONNECTION_STRING)
+    blob_service_client = CLIENT_REGISTRY.blob_service()
     blob_client = blob_service_client.get_container_client(
         storage_container_name)
 
@@ -343,77 +327,54 @@ def list_blob_names(
     return blob_names
 
 
-# 指定した名前で始まるBLOB名の内同じ元データを有するBLOBセグメントを取得するn
-def list_blob_segments(
+# 指定した名前で始まるBLOBをメタデータ付きで取得する関数
+# 一覧の取得時にメタデータも取得するため、BLOBごとのget_blob_propertiesは不要
+def list_blobs_with_metadata(
     storage_container_name: str,
-    prefix: str,
-    audio_blob_name_for_monitor
+    prefix: str
 ):
+    container_client = CLIENT_REGISTRY.blob_container(storage_container_name)
+    return list(container_client.list_blobs(name_starts_with=prefix, include=["metadata"]))
 
-    blob_service_client = BlobServiceClient.from_connection_string(
-        AZURE_STORAGE_CONNECTION_STRING)
-    blob_client = blob_service_client.get_container_client(
-        storage_container_name)
 
-    # 指定した名前で始まるBLOB名を取得
-    blobs = blob_client.list_blobs(name_starts_with=prefix)
-    blob_names = []
+# BLOBを元のモニタリング用音声BLOB名(audio_blob_name_for_monitor)ごとにまとめる関数
+# 一覧の順序は保持する
+def index_blobs_by_job(blobs: list) -> dict:
+    blob_index = defaultdict(list)
     for blob in blobs:
-        blob_client = blob_service_client.get_blob_client(
-            container=storage_container_name, blob=blob)
-        metadata = blob_client.get_blob_properties().metadata
-        if metadata["audio_blob_name_for_monitor"] == audio_blob_name_for_monitor:
-            blob_names.append(blob.name)
+        audio_blob_name_for_monitor = (blob.metadata or {}).get(
+            "audio_blob_name_for_monitor")
+        if audio_blob_name_for_monitor:
+            blob_index[audio_blob_name_for_monitor].append(blob)
+    return blob_index
 
-    return blob_names
+
+# 指定した名前で始まるBLOB名の内同じ元データを有するBLOBセグメントを取得する
+def list_blob_segments(
+    storage_container_name: str,
+    prefix: str,
+    audio_blob_name_for_monitor
+):
+    # メタデータ付きの一覧を1回取得し、元データが同じBLOBのみ返す
+    blob_index = index_blobs_by_job(list_blobs_with_metadata(
+        storage_container_name=storage_container_name,
+        prefix=prefix
+    ))
+    return [blob.name for blob in blob_index.get(audio_blob_name_for_monitor, [])]
 
 
 # コンテナの状態を取得する関数
 def get_container_state(
     container_group_name
 ):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
-    container = client.container_groups.get(
-        RESOURCE_GROUP_NAME, container_group_name).containers[0]
-
-    if container.instance_view != None:
-        state = container.instance_view.current_state.state
-    else:
-        state = "Unknown"
+    # 最新の状態を取得（スナップショットにも反映される）
+    return CONTAINER_FLEET.get_state(container_group_name)
 
-    return state
 
 # 稼働しているコンテナグループ名を取得
-
-
 def get_running_container_groups(name_prefix="whisper"):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
-
-    # 現在のコンテナーグループを取得
-    container_groups = client.container_groups.list_by_resource_group(
-        resource_group_name=RESOURCE_GROUP_NAME
-    )
-
-    # コンテナグループの状態を確認し、稼働していないコンテナグループ名を取得
-    running_container_groups_names = []
-    for container_group in container_groups:
-        if (name_prefix in container_group.name):
-            # コンテナーを取得
-            container = client.container_groups.get(
-                RESOURCE_GROUP_NAME, container_group.name).containers[0]
-            if (container.instance_view != None):
-                if container.instance_view.current_state.state == "Running":
-                    running_container_groups_names.append(container_group.name)
-
-    return running_container_groups_names
+    # コンテナグループの状態のスナップショットから、稼働しているコンテナグループ名を取得
+    return CONTAINER_FLEET.names_in_state("Running", name_prefix=name_prefix)
 
 # コンテナインスタンスのログを取得する関数
 
@@ -421,11 +382,8 @@ def get_running_container_groups(name_prefix="whisper"):
 def get_container_log(
     container_group_name
 ):
-    # 認証情報の設定
-    credential = DefaultAzureCredential()
-
-    # クライアントの初期化
-    client = ContainerInstanceManagementClient(credential, SUBSCRIPTION_ID)
+    # 共有のクライアントを取得
+    client = CONTAINER_FLEET.client()
 
     log = client.containers.list_logs(
         resource_group_name=RESOURCE_GROUP_NAME,
@@ -2,16 +2,14 @@ import azure.functions as func
 import azure.durable_functions as d_func
 from difflib import HtmlDiff
 from bs4 import BeautifulSoup, Tag, NavigableString
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Alignment
-from openpyxl.cell.text import InlineFont
-from openpyxl.cell.rich_text import CellRichText, TextBlock
 from itertools import zip_longest
 import logging
 import base64
 import re
 import json
-import io
+
+from utils.workbook import WorkbookBuilder, StyledCell
+from utils.workbook.renderer import WORKBOOK_RENDERER, DELIVERY_INLINE
 
 ##
 # blueprint
@@ -126,7 +124,10 @@ class DiffProcessor:
 
 
 class ExcelService():
-    """差分解析結果をExcelファイルに書き込むクラス。"""
+    """
+    差分解析結果をExcelファイルに書き込むクラス。
+    列幅・表示形式はシートに行を追加する時点で決め、書き出しはWORKBOOK_RENDERERで行う。
+    """
 
     DIFF_SHEET_NAME = "比較結果"
     DIFF_HEADER_COL3 = "相違点"
@@ -138,16 +139,7 @@ class ExcelService():
     }
 
     def __init__(self):
-        self.wb = self._create_workbook()
-        self._inline_fonts = {
-            tag: InlineFont(color=color) for tag, color in self.FONT_COLORS.items()
-        }
-
-    def _create_workbook(self):
-        """新しいワークブックを作成する。"""
-        wb = Workbook()
-        wb.remove(wb.active)
-        return wb
+        self.wb = WorkbookBuilder()
 
     def _validate_sheet_title(self, title):
         """Excelシート名として無効な文字を置換し、長さを調整する。"""
@@ -174,96 +166,49 @@ class ExcelService():
 
     def add_source_sheet(self, lines, title, sheet_name):
         """元のテキストデータを格納するシートを追加する。"""
-        ws = self.wb.create_sheet(title=sheet_name)
+        # 数値以外のセルは文字列の表示形式にする
+        ws = self.wb.create_sheet(sheet_name, text_format=True)
 
-        # ファイル名を1行目に格納
-        title_cell = ws.cell(row=1, column=1, value=title)
-        # 折り返し表示
-        title_cell.alignment = Alignment(wrap_text=True, vertical='top')
-        for i, line in enumerate(lines, start=2):
+        # ファイル名を1行目に格納（折り返し表示）
+        ws.append([StyledCell(title, wrap=True)])
+        for line in lines:
             value = (
                 f"'{line}" if line.startswith("=") else line  # =で始まる場合は'を付与
             )
-            cell = ws.cell(row=i, column=1, value=value)
             # 折り返し表示
-            cell.alignment = Alignment(wrap_text=True, vertical='top')
+            ws.append([StyledCell(value, wrap=True)])
 
     def add_diff_sheet(self, diff_iterator, file1_name, file2_name):
         """差分比較結果を格納するシートを追加する。"""
-        ws = self.wb.create_sheet(title=self.DIFF_SHEET_NAME)
+        ws = self.wb.create_sheet(self.DIFF_SHEET_NAME, text_format=True)
         # 各ファイル名を1行目に格納
-        ws.cell(row=1, column=1, value=file1_name)
-        ws.cell(row=1, column=2, value=file2_name)
-        ws.cell(row=1, column=3, value=self.DIFF_HEADER_COL3)
-
-        for row_idx, row_data in enumerate(diff_iterator, start=2):
-            # 比較元格納セル
-            self._write_text_cell(ws, row_idx, 1, row_data["runs_left"])
-            self._write_text_cell(ws, row_idx, 2, row_data["runs_right"])
-            # 相違点格納セル
-            diff_cell = ws.cell(row=row_idx, column=3,
-                                value=row_data["summary"])
-            # 折り返し表示
-            diff_cell.alignment = Alignment(wrap_text=True, vertical='top')
-
-    def _write_text_cell(self, ws, row, col, runs):
-        """指定されたセルにテキストを書き込む。"""
-        cell = ws.cell(row=row, column=col)
+        ws.append([file1_name, file2_name, self.DIFF_HEADER_COL3])
+
+        for row_data in diff_iterator:
+            ws.append([
+                # 比較元格納セル
+                self._text_cell(row_data["runs_left"]),
+                self._text_cell(row_data["runs_right"]),
+                # 相違点格納セル（折り返し表示）
+                StyledCell(row_data["summary"], wrap=True),
+            ])
+
+    def _text_cell(self, runs):
+        """差分のテキストを書き込むセルを作成する。"""
         if not runs:
-            return
+            return StyledCell()
 
-        blocks = [TextBlock(self._inline_fonts[tag], text)
-                  for tag, text in runs if text]
+        blocks = [(tag, text) for tag, text in runs if text]
         if len(blocks) == 1 and runs[0][0] == "normal":
-            cell.value = blocks[0].text
-        elif blocks:
-            cell.value = CellRichText(blocks)
+            return StyledCell(blocks[0][1], wrap=True)
+        if blocks:
+            return StyledCell(runs=[(self.FONT_COLORS[tag], text) for tag, text in blocks], wrap=True)
         # 折り返し表示
-        cell.alignment = Alignment(wrap_text=True, vertical='top')
-
-    def _format(self):
-        """全てのシートに対し、書式設定及び列幅を調整する。"""
-        for ws in self.wb.worksheets:
-            self._set_number_formats(ws)
-            self._adjust_column_width(ws)
-
-    def _set_number_formats(self, ws):
-        """セルの内容に応じて数値書式または文字列書式を設定する。"""
-        for row in ws.iter_rows():
-            for cell in row:
-                if isinstance(cell.value, (int, float)):
-                    cell.number_format = "General"
-                else:
-                    cell.number_format = "@"
-
-    def _adjust_column_width(self, ws):
-        """ワークシートの列幅を内容に合わせて自動調整する。"""
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            # 列の全セルをチェック
-            for cell in column:
-                try:
-                    # セルの値を文字列として取得
-                    cell_value = str(
-                        cell.value) if cell.value is not None else ""
-                    # 現在の最大長と比較
-                    max_length = max(max_length, len(cell_value))
-                except Exception as e:
-                    logging.warning(
-                        f"Error processing cell {cell.coordinate}: {str(e)}")
-                    continue
-            # 最小幅と最大幅の制限を設定 (最小8文字、最大50文字)
-            adjusted_width = min(max(max_length + 2, 8), 50)
-            # 列幅を設定
-            ws.column_dimensions[column_letter].width = adjusted_width
-
-    def get_bytes(self):
-        """ワークブックをメモリ上のバイトデータとして取得する。"""
-        self._format()
-        buffer = io.BytesIO()
-        self.wb.save(buffer)
-        return buffer.getvalue()
+        return StyledCell(wrap=True)
+
+    async def get_bytes(self):
+        """ワークブックをバイトデータとして取得する。（生成はプロセスプールで行う）"""
+        return await WORKBOOK_RENDERER.render(self.wb)
 
 
 @file_diff_bp.route(route="genie/file_diff", methods=("POST",))
@@ -280,6 +225,8 @@ async def file_diff(req: func.HttpRequest) -> func.HttpResponse:
         file2 = req_json["file2"]
         file2_name = req_json["file2_name"]
         upn = req_json["upn"]
+        # "blob"の場合はExcelをbase64で返さず、Blobに保存してblob名を返す（genie/blobでダウンロードする）
+        delivery = req_json.get("delivery", DELIVERY_INLINE)
     except Exception as e:
         logging.error(f"リクエストの受付処理時エラー: {e}")
         res_json = {"message": "リクエストの受付処理に失敗しました"}
@@ -309,16 +256,19 @@ async def file_diff(req: func.HttpRequest) -> func.HttpResponse:
         excel_service.add_source_sheet(file2_splitted, file2_name, sheet2_name)
         excel_service.add_diff_sheet(
             diff_processor.iter_diff_rows(), file1_name, file2_name)
-        excel_bytes = excel_service.get_bytes()
+        excel_bytes = await excel_service.get_bytes()
+        excel_file = await WORKBOOK_RENDERER.deliver(
+            excel_bytes, f"file_diff_{file1_name}_{file2_name}.xlsx", upn, delivery)
 
         # html & Excelファイル返却
         html_base64 = base64.b64encode(html.encode('utf-8')).decode('utf-8')
-        excel_base64 = base64.b64encode(excel_bytes).decode('utf-8')
         res_json = {
             "message": "差分表示用HTMLとExcelファイルの作成に成功しました。",
             "html_diff_base64": html_base64,
-            "excel_diff_base64": excel_base64
+            "excel_diff_base64": excel_file.get("data", "")
         }
+        if "blob_name" in excel_file:
+            res_json["excel_diff_blob_name"] = excel_file["blob_name"]
         return func.HttpResponse(
             json.dumps(res_json, ensure_ascii=False),
             mimetype="application/json",
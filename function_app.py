@@ -15,11 +15,11 @@ import io
 import sys
 import random
 import traceback
-from openpyxl import Workbook
 
 import ast
 import csv
 import asyncio
+import time
 
 # OSS
 import requests
@@ -27,29 +27,42 @@ import pandas as pd
 import markdown
 from pydantic import BaseModel, Field
 import openai
+import aiohttp
+from azurefunctions.extensions.http.fastapi import Request, StreamingResponse
 
 # 自作
 from config import LLM_REGISTRY, NON_CHAT_REGISTRY, COSMOS_CLIENT, VARIABLE_LIST, ENVIRONMENT_SELECTED
 from util import *
-from utils.token import decode_id_token
+from utils.token import decode_id_token, get_openid_keys, OPENID_KEY_CACHE
+from utils.clients import CLIENT_REGISTRY
+from utils.text_cache import FILE_TEXT_CACHE
+from utils.chunked_upload import CHUNKED_UPLOAD_STORE, ChunkedUploadError, PURPOSE_UPLOAD, PURPOSE_WHISPER
+from utils.streaming import CODE_FENCE_PATTERN, CodeFenceStripper, STREAM_METRICS, sse_event, parse_sse_events, stream_chat_completion
 from utils.user_auth.user_auth_manager import UserDivisionFetchService, MenuPermissionService
-
-from i_style.aiohttp import AsyncHttpClient, http_post
-from i_style.token import EntraIDTokenManager
+from utils.warmup import SIGNIN_WARMUP
+from utils.transcription import TRANSCRIPTION_GATEWAY
+from utils.prompt_catalog import PROMPT_CATALOG
+from utils.llm_scheduler import OCR_LLM_SCHEDULER
+from utils.workbook import WorkbookBuilder
+from utils.workbook.renderer import WORKBOOK_RENDERER, DELIVERY_INLINE
+from utils.token_budget import TOKEN_BUDGET
+from utils.minutes import MINUTES_ENGINE, MinutesPrompts
+
+from i_style.aiohttp import http_post
 from i_style.llm import AzureOpenAI, GeminiGenerate, ClaudeGenerate
-from openai import AsyncAzureOpenAI
 
 from prompt import (
     func_list, replace_dict, language_dict, ocr_prompt_list, ocr_prompt_list_business_pattern, ocr_prompt_list_shipping,
     query_prompt, process_prompt, choice_prompt, formatted_date, FavoritePromptManager, QueryList, LinkList,
     BASE_SYSTEM_CONTENT, WEB_SYSTEM_CONTENT, MAIL_SYSTEM_CONTENT, TEAMS_SYSTEM_CONTENT,
     CHAT_SYSTEM_CONTENT, CSE_SYSTEM_CONTENT, CSE_RESULT_SYSTEM_CONTENT, query_suffix,
-    MINUTES_SYSTEM_CONTENT, whisper_options, transcribe_prompt_dict, TRANSLATION_SYSTEM_CONTENT,
+    MINUTES_SYSTEM_CONTENT, MINUTES_MAP_SYSTEM_CONTENT, MINUTES_REDUCE_SYSTEM_CONTENT, MINUTES_REFINE_PREFIX,
+    whisper_options, transcribe_prompt_dict, TRANSLATION_SYSTEM_CONTENT,
     CRM_SYSTEM_CONTENT, CRM_USER_CONTENT, OCR_CSV_SYSTEM_CONTENT, SEARCH_GROUNDING_PROMPT,
     GOOGLE_CONTENT_SUMMARIZE_SYSTEM_CONTENT, QUERY_GENERATION_SYSTEM_CONTENT, LINK_SELECTION_SYSTEM_CONTENT
     )
 
-from config import GPT_API_VERSION, GPT4O_TRANSCRIBE_API_ENDPOINT, GPT4O_TRANSCRIBE_API_KEY, GPT4O_TRANSCRIBE_DEPLOYMENT_NAME, MCP_AGENT_URL, MCP_AGENT_API_KEY, GEMINI_DEFAULT_LABELS
+from config import MCP_AGENT_URL, MCP_AGENT_API_KEY, GEMINI_DEFAULT_LABELS
 from replace_list import replace_list
 
 from crm import csv_search
@@ -62,7 +75,7 @@ from history_bp import history_bp
 from ocr_bp import ocr_bp
 from file_diff_bp import file_diff_bp
 
-from blueprints import blob_dl_bp, hanabi_bp, word_bp
+from blueprints import blob_dl_bp, hanabi_bp, word_bp, chunked_upload_bp
 
 from utils.enq_apis.api_call import EnqAPICall
 from utils.enq_apis.authority_verification import AuthorityVerification
@@ -82,6 +95,9 @@ GPT5_MODEL_SERIES = {
         "gpt5-high": "high"
     }
 
+# llm_docsのプロンプトの置換（replace_dictから起動時に一度だけ作成）
+replace_docs_words = compile_replace_dict(replace_dict)
+
 
 ########
 # main #
@@ -99,6 +115,7 @@ app.register_blueprint(log_bp)
 app.register_blueprint(history_bp)
 app.register_blueprint(ocr_bp)
 app.register_blueprint(blob_dl_bp)
+app.register_blueprint(chunked_upload_bp)
 app.register_blueprint(file_diff_bp)
 app.register_blueprint(hanabi_bp)
 app.register_blueprint(word_bp)
@@ -107,23 +124,92 @@ app.register_blueprint(word_bp)
 @app.route(route="genie", methods=("POST",))
 async def genie(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Genie processed a request.')
+    start_time = time.monotonic()
+
+    ctx = await _genie_prepare(req.get_json(), req.params.get("id_token"), req.headers.get("x-forwarded-for"))
+    if "response" in ctx:
+        return func.HttpResponse(
+            json.dumps(ctx["response"]),
+            status_code=200 # 503
+            )
+
+    func_name = ctx["func_name"]
+    req_json = ctx["req_json"]
+    blob_names = ctx["blob_names"]
+
+    # API KEYとURLの取得
+    FUNCTION_API_KEY = os.environ.get(f"{func_name}_API_KEY")
+    FUNCTION_URL = os.environ.get(f"{func_name}_URL")
+
+    # API呼び出し
+    try:
+        api_response = await http_post(json_data=req_json, url=FUNCTION_URL, api_key=FUNCTION_API_KEY, process_name=func_name)
+        api_response_text = api_response["choices"][0]["message"]["content"]
+        if api_response["object"] == 'error':
+            status_code=200 # 503
+        else:
+            status_code=200
+        logging.info("Assistant response: " + api_response_text)
+
+        # ```html で始まるコードブロックを除去
+        api_response["choices"][0]["message"]["content"] = CODE_FENCE_PATTERN.sub(html_replacer, api_response["choices"][0]["message"]["content"])
+
+        # blobsの追加
+        api_response["blobs"] = blob_names
+    except Exception as e:
+        logging.critical(f"{e}")
+
+        # blobsの追加
+        api_response = error_response("サーバーからの応答がありません。時間をおいてお試しください。")
+        api_response["blobs"] = blob_names
+
+    # 履歴の登録
+    if ctx["session_id"] != None:
+        api_response.update(await _genie_add_history(ctx, api_response["choices"][0]["message"]["content"]))
+
+    # ストリーミング版との比較用（非ストリーミングはttft = total）
+    elapsed = time.monotonic() - start_time
+    STREAM_METRICS.record("genie", ttft=elapsed, total=elapsed)
+    return func.HttpResponse(json.dumps(api_response))
+
+
+# Genie(ストリーミング)
+@app.route(route="genie/stream", methods=("POST",))
+async def genie_stream(req: Request) -> StreamingResponse:
+    """
+    genieのストリーミング版。回答をServer-Sent Eventsで返す
+    リクエストはgenieと同じ。イベントは以下の通り
+    - {"type": "delta", "text": ...}: 回答の差分（```html のコードブロックは除去済み）
+    - {"type": "done", "blobs": [...], "session_id": ..., "title": ...}: 完了（履歴の登録後に送信）
+    - {"type": "error", "response": {...}}: エラー（genieと同じ形式のレスポンス）
+    LLM_CHATのみ差分ごとに返し、それ以外の機能は回答をまとめて1つの差分として返す
+    """
+    logging.info('Genie stream processed a request.')
+    start_time = time.monotonic()
+
+    ctx = await _genie_prepare(await req.json(), req.query_params.get("id_token"), req.headers.get("x-forwarded-for"))
+    return StreamingResponse(
+        _genie_stream_events(ctx, start_time),
+        media_type="text/event-stream"
+    )
+
+
+async def _genie_prepare(req_json: dict, id_token: str, client_ip: str) -> dict:
+    """
+    genie, genie/streamの共通の前処理
+    認証、履歴の取得、ファイルの文字起こし、Brainによる機能の選択を行い、後続の処理に必要な値をまとめて返す
+    エラーの場合は返却するレスポンスを"response"に入れて返す
+    """
 ########
 # init #
 ########
     # 非同期http通信クライアントのインスタンス化
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     # apiの呼び出し
     history_base_url = os.environ.get("HISTORY_API_URL")
     history_api_key = os.environ.get("HISTORY_API_KEY")
 
-    title = "No Title"
-
-    # get client ip
-    client_ip = req.headers.get("x-forwarded-for")
-
-    # get json input
-    req_json = req.get_json()
     mode = req_json["mode"]
 
     session_id = req_json.get("session_id")
@@ -132,18 +218,13 @@ async def genie(req: func.HttpRequest) -> func.HttpResponse:
     # DBにアクセスする場合はid_tokenでの認証を実施する
     if session_id != None or mode == "box":
         try:
-            id_token = req.params.get("id_token")
-            keys = await EntraIDTokenManager.get_entra_openid_keys(async_http_client)
+            keys = await get_openid_keys(async_http_client, id_token)
             upn, mail, _ = decode_id_token(id_token, keys)
         except Exception as e:
             logging.warning(f"token error: {e}")
             response = error_response("認証に失敗しました。ページの再読み込みをお試しください。")
             response["blobs"] = []
-
-            return func.HttpResponse(
-                json.dumps(response),
-                status_code=200 # 503
-            )
+            return {"response": response}
     else:
         upn = req_json.get("upn")
         mail = req_json.get("mail")
@@ -176,6 +257,7 @@ async def genie(req: func.HttpRequest) -> func.HttpResponse:
     logging.info(f"mail: {mail}")
     logging.info("model: " + model)
 
+    new_message = {"role": "user", "content": ""}
     try:
         messages = req_json["messages"]
 
@@ -185,7 +267,6 @@ async def genie(req: func.HttpRequest) -> func.HttpResponse:
         messages = []
     except IndexError as e:
         logging.warning(f"IndexError: {e}")
-        new_message = {"role": "user", "content": ""}
 
     if session_id != None:
         params = {"sessionId": session_id}
@@ -265,10 +346,7 @@ async def genie(req: func.HttpRequest) -> func.HttpResponse:
         logging.warning(f"Brain error: {e}")
         response = error_response("サーバーからの応答がありません。時間をおいてお試しください。")
         response["blobs"] = blob_names
-        return func.HttpResponse(
-            json.dumps(response),
-            status_code=200 # 503
-            )
+        return {"response": response}
     logging.info("Brain function: "+func_name)
     user_input = messages[-1]["content"]
 
@@ -288,88 +366,73 @@ async def genie(req: func.HttpRequest) -> func.HttpResponse:
         message = "質問を見つけられませんでした。もう一度質問を入力してください。"
         response = error_response(message)
         response["blobs"] = blob_names
-        return func.HttpResponse(
-            json.dumps(response),
-            status_code=200 # 503
-            )
+        return {"response": response}
 
     # enq
     if func_name == "LLM_DOCS":
         func_name = "LLM_ENQ"
 
-    # API KEYとURLの取得
-    FUNCTION_API_KEY = os.environ.get(f"{func_name}_API_KEY")
-    FUNCTION_URL = os.environ.get(f"{func_name}_URL")
-
-    # API呼び出し
-    try:
-        req_json["messages"] = messages
-        api_response = await http_post(json_data=req_json, url=FUNCTION_URL, api_key=FUNCTION_API_KEY, process_name=func_name)
-        api_response_text = api_response["choices"][0]["message"]["content"]
-        if api_response["object"] == 'error':
-            status_code=200 # 503
-        else:
-            status_code=200
-        logging.info("Assistant response: " + api_response_text)
-
-        # ```html で始まるコードブロックを除去
-        api_response["choices"][0]["message"]["content"] = re.sub(r"```([a-zA-Z0-9]+)?\s*\n?(.*?)```", html_replacer, api_response["choices"][0]["message"]["content"], flags=re.DOTALL)
-
-        # blobsの追加
-        api_response["blobs"] = blob_names
-    except Exception as e:
-        logging.critical(f"{e}")
-
-        # blobsの追加
-        api_response = error_response("サーバーからの応答がありません。時間をおいてお試しください。")
-        api_response["blobs"] = blob_names
+    req_json["messages"] = messages
+    return {
+        "async_http_client": async_http_client,
+        "history_base_url": history_base_url,
+        "history_api_key": history_api_key,
+        "req_json": req_json,
+        "mode": mode,
+        "session_id": session_id,
+        "upn": upn,
+        "model": model,
+        "sendFrom": sendFrom,
+        "new_message": new_message,
+        "blobs": blobs,
+        "blob_names": blob_names,
+        "func_name": func_name,
+    }
 
-    # 履歴の登録
-    if session_id != None:
-        submode_mapping = {
-            "LLM_CHAT": "chat",
-            "LLM_GOOGLE": "google"
-        }
-        submode = submode_mapping.get(func_name, "")
 
-        request_data = {
-            "items": []
-        }
+async def _genie_add_history(ctx: dict, assistant_text: str) -> dict:
+    """
+    genie, genie/streamの共通の履歴の登録
+    レスポンスに追加するsession_id, titleを返す
+    """
+    func_name = ctx["func_name"]
+    mode = ctx["mode"]
+    upn = ctx["upn"]
+    model = ctx["model"]
+    sendFrom = ctx["sendFrom"]
+    session_id = ctx["session_id"]
+
+    result = {}
+    title = "No Title"
 
-        if mode != "minutes":
+    submode_mapping = {
+        "LLM_CHAT": "chat",
+        "LLM_GOOGLE": "google"
+    }
+    submode = submode_mapping.get(func_name, "")
 
-            # 汎用履歴への登録用に最新のmessageの中にfileがある場合はblobに置換
-            blob_contents_info = [{'type': 'blob', 'name': blob['name'], 'file_name': blob['file_name']} for blob in blobs]
+    request_data = {
+        "items": []
+    }
 
-            content = new_message['content']
-            if isinstance(content, list):
-                other_contents_info = [item.copy() for item in content if item.get('type') != 'file']
-            elif isinstance(content, str):
-                other_contents_info = [{'type': 'text', 'text': content}]
+    if mode != "minutes":
 
-            converted_content = blob_contents_info + other_contents_info
+        # 汎用履歴への登録用に最新のmessageの中にfileがある場合はblobに置換
+        blob_contents_info = [{'type': 'blob', 'name': blob['name'], 'file_name': blob['file_name']} for blob in ctx["blobs"]]
 
-            request_data["items"].append(
-                {
-                    "upn": upn,
-                    "content": converted_content,
-                    "role": "user",
-                    "submode": submode,
-                    "model": model,
-                    "from": sendFrom,
-                    "sessionId": session_id
-                }
-            )
+        content = ctx["new_message"]['content']
+        if isinstance(content, list):
+            other_contents_info = [item.copy() for item in content if item.get('type') != 'file']
+        elif isinstance(content, str):
+            other_contents_info = [{'type': 'text', 'text': content}]
 
-        content = {"type": "text", "text": api_response["choices"][0]["message"]["content"]}
+        converted_content = blob_contents_info + other_contents_info
 
         request_data["items"].append(
             {
                 "upn": upn,
-                "content": [
-                    content
-                ],
-                "role": "assistant",
+                "content": converted_content,
+                "role": "user",
                 "submode": submode,
                 "model": model,
                 "from": sendFrom,
@@ -377,62 +440,132 @@ async def genie(req: func.HttpRequest) -> func.HttpResponse:
             }
         )
 
-        # history_base_url: https://itc-history-functions.azurewebsites.net
-        if mode not in {"inside", "minutes"}:
-            mode = "genie"
-        url = f"{history_base_url}/api/history/{mode}"
+    content = {"type": "text", "text": assistant_text}
 
-        api_name = "add_history"
-        try:
-            response = await async_http_client.post(url=url, api_key=history_api_key, json_data=request_data, process_name=api_name)
-        except Exception as e:
-            logging.warning(f"履歴の追加: {e}")
-        else:
-            api_response["session_id"] = response["sessionId"]
-            title = response.get("title", "タイトルの取得に失敗しました。")
+    request_data["items"].append(
+        {
+            "upn": upn,
+            "content": [
+                content
+            ],
+            "role": "assistant",
+            "submode": submode,
+            "model": model,
+            "from": sendFrom,
+            "sessionId": session_id
+        }
+    )
 
-        api_response["title"] = title
-    return func.HttpResponse(json.dumps(api_response))
+    # history_base_url: https://itc-history-functions.azurewebsites.net
+    if mode not in {"inside", "minutes"}:
+        mode = "genie"
+    url = f"{ctx['history_base_url']}/api/history/{mode}"
+
+    api_name = "add_history"
+    try:
+        response = await ctx["async_http_client"].post(url=url, api_key=ctx["history_api_key"], json_data=request_data, process_name=api_name)
+    except Exception as e:
+        logging.warning(f"履歴の追加: {e}")
+    else:
+        result["session_id"] = response["sessionId"]
+        title = response.get("title", "タイトルの取得に失敗しました。")
+
+    result["title"] = title
+    return result
+
+
+async def _genie_stream_events(ctx: dict, start_time: float):
+    """
+    genie/streamのイベントを順に返す
+    回答をすべて返した後に履歴を登録し、最後にdone(エラー時はerror)を返す
+    """
+    if "response" in ctx:
+        yield sse_event({"type": "error", "response": ctx["response"]})
+        return
+
+    stripper = CodeFenceStripper(html_replacer)
+    response_text = ""
+    ttft = None
+    error = None
+    try:
+        async for delta in _genie_stream_deltas(ctx["func_name"], ctx["req_json"]):
+            response_text += delta
+            text = stripper.feed(delta)
+            if text:
+                if ttft is None:
+                    ttft = time.monotonic() - start_time
+                yield sse_event({"type": "delta", "text": text})
+        text = stripper.finish()
+        if text:
+            yield sse_event({"type": "delta", "text": text})
+        logging.info("Assistant response: " + response_text)
+        assistant_text = CODE_FENCE_PATTERN.sub(html_replacer, response_text)
+    except Exception as e:
+        logging.critical(f"{e}")
+        error = error_response("サーバーからの応答がありません。時間をおいてお試しください。")
+        error["blobs"] = ctx["blob_names"]
+        assistant_text = error["choices"][0]["message"]["content"]
+
+    # 履歴の登録（genieと同様にエラー時もエラーメッセージを登録する）
+    result = {"blobs": ctx["blob_names"]}
+    if ctx["session_id"] != None:
+        result.update(await _genie_add_history(ctx, assistant_text))
+
+    total = time.monotonic() - start_time
+    STREAM_METRICS.record("genie_stream", ttft=total if ttft is None else ttft, total=total)
+
+    if error is not None:
+        error.update(result)
+        yield sse_event({"type": "error", "response": error})
+    else:
+        yield sse_event({"type": "done", **result})
+
+
+async def _genie_stream_deltas(func_name: str, req_json: dict):
+    """
+    各機能のAPIを呼び出し、回答の差分を返す
+    LLM_CHATはストリーミング版(LLM_CHAT_STREAM_URL)を呼び出し、それ以外はまとめて1つの差分として返す
+    """
+    FUNCTION_API_KEY = os.environ.get(f"{func_name}_API_KEY")
+    FUNCTION_STREAM_URL = os.environ.get(f"{func_name}_STREAM_URL")
+
+    if func_name == "LLM_CHAT" and FUNCTION_STREAM_URL:
+        session = CLIENT_REGISTRY.aiohttp_session()
+        async with session.post(
+            FUNCTION_STREAM_URL,
+            json=req_json,
+            headers={"x-functions-key": FUNCTION_API_KEY},
+            timeout=aiohttp.ClientTimeout(total=230)
+        ) as response:
+            response.raise_for_status()
+            async for event in parse_sse_events(response.content):
+                if event["type"] == "delta":
+                    yield event["text"]
+                elif event["type"] == "error":
+                    raise RuntimeError(event.get("message"))
+        return
+
+    FUNCTION_URL = os.environ.get(f"{func_name}_URL")
+    api_response = await http_post(json_data=req_json, url=FUNCTION_URL, api_key=FUNCTION_API_KEY, process_name=func_name)
+    yield api_response["choices"][0]["message"]["content"]
 
 
 # LLM_CHAT
 @app.route(route="llm/chat", methods=("POST",))
 async def llm_chat(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('LLM_CHAT processed a request.')
+    start_time = time.monotonic()
 ########
 # init #
 ########
     # get json input
     req_json = req.get_json()
-    sendFrom = req_json["from"]
-
     model_name = req_json.get("model", "gpt4.1")
 
-    messages = req_json["messages"]
-    user_input = next((content["text"] for content in messages[-1]["content"] if content["type"] == "text"), "")
-    logging.info("User input:" + user_input)
-
-    ui_system_content = ""
-    if sendFrom == "web":
-        ui_system_content = WEB_SYSTEM_CONTENT
-    if sendFrom == "mail":
-        ui_system_content = MAIL_SYSTEM_CONTENT
-    if sendFrom == "teams":
-        ui_system_content = TEAMS_SYSTEM_CONTENT
-
-    # prompt
-    chat_system_content = BASE_SYSTEM_CONTENT + ui_system_content + CHAT_SYSTEM_CONTENT
-    chat_system_content = chat_system_content.format(formatted_date=formatted_date())
-
-
 ########
 # main #
 ########
-    chat_messages = change_system_content(messages,chat_system_content)
-    if sendFrom in ["teams", ]:
-        for content in chat_messages[-1]["content"]:
-            if content["type"] == "text":
-                content["text"] += "\nHTML形式で回答してください。"
+    chat_messages = _llm_chat_messages(req_json)
     try:
         if model_name.startswith("claude-"):
             # Claude モデルの場合
@@ -444,46 +577,110 @@ async def llm_chat(req: func.HttpRequest) -> func.HttpResponse:
                 raise_for_error=False,
                 registry=LLM_REGISTRY
             )
-        elif model_name in GPT5_MODEL_SERIES:
-            # gpt5-low/medium/high → 実際の model_name は gpt5 に固定
-            chat_response = await AzureOpenAI(
-                chat_messages,
-                model_name="gpt5",
-                max_retries=2,
-                timeout=230,
-                raise_for_error=False,
-                registry=LLM_REGISTRY,
-                reasoning_effort=GPT5_MODEL_SERIES[model_name],
-                verbosity="high"
-            )
-        elif model_name.startswith("gpt5"):
-            # 他の gpt5 系モデルは low + high verbosity
-            chat_response = await AzureOpenAI(
-                chat_messages,
-                model_name=model_name,
-                max_retries=2,
-                timeout=230,
-                raise_for_error=False,
-                registry=LLM_REGISTRY,
-                reasoning_effort="low",
-                verbosity="high"
-            )
         else:
+            aoai_model_name, options = _llm_chat_model_options(model_name)
             chat_response = await AzureOpenAI(
                 chat_messages,
-                model_name=model_name,
+                model_name=aoai_model_name,
                 max_retries=2,
                 timeout=230,
                 raise_for_error=False,
-                registry=LLM_REGISTRY
+                registry=LLM_REGISTRY,
+                **options
             )
         # chat_response["choices"][0]["message"]["content"] += "<br><hr>" + "インターネット上の情報を検索して生成した回答が欲しい場合は「1」を入力してください。"
+        elapsed = time.monotonic() - start_time
+        STREAM_METRICS.record("llm_chat", ttft=elapsed, total=elapsed)
         return func.HttpResponse(json.dumps(chat_response))
     except Exception as e:
         logging.critical(f"LLM_CHAT: {e}")
         return func.HttpResponse(json.dumps(error_response("サーバーからの応答がありません。時間をおいてお試しください。")))
 
 
+# LLM_CHAT(ストリーミング)
+@app.route(route="llm/chat/stream", methods=("POST",))
+async def llm_chat_stream(req: Request) -> StreamingResponse:
+    """
+    llm/chatのストリーミング版。回答をServer-Sent Eventsで返す
+    - {"type": "delta", "text": ...}: 回答の差分
+    - {"type": "done"}: 完了
+    - {"type": "error", "message": ...}: エラー
+    """
+    logging.info('LLM_CHAT stream processed a request.')
+    start_time = time.monotonic()
+
+    req_json = await req.json()
+    model_name = req_json.get("model", "gpt4.1")
+    chat_messages = _llm_chat_messages(req_json)
+
+    async def events():
+        ttft = None
+        try:
+            if model_name.startswith("claude-"):
+                deltas = stream_chat_completion(chat_messages, model_name, timeout=230)
+            else:
+                aoai_model_name, options = _llm_chat_model_options(model_name)
+                deltas = stream_chat_completion(chat_messages, aoai_model_name, timeout=230, **options)
+            async for delta in deltas:
+                if ttft is None:
+                    ttft = time.monotonic() - start_time
+                yield sse_event({"type": "delta", "text": delta})
+        except Exception as e:
+            logging.critical(f"LLM_CHAT stream: {e}")
+            yield sse_event({"type": "error", "message": "サーバーからの応答がありません。時間をおいてお試しください。"})
+            return
+
+        total = time.monotonic() - start_time
+        STREAM_METRICS.record("llm_chat_stream", ttft=total if ttft is None else ttft, total=total)
+        yield sse_event({"type": "done"})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def _llm_chat_messages(req_json: dict) -> list:
+    """
+    llm/chat, llm/chat/streamの共通の処理
+    送信元に応じたsystem promptを設定したmessagesを返す
+    """
+    sendFrom = req_json["from"]
+
+    messages = req_json["messages"]
+    user_input = next((content["text"] for content in messages[-1]["content"] if content["type"] == "text"), "")
+    logging.info("User input:" + user_input)
+
+    ui_system_content = ""
+    if sendFrom == "web":
+        ui_system_content = WEB_SYSTEM_CONTENT
+    if sendFrom == "mail":
+        ui_system_content = MAIL_SYSTEM_CONTENT
+    if sendFrom == "teams":
+        ui_system_content = TEAMS_SYSTEM_CONTENT
+
+    # prompt
+    chat_system_content = BASE_SYSTEM_CONTENT + ui_system_content + CHAT_SYSTEM_CONTENT
+    chat_system_content = chat_system_content.format(formatted_date=formatted_date())
+
+    chat_messages = change_system_content(messages,chat_system_content)
+    if sendFrom in ["teams", ]:
+        for content in chat_messages[-1]["content"]:
+            if content["type"] == "text":
+                content["text"] += "\nHTML形式で回答してください。"
+    return chat_messages
+
+
+def _llm_chat_model_options(model_name: str) -> tuple:
+    """
+    Azure OpenAIのモデル名と、reasoning_effort/verbosityの指定を返す
+    """
+    if model_name in GPT5_MODEL_SERIES:
+        # gpt5-low/medium/high → 実際の model_name は gpt5 に固定
+        return "gpt5", {"reasoning_effort": GPT5_MODEL_SERIES[model_name], "verbosity": "high"}
+    elif model_name.startswith("gpt5"):
+        # 他の gpt5 系モデルは low + high verbosity
+        return model_name, {"reasoning_effort": "low", "verbosity": "high"}
+    return model_name, {}
+
+
 # LLM_GOOGLE
 @app.route(route="llm/google", methods=("POST",))
 async def llm_google(req: func.HttpRequest) -> func.HttpResponse:
@@ -492,7 +689,7 @@ async def llm_google(req: func.HttpRequest) -> func.HttpResponse:
 # init #
 ########
 
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
     # get json input
     req_json = req.get_json()
     sendFrom = req_json["from"]
@@ -562,15 +759,14 @@ async def llm_google(req: func.HttpRequest) -> func.HttpResponse:
         logging.warning("queryを減らしました")
         queries = queries[:max_query_num]
 
-    # 各クエリごとに5件ずつ検索して結果を集約
+    # 各クエリごとに5件ずつ並列に検索して結果を集約（集約はクエリの順序を維持）
     cse_list = []
     seen_links = set()  # 重複チェック用のセット
-    for query in queries:
+    search_results = await google_search_many(async_http_client, queries, num=max_search_results)
+    for query, search_result in zip(queries, search_results):
         logging.info("query: " + query)
-        try:
-            search_result = await google_search(async_http_client, query, num=max_search_results)
-        except Exception as e:
-            logging.critical(f"Google API ERROR {e}, query: {query}")
+        if isinstance(search_result, Exception):
+            logging.critical(f"Google API ERROR {search_result}, query: {query}")
             continue
 
         # エラーチェック（検索結果の先頭の要素を確認）
@@ -848,11 +1044,7 @@ async def llm_docs(req: func.HttpRequest) -> func.HttpResponse:
     DOCUMENTS_SEARCH_URL = os.environ.get("DOCUMENTS_SEARCH_URL")
 
     # 辞書を参照してpromptの置換
-    prompt = user_input
-
-    for key, word_list in replace_dict.items():
-        for word in word_list:
-            prompt = prompt.replace(word, key)
+    prompt = replace_docs_words(user_input)
     logging.info("prompt: " + prompt)
 
     history_list = []
@@ -949,7 +1141,7 @@ async def llm_enq(req: func.HttpRequest) -> func.HttpResponse:
     - エネ化問い合わせDB検索
     """
     # 非同期http通信クライアントのインスタンス化
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     # get json input
     req_json = req.get_json()
@@ -1083,67 +1275,23 @@ async def llm_minutes(req: func.HttpRequest) -> func.HttpResponse:
     # 仮置き
     # gpt4.1
     model_name = "o4-mini"
-    max_tokens = NON_CHAT_REGISTRY.models[model_name].max_tokens
-    model_max_token = max_tokens["input"]
-
-    # ループ制御
-    loop_count = 0
-    start_num = 0
-    len_buffer = 500
-    len_text = max_len_text = model_max_token - max_tokens["output"] - len_buffer*2
+    # 議事録の作成方法 "map_reduce" / "refine"（指定しない場合はMINUTES_MODE）
+    mode = req_json.get("mode")
 
     # prompt
-    minutes_system_content = MINUTES_SYSTEM_CONTENT
-    minutes_system_content = minutes_system_content.format(formatted_date=formatted_date())
+    minutes_date = formatted_date()
+    minutes_prompts = MinutesPrompts(
+        system=MINUTES_SYSTEM_CONTENT.format(formatted_date=minutes_date),
+        map_system=MINUTES_MAP_SYSTEM_CONTENT.format(formatted_date=minutes_date),
+        reduce_system=MINUTES_REDUCE_SYSTEM_CONTENT.format(formatted_date=minutes_date),
+        refine_prefix=MINUTES_REFINE_PREFIX,
+    )
 
 ########
 # main #
 ########
-    minutes_messages = change_system_content(messages,minutes_system_content)
-    user_prefix = "残りの会話ログです。先程の議事録を踏まえてあらためて完成版の議事録を作成してください。\n"
     try:
-        while True:
-            # loop init
-            end_num = start_num + len_text + len_buffer
-            end_num = min(end_num,len(user_input[start_num:]))
-
-            minutes_messages=[]
-            minutes_messages.append({"role": "system", "content": minutes_system_content})
-            if loop_count >= 1:
-                minutes_messages.append({"role": "assistant", "content": response_content})
-                minutes_messages.append({"role": "user", "content": user_prefix + user_input[start_num:end_num]})
-            else:
-                minutes_messages.append({"role": "user", "content": user_input[start_num:end_num]})
-
-            # token数を超過していないかのチェック
-            tokens = 0
-            for message in minutes_messages:
-                tokens += check_token(message["content"])
-            logging.warning(f"tokens: {tokens}")
-            if model_max_token < tokens + max_tokens["output"] + 1:
-                logging.warning(f"minutes: too many token {tokens}")
-                len_text -= 1000
-                continue
-
-            minutes_response = await AzureOpenAI(
-                minutes_messages,
-                temperature=0,
-                model_name=model_name,
-                max_retries=2,
-                timeout=230,
-                raise_for_error=False,
-                registry=NON_CHAT_REGISTRY
-                )
-            response_content = minutes_response["choices"][0]["message"]["content"]
-            logging.info(f"loop count: {loop_count}, minutes: {response_content}")
-
-            if end_num == len(user_input[start_num:]):
-                break
-            else:
-                loop_count += 1
-                start_num += len_text
-                len_text = max_len_text
-
+        minutes_response = await MINUTES_ENGINE.create(user_input, minutes_prompts, model_name, mode)
     except Exception as e:
         # エラーメッセージをログファイルに記録
         logging.error("LLM_MINUTES: " + f'Error occurred: {e}')
@@ -1481,26 +1629,32 @@ async def upload_file(req: func.HttpRequest) -> func.HttpResponse:
     # inputs
     inputs = req_json["inputs"]
     url = inputs["url"]
-    container_name = inputs["container_name"]
-
-    # Base64デコードしてバイナリデータに変換
-    encoded_data = inputs["content"][0]
-    binary_data = base64.b64decode(encoded_data)
-
-    # file_name
-    file_name = inputs["file_name"][0]
-    logging.debug(f"uploaded: {file_name}")
 
 ########
 # main #
 ########
     ## upload blob
     try:
-        upload_blob(
-            file_name=file_name,
-            file_content=binary_data,
-            container_name=container_name
-            )
+        if "upload_id" in inputs:
+            # 分割アップロード(genie/upload/sessions)済みのチャンクを結合して確定
+            session = CHUNKED_UPLOAD_STORE.commit(inputs["upload_id"], int(inputs["chunks"]), PURPOSE_UPLOAD)
+            file_name = session["blob_name"]
+        else:
+            container_name = inputs["container_name"]
+
+            # Base64デコードしてバイナリデータに変換
+            encoded_data = inputs["content"][0]
+            binary_data = base64.b64decode(encoded_data)
+
+            # file_name
+            file_name = inputs["file_name"][0]
+
+            upload_blob(
+                file_name=file_name,
+                file_content=binary_data,
+                container_name=container_name
+                )
+        logging.debug(f"uploaded: {file_name}")
     except Exception as e:
         logging.critical(f"CANNOT UPLOAD FILE: {e}")
         json_response["error"] = f"CANNOT UPLOAD FILE: {e}"
@@ -1543,7 +1697,7 @@ async def whisper(req: func.HttpRequest) -> func.HttpResponse:
 # init #
 ########
     # 非同期http通信クライアントのインスタンス化
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     title = "No title"
 
@@ -1601,30 +1755,32 @@ async def whisper(req: func.HttpRequest) -> func.HttpResponse:
 # main #
 ########
 
-    client = AsyncAzureOpenAI(
-        api_version=GPT_API_VERSION,
-        azure_endpoint=GPT4O_TRANSCRIBE_API_ENDPOINT,
-        api_key=GPT4O_TRANSCRIBE_API_KEY
-    )
-
     # content
-    encoded_audio = inputs["audio"][0]
-    binary_audio = base64.b64decode(encoded_audio)
+    upload_id = inputs.get("upload_id")
+    if upload_id:
+        # 分割アップロード(genie/upload/sessions)済みのチャンクを結合して保存し、文字起こし用に読み込む
+        try:
+            session = CHUNKED_UPLOAD_STORE.commit(upload_id, int(inputs["chunks"]), PURPOSE_WHISPER)
+            binary_audio = download_blob(file_name=session["blob_name"], container_name=session["container_name"])
+        except ChunkedUploadError as e:
+            return func.HttpResponse(json.dumps({"error": e.message}))
+        except Exception as e:
+            logging.critical(f"CANNOT UPLOAD FILE: {e}")
+            return func.HttpResponse(json.dumps({"error": f"CANNOT UPLOAD FILE: {e}"}))
+    else:
+        encoded_audio = inputs["audio"][0]
+        binary_audio = base64.b64decode(encoded_audio)
 
     try:
-        # BytesIOを使用して音声データをメモリ内ファイルとして扱う
-        with io.BytesIO(binary_audio) as audio_buffer:
-            audio_buffer.name = "audio.mp3"
-
-            # AOAI（transcribe）での非同期文字起こし実行
-            transcription = await client.audio.transcriptions.create(
-                file=audio_buffer,
-                model=GPT4O_TRANSCRIBE_DEPLOYMENT_NAME,
-                prompt=selected_transcribe_prompt,
-                temperature=whisper_options["values"].get("temperature", 0.0),
-                language=language_code,
-                response_format="json",
-            )
+        # AOAI（transcribe）での非同期文字起こし実行（共有のゲートウェイでレート制限内に順番待ちする）
+        transcription = await TRANSCRIPTION_GATEWAY.transcribe(
+            binary_audio,
+            file_name="audio.mp3",
+            prompt=selected_transcribe_prompt,
+            temperature=whisper_options["values"].get("temperature", 0.0),
+            language=language_code,
+            response_format="json",
+        )
 
         decoded_response = transcription
 
@@ -1642,12 +1798,13 @@ async def whisper(req: func.HttpRequest) -> func.HttpResponse:
 
         file_name = f"{upn}/{formatted_time}.mp3"
 
-        # upload blob
-        upload_blob(
-            file_name=file_name,
-            file_content=binary_audio,
-            container_name="audio-data"
-            )
+        # upload blob（分割アップロードの場合は保存済み）
+        if not upload_id:
+            upload_blob(
+                file_name=file_name,
+                file_content=binary_audio,
+                container_name="audio-data"
+                )
 
     # 文字起こしの結果の後処理
     text = decoded_response.text
@@ -1767,7 +1924,7 @@ async def ocr(req: func.HttpRequest) -> func.HttpResponse:
 # init #
 ########
     # 非同期http通信クライアントのインスタンス化
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     # apiの呼び出し
     history_base_url = os.environ.get("HISTORY_API_URL")
@@ -1891,7 +2048,7 @@ async def ocr_response(req: func.HttpRequest) -> func.HttpResponse:
 # init #
 ########
     # 非同期http通信クライアントのインスタンス化
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     # apiの呼び出し
     history_base_url = os.environ.get("HISTORY_API_URL")
@@ -1960,9 +2117,8 @@ async def ocr_response(req: func.HttpRequest) -> func.HttpResponse:
     _max_tokens = NON_CHAT_REGISTRY.models[model_name].max_tokens
     max_tokens = _max_tokens["input"] - _max_tokens["output"]
 
-    num_tokens = check_token(system_content+ocr_content)
-    logging.info(f"OCR_TOKENS: {num_tokens}")
-    if max_tokens < num_tokens:
+    logging.info(f"OCR_TOKENS(upper bound): {TOKEN_BUDGET.upper_bound(system_content+ocr_content)}")
+    if TOKEN_BUDGET.exceeds(system_content+ocr_content, max_tokens, model_name):
         return func.HttpResponse(json.dumps(error_response("ocrの文字数が多すぎます。")))
 
 ########
@@ -2023,11 +2179,10 @@ async def ocr_response(req: func.HttpRequest) -> func.HttpResponse:
 
     try:
         # Excelファイルの作成
-        wb = Workbook()
+        wb = WorkbookBuilder()
 
         # 1シート目: OCR結果
-        ws1 = wb.active
-        ws1.title = "OCR結果"
+        ws1 = wb.create_sheet("OCR結果", auto_width=False)
 
         for line in ocr_content.replace('<br>','\n').split('\n'):
             # テーブルのマークダウン記法を検出
@@ -2044,12 +2199,12 @@ async def ocr_response(req: func.HttpRequest) -> func.HttpResponse:
                 ws1.append([line])
 
         # 2シート目: LLMによる変換結果
-        ws2 = wb.create_sheet("プロンプトによる変換結果")
+        ws2 = wb.create_sheet("プロンプトによる変換結果", auto_width=False)
         for line in response_text.split('\n'):
             ws2.append([line])
 
         # 3シート目: LLMによるCSV出力結果
-        ws3 = wb.create_sheet("プロンプトによる変換結果(表形式)")
+        ws3 = wb.create_sheet("プロンプトによる変換結果(表形式)", auto_width=False)
 
         with io.StringIO(ocr_response["csv"]) as csv_data:
             csv_reader = csv.reader(csv_data)
@@ -2064,13 +2219,17 @@ async def ocr_response(req: func.HttpRequest) -> func.HttpResponse:
                         logging.warning(f"csv isdigit failure: {e}")
                     ws3.append(row)
 
-        with io.BytesIO() as excel_buffer:
-            wb.save(excel_buffer)
-            excel_buffer.seek(0)
-            excel_base64 = base64.b64encode(excel_buffer.read()).decode('utf-8')
-
-            # レスポンスにxlsxフィールドを追加
-            ocr_response["xlsx"] = excel_base64
+        # Excelファイルの生成はプロセスプールで行う
+        excel_data = await WORKBOOK_RENDERER.render(wb)
+
+        # レスポンスにxlsxフィールドを追加（"delivery": "blob"の場合はBlobに保存してblob名を返す）
+        delivery = req_json.get("delivery", DELIVERY_INLINE)
+        jst = ZoneInfo('Asia/Tokyo')
+        excel_file = await WORKBOOK_RENDERER.deliver(
+            excel_data, f"ocr_{datetime.now(jst).strftime('%Y%m%d%H%M%S')}.xlsx", upn, delivery)
+        ocr_response["xlsx"] = excel_file.get("data", "")
+        if "blob_name" in excel_file:
+            ocr_response["xlsx_blob_name"] = excel_file["blob_name"]
     except Exception as e:
         logging.critical(f"EXCEL_GENERATION: {e}")
         ocr_response["xlsx"] = ""
@@ -2155,7 +2314,7 @@ async def prompt_(req: func.HttpRequest) -> func.HttpResponse:
 # @app.route(route="genie/prompt/v2", methods=("GET", "POST"))
 async def prompt_v2(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('prompt v2 processed a request.')
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
     upn = req.params.get("upn")
     id_token = req.params.get("id_token")
     if not id_token:
@@ -2166,7 +2325,7 @@ async def prompt_v2(req: func.HttpRequest) -> func.HttpResponse:
 
     # id_tokenから認証情報を取得
     try:
-        keys = await EntraIDTokenManager.get_entra_openid_keys(async_http_client)
+        keys = await get_openid_keys(async_http_client, id_token)
         upn_from_token, mail, _ = decode_id_token(id_token, keys)
     except Exception as e:
         logging.warning(f"id_token処理エラー: {e}")
@@ -2208,22 +2367,25 @@ async def prompt_v2(req: func.HttpRequest) -> func.HttpResponse:
 
     # お気に入り
     favorite_list = []
-    if upn != None:
+    if upn != None and req.method == "GET":
+        # 先読み済みの場合はBlobへのアクセスを省略する
+        favorite_list = await SIGNIN_WARMUP.take("favorites", upn)
+        if favorite_list is None:
+            favorite_list = FavoritePromptManager(upn).get_favorite_list()
+    elif upn != None and req.method == "POST":
         prompt_manager = FavoritePromptManager(upn)
-        if req.method == "GET":
-            favorite_list = prompt_manager.get_favorite_list()
-        elif req.method == "POST":
-            prompt_id = req_json.get("prompt_id")
-            favorite = req_json.get("favorite", 0)
-            if prompt_id != None:
-                prompt_id = str(prompt_id)
-                if bool(favorite):
-                    logging.info(f"favorite: add {prompt_id}")
-                    prompt_manager.add_favorite(prompt_id)
-                else:
-                    logging.info(f"favorite: del {prompt_id}")
-                    prompt_manager.remove_favorite(prompt_id)
-            favorite_list = prompt_manager.get_favorite_list()
+        SIGNIN_WARMUP.invalidate("favorites", upn)
+        prompt_id = req_json.get("prompt_id")
+        favorite = req_json.get("favorite", 0)
+        if prompt_id != None:
+            prompt_id = str(prompt_id)
+            if bool(favorite):
+                logging.info(f"favorite: add {prompt_id}")
+                prompt_manager.add_favorite(prompt_id)
+            else:
+                logging.info(f"favorite: del {prompt_id}")
+                prompt_manager.remove_favorite(prompt_id)
+        favorite_list = prompt_manager.get_favorite_list()
 
     # query
     try:
@@ -2366,6 +2528,40 @@ async def send_merchant_rate(req: func.HttpRequest) -> func.HttpResponse:
         }
     return func.HttpResponse(json.dumps(response))
 
+
+@app.route(route="genie/health/clients", methods=("GET",))
+async def clients_health(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    共有クライアントの接続確認とプールの統計情報を返す
+    """
+    logging.info('clients_health processed a request.')
+    try:
+        health = await CLIENT_REGISTRY.health_check()
+        response = {
+            "status": 200 if health["healthy"] else 503,
+            "data": {
+                "health": health,
+                "stats": CLIENT_REGISTRY.stats(),
+                "openid_keys": OPENID_KEY_CACHE.stats(),
+                "file_text_cache": FILE_TEXT_CACHE.stats(),
+                "response_metrics": STREAM_METRICS.stats(),
+                "signin_warmup": SIGNIN_WARMUP.stats(),
+                "transcription": TRANSCRIPTION_GATEWAY.stats(),
+                "prompt_catalog": PROMPT_CATALOG.stats(),
+                "ocr_scheduler": OCR_LLM_SCHEDULER.stats(),
+                "workbook_renderer": WORKBOOK_RENDERER.stats(),
+                "token_budget": TOKEN_BUDGET.stats(),
+                "minutes": MINUTES_ENGINE.stats(),
+            }
+        }
+    except Exception as e:
+        logging.critical(f"clients health error: {e}")
+        response = {
+            "status": 500,
+            "error": str(e)
+        }
+    return func.HttpResponse(json.dumps(response), status_code=response["status"])
+
 @app.route(route="genie/top", methods=("GET",))
 async def send_top_page_content(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -2522,6 +2718,32 @@ async def send_top_page_content(req: func.HttpRequest) -> func.HttpResponse:
 
 
 
+###################
+# sign-in warm-up #
+###################
+
+async def _warmup_user_attributes(upn: str) -> list:
+    # 取得結果はUSER_ATTRIBUTE_CACHEにも保持される
+    return await asyncio.to_thread(UserDivisionFetchService().fetch_user_attributes, upn)
+
+
+async def _warmup_menu_permissions(upn: str) -> dict:
+    user_attributes = await SIGNIN_WARMUP.take("attributes", upn, keep=True)
+    if user_attributes is None:
+        user_attributes = await _warmup_user_attributes(upn)
+    menu_client = MenuPermissionService(cosmos_client=COSMOS_CLIENT)
+    return await asyncio.to_thread(menu_client.fetch_menu_permissions, user_attributes)
+
+
+async def _warmup_favorites(upn: str) -> list:
+    return await asyncio.to_thread(lambda: FavoritePromptManager(upn).get_favorite_list())
+
+
+SIGNIN_WARMUP.register("attributes", _warmup_user_attributes)
+SIGNIN_WARMUP.register("menu_permissions", _warmup_menu_permissions)
+SIGNIN_WARMUP.register("favorites", _warmup_favorites)
+
+
 @app.route(route="genie/auth/{mode}", methods=("GET",))
 async def check_user_authority(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -2572,11 +2794,21 @@ async def check_user_authority(req: func.HttpRequest) -> func.HttpResponse:
     upn = req.params.get("upn")
     logging.info(f"upn: {upn}")
 
-    # 所属情報の取得
-    client = UserDivisionFetchService()
-    user_attributes = client.fetch_user_attributes(upn)
+    # 所属情報の取得（先読み中の場合はその結果を待つ）
+    # キャッシュにない場合のDBアクセスはイベントループを塞がないようスレッドで実行
+    user_attributes = await SIGNIN_WARMUP.take("attributes", upn, keep=True)
+    if user_attributes is None:
+        client = UserDivisionFetchService()
+        user_attributes = await asyncio.to_thread(client.fetch_user_attributes, upn)
+        # 取得した所属情報はメニュー表示権限の先読みで使う
+        SIGNIN_WARMUP.put("attributes", upn, user_attributes)
     logging.info(f"user_attribute: {user_attributes}")
 
+    # サインイン直後の後続リクエスト（お気に入り・履歴など）の情報を先読みする
+    # このリクエストで取得する情報は先読みしない（開始直後の先読みをtake()で取り消して取得し直すことになるため）
+    skip = ("attributes", "menu_permissions") if mode == "menu" else ("attributes",)
+    SIGNIN_WARMUP.schedule(upn, skip=skip)
+
     response = {
         "status": 500,
         "error": f"invalid mode: {mode}"
@@ -2592,9 +2824,11 @@ async def check_user_authority(req: func.HttpRequest) -> func.HttpResponse:
 
     elif mode == "menu":
         try:
-            # メニュー表示権限の取得
-            menu_client = MenuPermissionService(cosmos_client=COSMOS_CLIENT)
-            permissions = menu_client.fetch_menu_permissions(user_attributes)
+            # メニュー表示権限の取得（先読み済みの場合はその結果を使う）
+            permissions = await SIGNIN_WARMUP.take("menu_permissions", upn, keep=True)
+            if permissions is None:
+                menu_client = MenuPermissionService(cosmos_client=COSMOS_CLIENT)
+                permissions = await asyncio.to_thread(menu_client.fetch_menu_permissions, user_attributes)
             logging.info(f"permissions: {permissions}")
 
             response = {
@@ -2622,7 +2856,7 @@ async def check_user_authority(req: func.HttpRequest) -> func.HttpResponse:
 async def decode_idtoken(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('decode_idtoken: Start.')
     # 非同期http通信クライアントのインスタンス化
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     # ip情報の取得
     client_ip = req.headers.get("x-forwarded-for")
@@ -2634,9 +2868,11 @@ async def decode_idtoken(req: func.HttpRequest) -> func.HttpResponse:
     # id_tokenのデコード
     if id_token:
         try:
-            keys = await EntraIDTokenManager.get_entra_openid_keys(async_http_client)
+            keys = await get_openid_keys(async_http_client, id_token)
             upn, mail, _ = decode_id_token(id_token, keys)
             logging.info("id_tokenのデコードに成功")
+            # サインイン直後のリクエストで使う情報を先読みする
+            SIGNIN_WARMUP.schedule(upn)
         except Exception as e:
             logging.warning("id_tokenのデコードに失敗: {e}")
             response = {"status": 200, "error": "id_tokenのデコードに失敗"}
@@ -7,10 +7,9 @@ import json
 import os
 import functools
 
-from utils.token import decode_id_token
-
-from i_style.aiohttp import AsyncHttpClient
-from i_style.token import EntraIDTokenManager
+from utils.token import decode_id_token, get_openid_keys
+from utils.clients import CLIENT_REGISTRY
+from utils.warmup import SIGNIN_WARMUP
 
 ##
 # blueprint
@@ -18,6 +17,20 @@ from i_style.token import EntraIDTokenManager
 history_bp = d_func.Blueprint()
 
 
+async def _warmup_genie_sessions(upn: str) -> dict:
+    """
+    サインイン時に履歴ペインのセッション一覧(genie)を先読みする
+    """
+    return await CLIENT_REGISTRY.http_client().get(
+        url=f"{os.environ.get('HISTORY_API_URL')}/api/history/genie/{upn}",
+        api_key=os.environ.get("HISTORY_API_KEY"),
+        process_name="get_history_summary"
+    )
+
+
+SIGNIN_WARMUP.register("history:genie", _warmup_genie_sessions)
+
+
 @history_bp.route(route="genie/session", methods=("GET",))
 async def history_create_session(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -120,7 +133,7 @@ def history_setup(func_handler):
     @functools.wraps(func_handler)
     async def wrapper(req: func.HttpRequest):
         # 初期化処理
-        async_http_client = AsyncHttpClient()
+        async_http_client = CLIENT_REGISTRY.http_client()
         history_base_url = os.environ.get("HISTORY_API_URL")
         history_api_key = os.environ.get("HISTORY_API_KEY")
 
@@ -145,7 +158,7 @@ def history_setup(func_handler):
         # IDトークンによる認証処理
         try:
             id_token = req.params.get("id_token")
-            keys = await EntraIDTokenManager.get_entra_openid_keys(async_http_client)
+            keys = await get_openid_keys(async_http_client, id_token)
             upn, _, _ = decode_id_token(id_token, keys)
 
             assert upn == req.route_params.get(
@@ -164,6 +177,10 @@ def history_setup(func_handler):
         if session_id != None:
             logging.info(f"session_id: {session_id}")
 
+        # 履歴を更新する場合は先読みしたセッション一覧を破棄する
+        if req.method != "GET":
+            SIGNIN_WARMUP.invalidate(f"history:{mode}", upn)
+
         # URL 生成
         url = f"{history_base_url}/api/history/{mode}/{upn}"
 
@@ -286,11 +303,14 @@ async def history_get_session(req: func.HttpRequest,
     logging.info("履歴の概要一覧を取得しています。")
 
     try:
-        history_summary_json = await async_http_client.get(
-            url=url,
-            api_key=history_api_key,
-            process_name=api_name
-        )
+        # サインイン時に先読みしている場合はその結果を使う
+        history_summary_json = await SIGNIN_WARMUP.take(f"history:{mode}", upn)
+        if history_summary_json is None:
+            history_summary_json = await async_http_client.get(
+                url=url,
+                api_key=history_api_key,
+                process_name=api_name
+            )
 
         response_data = [
             {
@@ -11,16 +11,20 @@ import asyncio
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import base64
-from openpyxl import Workbook, load_workbook
+from functools import partial
+from openpyxl import load_workbook
 from typing import Union, List, Dict, Any
 from abc import ABC, abstractmethod
 
 # 自作
 from config import NON_CHAT_REGISTRY, BLOB_SERVICE_CLIENT
-from util import check_token
 from prompt import coa_comparison_sub_prompt_list, prompt_shipping_doc_classify, ocr_prompt_list_shipping
 
 from i_style.llm import AzureOpenAI
+from utils.llm_scheduler import OCR_LLM_SCHEDULER
+from utils.token_budget import TOKEN_BUDGET
+from utils.workbook import WorkbookBuilder, SheetBuilder
+from utils.workbook.renderer import WORKBOOK_RENDERER, DELIVERY_INLINE
 
 # blob
 BLOB_CONNECTION_STRING = os.environ.get("BLOB_CONNECTION_STRING")
@@ -54,7 +58,8 @@ async def ocr_response2(req: func.HttpRequest) -> func.HttpResponse:
         "prompt": [{""id": "1", title": "L／C読取", "prompt": "<選択されたプロンプト>"}, ...],
         "ocr": [{"fileName": "<ファイル名>", "content": "<OCR結果>"}, ...],
         "ocr_mode": "<ocrのモード>", # "ocr" or "shipping_ocr" or "business_ocr"
-        "json_mode": true or false
+        "json_mode": true or false,
+        "delivery": "inline" or "blob" # 省略時はinline(base64)
     }
     ```
     """
@@ -72,16 +77,18 @@ async def ocr_response2(req: func.HttpRequest) -> func.HttpResponse:
         ocr_contents = req_json["ocr"]
         ocr_mode = req_json["ocr_mode"]
         business_pattern = req_json.get("business_pattern", "ocr_results")
+        # "blob"の場合はExcelをbase64で返さず、Blobに保存してblob名を返す（genie/blobでダウンロードする）
+        delivery = req_json.get("delivery", DELIVERY_INLINE)
 
         logging.info(f"upn: {upn}")
 
         # プロセッサーの選択
         if ocr_mode == "shipping_ocr":
-            processor = ShippingDocumentTextExtractor(upn)
+            processor = ShippingDocumentTextExtractor(upn, delivery)
         # elif ocr_mode == "comparison_ocr":
         #     processor = DocumentComparisonProcessor(upn)
         else:
-            processor = DocumentProcessor(business_pattern, upn)
+            processor = DocumentProcessor(business_pattern, upn, delivery)
 
         # 文書処理の実行
         excel_files = await processor.process(ocr_contents, system_contents)
@@ -290,7 +297,7 @@ class BaseDocumentProcessor(ABC):
     async def generate_response(self, content: str, system_prompt: str, model_name: str, json_mode: bool) -> Dict:
         """AOAIを呼び出し、回答を生成する。"""
         try:
-            if check_token(system_prompt + content) > max_tokens:
+            if TOKEN_BUDGET.exceeds(system_prompt + content, max_tokens, model_name):
                 return {"error_type": "token_error", "message": "トークン数が制限を超えています。"}
 
             response = await AzureOpenAI(
@@ -357,6 +364,23 @@ class BaseDocumentProcessor(ABC):
             logging.error(f"Error in upload: {traceback.format_exc()}")
             raise
 
+    async def deliver_excel_files(self, rendered_files: List[tuple]) -> List[Dict]:
+        """
+        生成したExcelファイル[(ファイル名, データ)]をBlob({upn}/{ファイル名})に保存し、レスポンス用の形式で返す。
+        delivery="blob"の場合は保存したBlobの参照を返す。（同じファイルを別の場所に再度アップロードしない）
+        """
+        async def deliver(file_name: str, excel_data: bytes) -> Dict:
+            blob_name = f"{self.upn}/{file_name}"
+
+            # Azure Blob Storageに保存
+            await self.upload_blob(blob_name, excel_data)
+
+            # Base64エンコード、または保存したBlobの参照
+            return await WORKBOOK_RENDERER.deliver(
+                excel_data, file_name, self.upn, self.delivery, blob_name=blob_name)
+
+        return await asyncio.gather(*(deliver(file_name, excel_data) for file_name, excel_data in rendered_files))
+
     def create_error_response(self, file_name, error_message):
         """エラーレスポンスを生成する。"""
         return {
@@ -430,19 +454,17 @@ class BaseDocumentProcessor(ABC):
 class ExcelService():
     """Excel生成サービスクラス"""
 
-    def create_workbook(self) -> Workbook:
-        """新しいワークブックを作成する。"""
-        wb = Workbook()
-        wb.remove(wb.active)
-        return wb
+    def create_workbook(self) -> WorkbookBuilder:
+        """新しいワークブックを作成する。（書き出しはWORKBOOK_RENDERER.renderで行う）"""
+        return WorkbookBuilder()
 
-    def create_unique_sheet(self, wb: Workbook, base_name: str) -> tuple[Workbook, str]:
+    def create_unique_sheet(self, wb: WorkbookBuilder, base_name: str) -> tuple[WorkbookBuilder, str]:
         """ユニークなシート名でシートを作成する。"""
         sheet_name = self._get_unique_sheet_name(wb, base_name)
         wb.create_sheet(title=sheet_name)
         return wb, sheet_name
 
-    def _get_unique_sheet_name(self, wb: Workbook, base_name: str) -> str:
+    def _get_unique_sheet_name(self, wb: WorkbookBuilder, base_name: str) -> str:
         """ユニークなシート名を生成する。"""
         sheet_name = base_name
         counter = 1
@@ -469,8 +491,8 @@ class ExcelService():
 
         return sanitized_title
 
-    def write_to_sheet(self, ws: Workbook, data: Any) -> Workbook:
-        """データをシートに書き込む。"""
+    def write_to_sheet(self, ws: SheetBuilder, data: Any) -> SheetBuilder:
+        """データをシートに書き込む。（列幅は行の追加時に内容に合わせて求める）"""
         if isinstance(data, str):
             # 文字列データの場合
             for line in data.replace('<br>', '\n').split('\n'):
@@ -498,6 +520,8 @@ class ExcelService():
             # データ型の検証
             if not all(isinstance(item, dict) for item in data):
                 ws.append([str(data)])
+                # 列幅は調整しない
+                ws.auto_width = False
                 return ws
 
             # ヘッダーの収集、ヘッダー行の追加（入れ子になった辞書のフィールドも含める）
@@ -556,7 +580,7 @@ class ExcelService():
                         row_data.append(value)
                     ws.append(row_data)
 
-        return self._adjust_column_width(ws)
+        return ws
 
     def safe_cell_conversion(self, value: Any) -> Any:
         """安全なセルに変換する。"""
@@ -564,33 +588,6 @@ class ExcelService():
             return value[:32767]
         return value
 
-    def _adjust_column_width(self, ws):
-        """
-        ワークシートの列幅を内容に合わせて自動調整する。
-        """
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-
-            # その列の全セルをチェック
-            for cell in column:
-                try:
-                    # セルの値を文字列として取得
-                    cell_value = str(
-                        cell.value) if cell.value is not None else ""
-                    # 現在の最大長と比較
-                    max_length = max(max_length, len(cell_value))
-                except Exception as e:
-                    logging.warning(
-                        f"Error processing cell {cell.coordinate}: {str(e)}")
-                    continue
-
-            # 最小幅と最大幅の制限を設定
-            adjusted_width = min(max(max_length + 2, 8), 50)  # 最小8文字、最大50文字
-
-            # 列幅を設定
-            ws.column_dimensions[column_letter].width = adjusted_width
-
     # def _write_formatted_data_to_new_sheets(self, wb: Workbook, data: Union[List[Dict[str, Any]], Dict[str, Any]]) -> None:
     #     """
     #     比較元ファイルと比較先ファイルのデータを項目ごと対応させたデータをファイルごとシートに出力する。
@@ -682,130 +679,79 @@ class DocumentProcessor(BaseDocumentProcessor):
     業務パターンが「船積書類文字起こし」、「複数ファイル突合」以外の場合に使用する。
     """
 
-    def __init__(self, business_pattern: str = "ocr_results", upn: str = "unknown"):
+    def __init__(self, business_pattern: str = "ocr_results", upn: str = "unknown", delivery: str = DELIVERY_INLINE):
         self.upn = upn
         self.business_pattern = business_pattern
+        self.delivery = delivery
 
     async def process(self, ocr_contents, system_prompts):
         """
         OCRで読み取った書類のテキストから、情報を抽出し、Excelファイルに出力する。
+        ファイルごとのAOAIの処理が終わり次第、次のファイルの処理と並行してExcelファイルを生成する。
+        Blobへの保存は、すべてのファイルのExcelファイルの生成が終わった後に行う。（途中で失敗した場合は保存しない）
         """
         try:
-            # AOAIでテキストを分析し、構造化された情報を抽出する
-            all_results = await self._analyze_ocr_contents_with_aoai(ocr_contents, system_prompts)
-
-            excel_service = ExcelService()
-            excel_files = []
-
-            # 各OCRコンテンツに対して個別のExcelファイルを生成
-            for idx, ocr_content in enumerate(ocr_contents):
-                # 新しいワークブックを作成
-                wb = excel_service.create_workbook()
-
-                # OCR結果シートの作成
-                wb, sheet_name = excel_service.create_unique_sheet(
-                    wb, ocr_content["fileName"][:31])
-                ws = wb[sheet_name]
-                excel_service.write_to_sheet(ws, ocr_content["content"])
-
-                # このファイルに関連する処理結果シートの作成
-                document_results = all_results["documents"][idx]
-                for result_item in document_results["results"]:
-                    wb, sheet_name = excel_service.create_unique_sheet(
-                        wb, result_item["title"])
-                    ws = wb[sheet_name]
-                    excel_service.write_to_sheet(ws, result_item["result"])
-
-                # プロンプトシートの作成
-                for prompt in all_results["prompts"]:
-                    wb, sheet_name = excel_service.create_unique_sheet(
-                        wb, f"{prompt['title']}指示文")
-                    ws = wb[sheet_name]
-                    excel_service.write_to_sheet(ws, prompt["prompt"])
-
-                # Excelファイルを一時的にメモリに保存
-                with io.BytesIO() as excel_stream:
-                    wb.save(excel_stream)
-                    excel_stream.seek(0)
-                    excel_data = excel_stream.getvalue()
-
-                # ファイル名の生成
-                jst = ZoneInfo('Asia/Tokyo')
-                timestamp = datetime.now(jst).strftime("%Y%m%d%H%M%S")
-                file_name = f"{self.business_pattern}_{ocr_content['fileName']}_{timestamp}.xlsx"
-                blob_name = f"{self.upn}/{file_name}"
-
-                # Azure Blob Storageに保存
-                await self.upload_blob(blob_name, excel_data)
-
-                # Base64エンコード
-                excel_base64 = base64.b64encode(excel_data).decode('utf-8')
-
-                # 結果をリストに追加
-                excel_files.append({
-                    "fileName": file_name,
-                    "data": excel_base64
-                })
-
-            return excel_files
+            # 全ファイル×全プロンプトの処理を1つの待ち行列で実行
+            groups = [
+                [
+                    (model_gpt4_1_mini, partial(
+                        self._process_single_prompt,
+                        ocr_content["content"], prompt_config, model_gpt4_1_mini, json_mode=True))
+                    for prompt_config in system_prompts
+                ]
+                for ocr_content in ocr_contents
+            ]
+            rendered_files = await OCR_LLM_SCHEDULER.run_groups(
+                groups,
+                partial(self._create_excel_file, ocr_contents, system_prompts),
+                name=f"ocr:{self.business_pattern}"
+            )
+            return await self.deliver_excel_files(rendered_files)
 
         except Exception as e:
             logging.error(
                 f"Error in DocumentProcessor.process: {traceback.format_exc()}")
             raise
 
-    async def _analyze_ocr_contents_with_aoai(self, ocr_contents: List[Dict], system_prompts: List[Dict]) -> Dict[str, Any]:
+    async def _create_excel_file(self, ocr_contents: List[Dict], system_prompts: List[Dict], idx: int, content_results: List[Any]) -> tuple:
         """
-        OCR結果をAOAIで分析し、構造化された情報を抽出し、プロンプトと共に返す。
-
-        Returns:
-            Dict[str, Any]: {
-                "documents": [  # 全てのOCR contentsの結果
-                    {
-                        "filename": "ファイル1.pdf",
-                        "results": [
-                            {
-                                "title": "プロンプト1のタイトル_ファイル1.pdf",
-                                "result": "プロンプト1の結果"
-                            },
-                            {
-                                "title": "プロンプト2のタイトル_ファイル1.pdf",
-                                "result": "プロンプト2の結果"
-                            }
-                        ]
-                    },
-                    ...
-                ],
-                "prompts": List[Dict] # システムプロンプトのリスト(全てのファイルに対して共通のプロンプトを使用するため"documents"とは別に格納)
-            }
+        1ファイル分のAOAIの結果からExcelファイルを生成し、(ファイル名, データ)を返す。
         """
-        all_results = []
-        for ocr_content in ocr_contents:
-            # 各プロンプトの処理を並列実行
-            tasks = [
-                self._process_single_prompt(
-                    ocr_content["content"], prompt_config, model_gpt4_1_mini, json_mode=True)
-                for prompt_config in system_prompts
-            ]
-            content_results = await asyncio.gather(*tasks)
+        ocr_content = ocr_contents[idx]
+        excel_service = ExcelService()
 
-            # 結果とタイトルをペアにする
-            results_with_titles = [
-                {
-                    "title": f"{prompt['title']}_{ocr_content['fileName']}",
-                    "result": result
-                }
-                for prompt, result in zip(system_prompts, content_results)
-            ]
-            all_results.append({
-                "filename": ocr_content["fileName"],
-                "results": results_with_titles
-            })
+        # 新しいワークブックを作成
+        wb = excel_service.create_workbook()
 
-        return {
-            "documents": all_results,
-            "prompts": system_prompts
-        }
+        # OCR結果シートの作成
+        wb, sheet_name = excel_service.create_unique_sheet(
+            wb, ocr_content["fileName"][:31])
+        ws = wb[sheet_name]
+        excel_service.write_to_sheet(ws, ocr_content["content"])
+
+        # このファイルに関連する処理結果シートの作成
+        for prompt, result in zip(system_prompts, content_results):
+            wb, sheet_name = excel_service.create_unique_sheet(
+                wb, f"{prompt['title']}_{ocr_content['fileName']}")
+            ws = wb[sheet_name]
+            excel_service.write_to_sheet(ws, result)
+
+        # プロンプトシートの作成
+        for prompt in system_prompts:
+            wb, sheet_name = excel_service.create_unique_sheet(
+                wb, f"{prompt['title']}指示文")
+            ws = wb[sheet_name]
+            excel_service.write_to_sheet(ws, prompt["prompt"])
+
+        # Excelファイルの生成（プロセスプールで実行）
+        excel_data = await WORKBOOK_RENDERER.render(wb)
+
+        # ファイル名の生成
+        jst = ZoneInfo('Asia/Tokyo')
+        timestamp = datetime.now(jst).strftime("%Y%m%d%H%M%S")
+        file_name = f"{self.business_pattern}_{ocr_content['fileName']}_{timestamp}.xlsx"
+
+        return file_name, excel_data
 
 
 class ShippingDocumentTextExtractor(BaseDocumentProcessor):
@@ -816,8 +762,9 @@ class ShippingDocumentTextExtractor(BaseDocumentProcessor):
     L/C、B/L、Invoice、P/L、COO、COA、COQの情報を抽出し、Excelファイルに出力する。
     """
 
-    def __init__(self, upn: str = "unknown"):
+    def __init__(self, upn: str = "unknown", delivery: str = DELIVERY_INLINE):
         self.upn = upn
+        self.delivery = delivery
         self.key_mappings = {
             "PO": ["PO", "P/O", "Purchase Order", "PURCHASE ORDER"],
             "LC": ["L/C", "L／C", "LC"],
@@ -830,10 +777,15 @@ class ShippingDocumentTextExtractor(BaseDocumentProcessor):
         }
 
     async def process(self, ocr_contents: List[Dict], system_prompts: List[Dict]) -> Dict:
-        """船積書類のOCR結果を判別結果を元にページ分割し、種別ごとに処理する。"""
+        """
+        船積書類のOCR結果を判別結果を元にページ分割し、種別ごとに処理する。
+        ファイルごとのAOAIの処理が終わり次第、次のファイルの処理と並行してExcelファイルを生成する。
+        Blobへの保存は、すべてのファイルのExcelファイルの生成が終わった後に行う。（途中で失敗した場合は保存しない）
+        """
         try:
-            excel_files = []
-
+            # 全ファイルの帳票ごとの処理を準備し、1つの待ち行列で実行する
+            groups = []
+            file_prompts = []
             for ocr_content in ocr_contents:
                 # OCRテキストをページ単位に分割
                 document_pages = self._split_content_by_pages(
@@ -853,9 +805,8 @@ class ShippingDocumentTextExtractor(BaseDocumentProcessor):
                             "prompt": prompt_config
                         })
 
+                jobs = []
                 prompts = []
-                all_results = []
-                task_prompt_pairs = []
                 for item in document_page_mappings:
                     target_pages = item.get("contents_page")
                     prompt = item.get("prompt")
@@ -868,91 +819,72 @@ class ShippingDocumentTextExtractor(BaseDocumentProcessor):
                             document_pages[page_num])  # 対象ページの内容を追加
                     combined_page_content = "\n".join(page_contents)
 
-                    task = self._process_single_prompt(
+                    jobs.append((model_gpt4_1_mini, partial(
+                        self._process_single_prompt,
                         combined_page_content,
                         prompt,
                         model_gpt4_1_mini,
                         json_mode=True
-                    )
-                    task_prompt_pairs.append((task, prompt))
-
-                # タスクとプロンプトのペアを維持
-                tasks = [pair[0] for pair in task_prompt_pairs]
-                prompts = [pair[1] for pair in task_prompt_pairs]
-
-                # 全てのタスクを並列実行
-                content_results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                # 結果とタイトルをペアにする
-                results_with_titles = [
-                    {
-                        "title": prompt['title'],
-                        "result": result
-                    }
-                    for prompt, result in zip(prompts, content_results)
-                ]
-                all_results.append({
-                    "filename": ocr_content["fileName"],
-                    "results": results_with_titles
-                })
-
-                excel_service = ExcelService()
-
-                # 新しいワークブックを作成
-                wb = excel_service.create_workbook()
-
-                # OCR結果シートの作成
-                wb, sheet_name = excel_service.create_unique_sheet(
-                    wb, "全文字起こし")
-                ws = wb[sheet_name]
-                excel_service.write_to_sheet(ws, ocr_content["content"])
-
-                # このファイルに関連する処理結果シートの作成
-                for result_item in all_results:
-                    for result in result_item["results"]:
-                        wb, sheet_name = excel_service.create_unique_sheet(
-                            wb, result["title"])
-                        ws = wb[sheet_name]
-                        excel_service.write_to_sheet(ws, result["result"])
-
-                # プロンプトシートの作成
-                for prompt in prompts:
-                    wb, sheet_name = excel_service.create_unique_sheet(
-                        wb, f"{prompt['title']}指示文")
-                    ws = wb[sheet_name]
-                    excel_service.write_to_sheet(ws, prompt["prompt"])
-
-                # Excelファイルを一時的にメモリに保存
-                with io.BytesIO() as excel_stream:
-                    wb.save(excel_stream)
-                    excel_stream.seek(0)
-                    excel_data = excel_stream.getvalue()
-
-                # ファイル名の生成
-                jst = ZoneInfo('Asia/Tokyo')
-                timestamp = datetime.now(jst).strftime("%Y%m%d%H%M%S")
-                file_name = f"{ocr_content['fileName']}_{timestamp}.xlsx"
-                blob_name = f"{self.upn}/{file_name}"
-
-                # Azure Blob Storageに保存
-                await self.upload_blob(blob_name, excel_data)
-
-                # Base64エンコード
-                excel_base64 = base64.b64encode(excel_data).decode('utf-8')
-
-                # 結果をリストに追加
-                excel_files.append({
-                    "fileName": file_name,
-                    "data": excel_base64
-                })
-
-            return excel_files
+                    )))
+                    prompts.append(prompt)
+                groups.append(jobs)
+                file_prompts.append(prompts)
+
+            # 全てのタスクを並列実行（結果は登録した順番）
+            rendered_files = await OCR_LLM_SCHEDULER.run_groups(
+                groups,
+                partial(self._create_excel_file, ocr_contents, file_prompts),
+                name="shipping_ocr",
+                return_exceptions=True
+            )
+            return await self.deliver_excel_files(rendered_files)
 
         except Exception as e:
             logging.error(
                 f"Error in ShippingDocumentClassifier.process: {traceback.format_exc()}")
             raise
 
+    async def _create_excel_file(self, ocr_contents: List[Dict], file_prompts: List[List[Dict]], idx: int, content_results: List[Any]) -> tuple:
+        """
+        1ファイル分のAOAIの結果からExcelファイルを生成し、(ファイル名, データ)を返す。
+        """
+        ocr_content = ocr_contents[idx]
+        prompts = file_prompts[idx]
+        excel_service = ExcelService()
+
+        # 新しいワークブックを作成
+        wb = excel_service.create_workbook()
+
+        # OCR結果シートの作成
+        wb, sheet_name = excel_service.create_unique_sheet(
+            wb, "全文字起こし")
+        ws = wb[sheet_name]
+        excel_service.write_to_sheet(ws, ocr_content["content"])
+
+        # このファイルに関連する処理結果シートの作成
+        for prompt, result in zip(prompts, content_results):
+            wb, sheet_name = excel_service.create_unique_sheet(
+                wb, prompt['title'])
+            ws = wb[sheet_name]
+            excel_service.write_to_sheet(ws, result)
+
+        # プロンプトシートの作成
+        for prompt in prompts:
+            wb, sheet_name = excel_service.create_unique_sheet(
+                wb, f"{prompt['title']}指示文")
+            ws = wb[sheet_name]
+            excel_service.write_to_sheet(ws, prompt["prompt"])
+
+        # Excelファイルの生成（プロセスプールで実行）
+        excel_data = await WORKBOOK_RENDERER.render(wb)
+
+        # ファイル名の生成
+        jst = ZoneInfo('Asia/Tokyo')
+        timestamp = datetime.now(jst).strftime("%Y%m%d%H%M%S")
+        file_name = f"{ocr_content['fileName']}_{timestamp}.xlsx"
+
+        return file_name, excel_data
+
     def _map_to_standard_key(self, input_key: str) -> str:
         """入力されたキーを標準化された形式に変換する
 
@@ -1094,20 +1026,22 @@ class ShippingDocumentTypeIdentifier(BaseDocumentProcessor):
             List[Dict]: 各書類の分類結果
         """
         try:
-            tasks = []
+            jobs = []
             for ocr_content in ocr_contents:
                 for prompt_config in system_prompts:
-                    tasks.append(
-                        self._process_single_prompt(
+                    jobs.append((
+                        model_o4_mini,
+                        partial(
+                            self._process_single_prompt,
                             content=ocr_content["content"],
                             prompt_config=prompt_config,
                             model_name=model_o4_mini,
                             json_mode=self.json_mode
                         )
-                    )
+                    ))
 
-            # 全てのタスクを並列実行
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+            # 全てのタスクをモデルの同時実行数の上限内で並列実行
+            results = await OCR_LLM_SCHEDULER.run(jobs, name="classify_documents", return_exceptions=True)
 
             return results
 
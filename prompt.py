@@ -3,19 +3,13 @@ import logging
 import urllib.request
 import urllib.parse
 import json
-import os
-import re
-import random
-from copy import deepcopy
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-import pandas as pd
 from pydantic import BaseModel, Field
 
-from azure.storage.blob import BlobServiceClient
-
-from util import BLOB_CONNECTION_STRING
+from utils.clients import CLIENT_REGISTRY
+from utils.prompt_catalog import PROMPT_CATALOG
 
 ############
 # settings #
@@ -1629,167 +1623,13 @@ def query_prompt(query: str = "", lang: str = "ja") -> dict:
 def process_prompt(query: str = "", favorite_list: list = []):
     """
     プロンプト処理
+    プロンプト集の読み込み・索引の作成はPROMPT_CATALOGで1回のみ行い、リクエストごとには検索とお気に入りの付与のみを行う
 
     Args:
         query: 検索クエリ
         favorite_list: お気に入りリスト
     """
-
-    favorite_set = set(favorite_list)
-
-    def safe_int(value, default=1000):
-        """値を安全に整数に変換する"""
-        if value is None or value == '':
-            return default
-        try:
-            return int(value)
-        except (ValueError, TypeError):
-            return default
-
-    def load_prompts_from_file(file_path: str):
-        """Excelからプロンプトを読み込み、プロンプトのリストを返す"""
-        try:
-            # ヘッダーは2行目を使用する（Excel上で2行目が列名）
-            df = pd.read_excel(file_path, header=1)
-        except Exception as e:
-            logging.warning(f"prompt load failed: {file_path}, error: {e}")
-            return None
-
-        if df is None or df.empty:
-            return None
-
-        # 列名の正規化
-        rename_map = {}
-        for col in df.columns:
-            col_str = str(col).strip()
-            lower = col_str.lower()
-            if col_str in {"#", "＃"} or lower in {"no", "id"}:
-                rename_map[col] = "id"
-            elif "title" in lower:
-                rename_map[col] = "title"
-            elif "prompt" in lower:
-                rename_map[col] = "prompt"
-
-        df = df.rename(columns=rename_map)
-
-        # 必須列の確認
-        required_columns = {"title", "prompt"}
-        if not required_columns.issubset(set(df.columns)):
-            logging.warning(f"prompt load skipped: {file_path}, missing columns: {required_columns - set(df.columns)}")
-            return None
-
-        prompt_list = []
-        for idx, (_, row) in enumerate(df.iterrows(), start=1):
-            raw_title = row.get("title")
-            raw_prompt = row.get("prompt")
-
-            # NaN/None/空白はスキップ
-            if pd.isna(raw_title) or pd.isna(raw_prompt):
-                continue
-
-            title = str(raw_title).strip()
-            prompt_text = str(raw_prompt).strip()
-
-            # タイトルまたはプロンプトが空の行はスキップ
-            if not title or not prompt_text:
-                continue
-
-            # サンプル行（"(例)"を含むタイトル）はスキップ
-            if "(例)" in title:
-                continue
-
-            prompt_id = safe_int(row.get("id"), default=idx)
-
-            prompt_list.append({
-                "id": prompt_id,
-                "title": title,
-                "prompt": prompt_text,
-            })
-
-        if not prompt_list:
-            return None
-
-        return prompt_list
-
-    def search_keyword(result_list: list, query: str = ""):
-        filtered_response = []
-
-        for category_data in result_list:
-            filtered_prompt_list = [
-                prompt_data for prompt_data in category_data["prompt_list"]
-                if query in prompt_data["title"] or query in prompt_data["prompt"]
-            ]
-
-            if filtered_prompt_list:
-                filtered_response.append({
-                    "category": category_data["category"],
-                    "prompt_list": filtered_prompt_list
-                })
-
-        return filtered_response
-
-    # 対象ディレクトリ
-    prompt_dir = "data/プロンプト集"
-
-    result_list = []
-
-    try:
-        file_names = [f for f in os.listdir(prompt_dir) if f.endswith(".xlsx") and not f.startswith("~$")]
-    except FileNotFoundError:
-        logging.warning(f"prompt directory not found: {prompt_dir}")
-        file_names = []
-
-    def parse_category_name(file_name: str) -> str:
-        base_name, _ = os.path.splitext(file_name)
-        base_name = base_name.strip()
-        match = re.search(r"【([^】]+)】", base_name)
-        if match:
-            label = match.group(1).strip()
-            return label
-        return base_name
-
-    for file_name in file_names:
-        file_path = os.path.join(prompt_dir, file_name)
-        category_name = parse_category_name(file_name)
-
-        prompt_list = load_prompts_from_file(file_path)
-        if prompt_list:
-            adjusted_list = []
-            for prompt in prompt_list:
-                raw_id = prompt.get("id")
-                composite_id = f"{category_name}_{raw_id}"
-
-                favorite_flag = 1 if composite_id in favorite_set else 0
-
-                adjusted_prompt = {
-                    **prompt,
-                    "id": composite_id,
-                    "favorite": favorite_flag
-                }
-                adjusted_list.append(adjusted_prompt)
-
-            result_list.append({
-                "category": category_name,
-                "prompt_list": adjusted_list
-            })
-
-    # 並び順の優先度を指定
-    order_labels = ["全社", "繊維", "金属", "食料", "機械", "エネ化", "住生活", "情金", "第8"]
-    order_priority = {label: idx for idx, label in enumerate(order_labels)}
-
-    result_list.sort(key=lambda item: order_priority.get(item.get("category", ""), len(order_priority)))
-
-    # 並べ替え後にカテゴリ名へサフィックスを付与（全社以外）
-    for item in result_list:
-        base = item.get("category", "")
-        if base and base != "全社":
-            item["category"] = f"{base}Co"
-
-    if query in ("", " ", "　"):
-        return result_list
-
-    search_result = search_keyword(result_list, query)
-    return search_result
+    return PROMPT_CATALOG.search(query, favorite_list)
 
 # PROMPT_LIST_JA = extract_prompts("./data/プロンプト集_新UI用.xlsx")
 
@@ -1800,22 +1640,7 @@ def choice_prompt(k: int = 4) -> list:
     全社カテゴリからランダムに固定数(k=4)個のプロンプトを抽出する
     各プロンプトにカテゴリを付与する
     """
-    _list = deepcopy(process_prompt(query=""))
-
-    prompt_list = []
-    for category_dict in _list:
-        category = category_dict["category"]
-        if category != "全社":
-            continue
-        for _prompt in category_dict["prompt_list"]:
-            _prompt["category"] = category
-            prompt_list.append(_prompt)
-
-    if len(prompt_list) <= k:
-        return prompt_list
-
-    # promptの選択
-    return random.sample(prompt_list, k)
+    return PROMPT_CATALOG.sample("全社", k)
 
 
 prompt_json_ja = {
@@ -2893,24 +2718,12 @@ class FavoritePromptManager:
 
     def _set_up_blob(self):
         """Blobクライアントをセットアップする"""
-        blob_service_client = BlobServiceClient.from_connection_string(
-            BLOB_CONNECTION_STRING)
-        container_client = blob_service_client.get_container_client(
-            container=PROMPT_CONTAINER_NAME)
-
-        # コンテナが存在しない場合は作成(作成競合時は無視)
-        if not container_client.exists():
-            try:
-                container_client.create_container()
-            except Exception as e:
-                logging.debug(
-                    f"Container already exists or error creating container: {e}")
+        # 共有のコンテナクライアントを取得(コンテナが存在しない場合は作成)
+        container_client = CLIENT_REGISTRY.blob_container(
+            PROMPT_CONTAINER_NAME, create=True)
 
         # 指定Blobへのクライアントを取得
-        blob_client = blob_service_client.get_blob_client(
-            container=PROMPT_CONTAINER_NAME,
-            blob=self.blob_name
-        )
+        blob_client = container_client.get_blob_client(self.blob_name)
         return blob_client
 
     def _check_blob_exist(self):
@@ -3205,6 +3018,16 @@ class LinkList(BaseModel):
 MINUTES_SYSTEM_CONTENT = """本日の日付は{formatted_date}です。
 以下の会議文字起こしを議事録にしてください。ただし、出席者についてまとめる必要はありません。"""
 
+MINUTES_REFINE_PREFIX = "残りの会話ログです。先程の議事録を踏まえてあらためて完成版の議事録を作成してください。\n"
+
+MINUTES_MAP_SYSTEM_CONTENT = """本日の日付は{formatted_date}です。
+以下は会議文字起こしを分割した一部です（{{index}}/{{total}}）。この部分の議事録を作成してください。ただし、出席者についてまとめる必要はありません。
+後で他の部分の議事録と統合するため、決定事項・課題・担当者・期限・数値・固有名詞は省略しないでください。"""
+
+MINUTES_REDUCE_SYSTEM_CONTENT = """本日の日付は{formatted_date}です。
+以下は1つの会議の文字起こしを分割して作成した議事録です（会議の進行順に並んでいます）。
+重複を整理して、会議全体の完成版の議事録を1つ作成してください。ただし、出席者についてまとめる必要はありません。"""
+
 TRANSLATION_SYSTEM_CONTENT = """以下の文を{language}に翻訳します。
 *****
 「{user_input}」
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# リポジトリのルート(function_app.pyのあるディレクトリ)をimportのパスに追加する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
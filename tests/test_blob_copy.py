@@ -0,0 +1,173 @@
+"""
+utils.blob_copy のテスト
+- コピー・移動でBLOBのデータを関数のメモリに読み込まないこと（ピークのメモリ使用量が音声のサイズに依存しないこと）
+- メタデータの引き継ぎ、pendingの間の待機、タイムアウト時のabort
+BLOBはサーバー側を模したコンテナ（データはテストの開始前に確保する）で置き換える
+"""
+import gc
+import itertools
+import tracemalloc
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("azure.core")
+
+from utils import blob_copy  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class FakeBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+        self.url = f"https://account.blob.core.windows.net/audio/{name}"
+
+    def get_blob_properties(self):
+        blob = self.container.blobs[self.name]
+        status = None
+        if self.name in self.container.copying:
+            status = self.container.statuses.pop(0) if self.container.statuses else "success"
+        return SimpleNamespace(metadata=dict(blob["metadata"]), copy=SimpleNamespace(status=status))
+
+    def start_copy_from_url(self, source_url, metadata=None, etag=None, match_condition=None):
+        if etag == "*" and self.name in self.container.blobs:
+            raise FileExistsError(self.name)
+        source_name = source_url.rsplit("/audio/", 1)[1]
+        # サーバー側のコピー（同じバッファを参照し、クライアント側では確保しない）
+        self.container.blobs[self.name] = {
+            "data": self.container.blobs[source_name]["data"],
+            "metadata": dict(metadata or {}),
+        }
+        self.container.copying.add(self.name)
+        status = self.container.statuses.pop(0) if self.container.statuses else "success"
+        return {"copy_status": status, "copy_id": "copy-1"}
+
+    def abort_copy(self, copy_id):
+        self.container.aborted.append(copy_id)
+
+    def delete_blob(self):
+        del self.container.blobs[self.name]
+
+    def download_blob(self):
+        data = self.container.blobs[self.name]["data"]
+        return SimpleNamespace(readall=lambda: bytes(data))
+
+    def upload_blob(self, data, overwrite=False, metadata=None):
+        self.container.blobs[self.name] = {"data": bytearray(data), "metadata": dict(metadata or {})}
+
+
+class FakeContainerClient:
+    def __init__(self, statuses=()):
+        self.blobs = {}
+        self.statuses = list(statuses)
+        self.aborted = []
+        self.copying = set()
+
+    def get_blob_client(self, name):
+        return FakeBlobClient(self, name)
+
+
+def download_and_upload(container_client, source_blob_name, destination_blob_name):
+    """
+    変更前の移動（download_blob().readall()で読み込み、アップロードし直す）
+    """
+    source_blob_client = container_client.get_blob_client(source_blob_name)
+    data = source_blob_client.download_blob().readall()
+    metadata = source_blob_client.get_blob_properties().metadata
+    container_client.get_blob_client(destination_blob_name).upload_blob(data, metadata=metadata)
+    source_blob_client.delete_blob()
+    return metadata
+
+
+def peak_bytes(move, size):
+    container_client = FakeContainerClient()
+    container_client.blobs["audio_for_monitor/a.wav"] = {
+        "data": bytearray(size), "metadata": {"status": "done"}}
+    gc.collect()
+    tracemalloc.start()
+    try:
+        move(container_client, "audio_for_monitor/a.wav", "audio_tmp/a.wav")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert "audio_tmp/a.wav" in container_client.blobs
+    assert "audio_for_monitor/a.wav" not in container_client.blobs
+    return peak
+
+
+def test_peak_memory_does_not_depend_on_audio_size():
+    small = peak_bytes(blob_copy.move_blob, 1 * MB)
+    large = peak_bytes(blob_copy.move_blob, 64 * MB)
+    assert large < 1 * MB
+    assert abs(large - small) < 256 * 1024
+
+
+def test_peak_memory_of_download_and_upload_grows_with_audio_size():
+    # 測定方法の確認: 読み込んでアップロードし直す場合はサイズ分のメモリを使う
+    assert peak_bytes(download_and_upload, 64 * MB) > 64 * MB
+
+
+def test_move_keeps_metadata_and_deletes_source():
+    container_client = FakeContainerClient()
+    container_client.blobs["src"] = {"data": bytearray(b"abc"), "metadata": {"status": "done", "upn": "a@b"}}
+
+    metadata = blob_copy.move_blob(container_client, "src", "dst")
+
+    assert metadata == {"status": "done", "upn": "a@b"}
+    assert container_client.blobs == {"dst": {"data": bytearray(b"abc"), "metadata": metadata}}
+
+
+def test_copy_with_metadata_keeps_source():
+    container_client = FakeContainerClient()
+    container_client.blobs["src"] = {"data": bytearray(b"abc"), "metadata": {"status": "done"}}
+
+    blob_copy.copy_blob(container_client, "src", "dst", metadata={"status": "terminated"})
+
+    assert container_client.blobs["src"]["metadata"] == {"status": "done"}
+    assert container_client.blobs["dst"]["metadata"] == {"status": "terminated"}
+
+
+def test_copy_does_not_overwrite_destination():
+    container_client = FakeContainerClient()
+    container_client.blobs["src"] = {"data": bytearray(b"abc"), "metadata": {}}
+    container_client.blobs["dst"] = {"data": bytearray(b"old"), "metadata": {}}
+
+    with pytest.raises(FileExistsError):
+        blob_copy.move_blob(container_client, "src", "dst")
+    assert "src" in container_client.blobs
+
+
+def test_copy_waits_while_pending(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(blob_copy.time, "sleep", sleeps.append)
+    # 開始時・1回目の確認はpending、2回目の確認で完了
+    container_client = FakeContainerClient(statuses=["pending", "pending", "success"])
+    container_client.blobs["src"] = {"data": bytearray(b"abc"), "metadata": {}}
+
+    blob_copy.copy_blob(container_client, "src", "dst", poll_interval=0.5)
+
+    assert sleeps == [0.5, 0.5]
+
+
+def test_copy_aborts_on_timeout(monkeypatch):
+    clock = itertools.count(step=10)
+    monkeypatch.setattr(blob_copy.time, "monotonic", lambda: next(clock))
+    monkeypatch.setattr(blob_copy.time, "sleep", lambda seconds: None)
+    container_client = FakeContainerClient(statuses=["pending"] * 10)
+    container_client.blobs["src"] = {"data": bytearray(b"abc"), "metadata": {}}
+
+    with pytest.raises(TimeoutError):
+        blob_copy.move_blob(container_client, "src", "dst", timeout=25)
+    assert container_client.aborted == ["copy-1"]
+    assert "src" in container_client.blobs
+
+
+def test_failed_copy_keeps_source():
+    container_client = FakeContainerClient(statuses=["failed"])
+    container_client.blobs["src"] = {"data": bytearray(b"abc"), "metadata": {}}
+
+    with pytest.raises(Exception, match="Copy status:failed"):
+        blob_copy.move_blob(container_client, "src", "dst")
+    assert "src" in container_client.blobs
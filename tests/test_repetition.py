@@ -0,0 +1,120 @@
+"""
+utils.repetition のテスト
+collapse_repeatsの結果が、置き換える前の正規表現による処理と一致することを確認する
+- remove_repeated_phrases: (.*?)\1+ を\1に置換する処理を変化がなくなるまで繰り返す
+- remove_repeated_words: ((.+?)\2{2,}) を削除する
+"""
+import random
+import re
+import time
+
+import pytest
+
+from utils.repetition import MAX_PERIOD, collapse_repeats
+
+ALPHABETS = ["ab", "abc", "あいう", "ab\n", "えーと、"]
+
+
+def remove_repeated_phrases_regex(text):
+    # 変更前のutil.remove_repeated_phrases
+    pattern = r'(.*?)\1+'
+    while True:
+        new_text = re.sub(pattern, r'\1', text)
+        if new_text == text:
+            break
+        text = new_text
+    return text
+
+
+def remove_repeated_words_regex(text):
+    # 変更前のwhisper_util.remove_repeated_words
+    pattern = r"((.+?)\2{2,})"
+    text = re.sub(pattern, "", text)
+    return text
+
+
+def remove_repeated_phrases(text):
+    return collapse_repeats(text)
+
+
+def remove_repeated_words(text):
+    return collapse_repeats(text, min_repeat=3, keep=0, until_stable=False)
+
+
+def random_texts(count, seed, max_length=40):
+    """
+    繰り返しを含みやすいテキスト（少ない文字の組み合わせ、短い単位の繰り返しの連結）を作成する
+    """
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        alphabet = rng.choice(ALPHABETS)
+        text = ""
+        while len(text) < rng.randint(0, max_length):
+            unit = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+            text += unit * rng.randint(1, 4)
+        texts.append(text[:max_length])
+    return texts
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_phrases_same_as_regex(seed):
+    for text in random_texts(300, seed):
+        assert remove_repeated_phrases(text) == remove_repeated_phrases_regex(text), repr(text)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_words_same_as_regex(seed):
+    for text in random_texts(300, seed):
+        assert remove_repeated_words(text) == remove_repeated_words_regex(text), repr(text)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "a",
+    "aa",
+    "aaa",
+    "abab",
+    "ababa",
+    "はいはいはい、そうですね",
+    "ありがとうございます。ありがとうございます。ありがとうございます。",
+    "あいうあいう\nあいうあいう",
+    "\n\n\n",
+    "えーとえーとえーと\nはい",
+])
+def test_examples_same_as_regex(text):
+    assert remove_repeated_phrases(text) == remove_repeated_phrases_regex(text)
+    assert remove_repeated_words(text) == remove_repeated_words_regex(text)
+
+
+def test_repeats_longer_than_max_period_are_kept():
+    # 周期がMAX_PERIODを超える繰り返しは対象にしない（正規表現では削除される）
+    unit = "".join(chr(0x4E00 + i) for i in range(MAX_PERIOD + 1))
+    text = unit * 3
+    assert remove_repeated_words(text) == text
+    assert remove_repeated_words_regex(text) == ""
+
+
+def elapsed(func, text, repeat=3):
+    times = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func(text)
+        times.append(time.perf_counter() - started_at)
+    return min(times)
+
+
+@pytest.mark.parametrize("make_text", [
+    # 少ない文字のランダムなテキスト（短い繰り返しが多く、候補の周期も多い）
+    lambda n: "".join(random.Random(0).choice("あいうえおかきくけこ") for _ in range(n)),
+    # 同じ文字の長い繰り返し
+    lambda n: "あ" * n,
+    # 周期の長い(MAX_PERIOD未満)繰り返し
+    lambda n: "".join(chr(0x4E00 + i % (MAX_PERIOD - 1)) for i in range(n)),
+])
+@pytest.mark.parametrize("func", [remove_repeated_phrases, remove_repeated_words])
+def test_pathological_input_is_linear(make_text, func):
+    # 長さを4倍にしたときの処理時間が、2乗(16倍)ではなく線形(4倍)に近いこと
+    small = elapsed(func, make_text(10_000))
+    large = elapsed(func, make_text(40_000))
+    assert large < max(small, 0.005) * 8
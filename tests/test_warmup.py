@@ -0,0 +1,122 @@
+"""
+utils.warmup のテスト
+- invalidate()の後に完了した先読みの結果で、更新後の情報を上書きしないこと
+- 呼び出し元で取得した情報をput()で渡し、skipした種類は先読みしないこと
+"""
+import asyncio
+
+from utils.warmup import SignInWarmup
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_invalidate_discards_inflight_prefetch():
+    async def main():
+        warmup = SignInWarmup()
+        release = asyncio.Event()
+        favorites = ["old"]
+
+        async def fetch_favorites(upn):
+            value = list(favorites)
+            await release.wait()
+            return value
+
+        warmup.register("favorites", fetch_favorites)
+        warmup.schedule("a@b")
+        await asyncio.sleep(0)
+
+        # 取得中にお気に入りが更新された
+        favorites[:] = ["new"]
+        warmup.invalidate("favorites", "a@b")
+        release.set()
+        await asyncio.sleep(0.01)
+
+        assert await warmup.take("favorites", "a@b") is None
+        assert warmup.stats()["stale"] == 1
+        assert warmup.stats()["inflight"] == 0
+
+    run(main())
+
+
+def test_invalidate_cancels_waiting_prefetch():
+    async def main():
+        warmup = SignInWarmup(max_concurrency=1)
+        release = asyncio.Event()
+        calls = []
+
+        async def fetch(upn):
+            calls.append(upn)
+            await release.wait()
+            return upn
+
+        warmup.register("favorites", fetch)
+        warmup.schedule("a@b")
+        warmup.schedule("c@d")
+        await asyncio.sleep(0)
+
+        # c@dは順番待ちのため取り消す
+        warmup.invalidate("favorites", "c@d")
+        release.set()
+        await asyncio.sleep(0.01)
+
+        assert calls == ["a@b"]
+        assert await warmup.take("favorites", "a@b") == "a@b"
+        assert await warmup.take("favorites", "c@d") is None
+
+    run(main())
+
+
+def test_prefetch_after_invalidate_is_kept():
+    async def main():
+        warmup = SignInWarmup(cooldown=0)
+        values = iter(["old", "new"])
+
+        async def fetch(upn):
+            return next(values)
+
+        warmup.register("favorites", fetch)
+        warmup.schedule("a@b")
+        await asyncio.sleep(0.01)
+        warmup.invalidate("favorites", "a@b")
+        warmup.schedule("a@b")
+        await asyncio.sleep(0.01)
+
+        assert await warmup.take("favorites", "a@b") == "new"
+
+    run(main())
+
+
+def test_put_and_skip_do_not_fetch_twice():
+    async def main():
+        warmup = SignInWarmup()
+        calls = []
+
+        async def fetch_attributes(upn):
+            calls.append("attributes")
+            return ["division"]
+
+        async def fetch_menu_permissions(upn):
+            attributes = await warmup.take("attributes", upn, keep=True)
+            if attributes is None:
+                attributes = await fetch_attributes(upn)
+            calls.append("menu_permissions")
+            return {"allowed": attributes}
+
+        warmup.register("attributes", fetch_attributes)
+        warmup.register("menu_permissions", fetch_menu_permissions)
+
+        # check_user_authorityと同じ順: 取得してから渡し、取得済みの種類はskipして先読みする
+        attributes = await warmup.take("attributes", "a@b", keep=True)
+        assert attributes is None
+        attributes = await fetch_attributes("a@b")
+        warmup.put("attributes", "a@b", attributes)
+        assert warmup.schedule("a@b", skip=("attributes",))
+        await asyncio.sleep(0.01)
+
+        assert calls == ["attributes", "menu_permissions"]
+        assert await warmup.take("menu_permissions", "a@b") == {"allowed": ["division"]}
+        assert warmup.stats()["cancelled"] == 0
+
+    run(main())
@@ -0,0 +1,92 @@
+"""
+compile_replace_dict と従来のllm_docsの置換(辞書の順にstr.replaceを繰り返す)の比較
+"""
+import random
+
+import pytest
+
+from utils.word_replace import compile_replace_dict
+
+SAMPLE_DICT = {
+    "Camellia": ["食堂", "社食", "社員食堂"],
+    "情報金融": ["情金"],
+    "ボーナス": ["変動給", "賞与"],
+    "付加価値税": ["vat"],
+    "share point": ["sharepoint"],
+    "情報金融Co": ["情報金融カンパニー"],
+}
+
+
+def replace_loop(replace_dict: dict, text: str) -> str:
+    """従来の置換"""
+    for key, word_list in replace_dict.items():
+        for word in word_list:
+            text = text.replace(word, key)
+    return text
+
+
+def independent_words(replace_dict: dict) -> list:
+    """
+    他の語を含まず、他の語に含まれず、置換後にも他の語を含まない語
+    (これらの語だけで作ったテキストは従来の置換と結果が一致する)
+    """
+    pairs = [(key, word) for key, word_list in replace_dict.items() for word in word_list]
+    words = [word for _, word in pairs]
+    return [
+        word for key, word in pairs
+        if not any(word != other and (other in word or word in other) for other in words)
+        and not any(other in key for other in words)
+        and not any(word in other_key for other_key in replace_dict)
+    ]
+
+
+def random_texts(replace_dict: dict, count: int, seed: int = 0) -> list:
+    words = independent_words(replace_dict)
+    used = set("".join(words) + "".join(replace_dict))
+    filler = [c for c in "あいうえおかきくけこ、。 \nABCXYZ0123" if c not in used]
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 30)):
+            if rng.random() < 0.3:
+                parts.append(rng.choice(words))
+            else:
+                parts.append("".join(rng.choices(filler, k=rng.randint(1, 8))))
+        texts.append("".join(parts))
+    return texts
+
+
+@pytest.mark.parametrize("text", random_texts(SAMPLE_DICT, 500))
+def test_same_as_loop_for_sample_dict(text):
+    assert compile_replace_dict(SAMPLE_DICT)(text) == replace_loop(SAMPLE_DICT, text)
+
+
+def test_same_as_loop_for_replace_dict():
+    prompt = pytest.importorskip("prompt")
+    replace_words = compile_replace_dict(prompt.replace_dict)
+    for text in random_texts(prompt.replace_dict, 5_000, seed=1):
+        assert replace_words(text) == replace_loop(prompt.replace_dict, text)
+
+
+def test_longest_word_wins():
+    # 従来は「食堂」が先に置換され「社員Camellia」になっていた
+    replace_words = compile_replace_dict(SAMPLE_DICT)
+    assert replace_words("社員食堂のメニュー") == "Camelliaのメニュー"
+    assert replace_words("情報金融カンパニーと情金") == "情報金融Coと情報金融"
+
+
+def test_replaced_text_is_not_rescanned():
+    replace_words = compile_replace_dict({"ab": ["x"], "c": ["ab"]})
+    assert replace_words("x ab") == "ab c"
+
+
+def test_first_key_wins_for_duplicated_word():
+    replace_words = compile_replace_dict({"A": ["w"], "B": ["w"]})
+    assert replace_words("w") == "A"
+
+
+def test_special_characters_and_empty_dict():
+    assert compile_replace_dict({"X": ["a.b", "(c)"]})("a.b axb (c)") == "X axb X"
+    assert compile_replace_dict({})("text") == "text"
+    assert compile_replace_dict({"X": [""]})("text") == "text"
@@ -13,6 +13,7 @@ import ast
 import uuid
 
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from mimetypes import guess_type
@@ -26,9 +27,9 @@ from email.utils import make_msgid
 # OSSライブラリ
 import requests
 from requests.exceptions import RequestException, Timeout, TooManyRedirects
+import aiohttp
 import openpyxl
 import pandas as pd
-import tiktoken
 import openai
 from httpx import Timeout
 import extract_msg
@@ -41,15 +42,19 @@ from docx.oxml.table import CT_Tbl
 from docx.table import Table
 from docx.text.paragraph import Paragraph
 
-from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos import PartitionKey
 from azure.cosmos.exceptions import CosmosResourceExistsError
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 
 # 自作
-from config import (LLM_REGISTRY, COSMOS_CONNECTION_STRING, BLOB_CONNECTION_STRING,
-                    AUDIO_CONTAINER_NAME, FILE_CONTAINER_NAME, VARIABLE_LIST, ENVIRONMENT_SELECTED)
+from config import (LLM_REGISTRY, AUDIO_CONTAINER_NAME, FILE_CONTAINER_NAME, VARIABLE_LIST, ENVIRONMENT_SELECTED)
+from utils.clients import CLIENT_REGISTRY
+from utils.text_cache import FILE_TEXT_CACHE
+from utils.keyword_matcher import KeywordMatcher
+from utils.repetition import collapse_repeats
+from utils.word_replace import compile_replace_dict
+from utils.token_budget import TOKEN_BUDGET
 from i_style.aiohttp import AsyncHttpClient
 from i_style.llm import AzureOpenAI
 from i_style.text_extractor import FileTextExtractor
@@ -65,6 +70,12 @@ GOOGLE_CSE_ID = os.environ.get("GOOGLE_CSE_ID")
 ENCODINGS = ['utf-8', 'shift_jis', 'euc_jp',
              'iso2022_jp', 'cp932', 'utf-16', 'latin1']
 
+# ファイルの文字起こし(file2text)を実行するスレッドプール
+# 同時に実行する変換の数を制限し、イベントループを塞がないようにする
+FILE2TEXT_MAX_WORKERS = int(os.environ.get("FILE2TEXT_MAX_WORKERS", 4))
+FILE2TEXT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=FILE2TEXT_MAX_WORKERS, thread_name_prefix="file2text")
+
 ##########
 # module #
 ##########
@@ -117,6 +128,25 @@ async def google_search(async_http_client: AsyncHttpClient, query: str, num: int
              "link": it.get("link", "")}
             for it in items]
 
+
+async def google_search_many(async_http_client: AsyncHttpClient, queries: list[str], num: int = 5) -> list:
+    """
+    複数のクエリでGoogle検索を並列に実行する関数
+    戻り値はqueriesと同じ順序で、各要素はgoogle_searchの結果、または発生した例外
+
+    Args:
+        async_http_client: 検索に利用するHTTPクライアント
+        queries: 検索クエリのリスト
+        num: クエリごとの取得件数
+
+    Returns:
+        クエリごとの検索結果（または例外）のリスト
+    """
+    return await asyncio.gather(
+        *(google_search(async_http_client, query, num=num) for query in queries),
+        return_exceptions=True
+    )
+
 # urlから必要な情報のみ抽出する関数
 
 
@@ -144,16 +174,44 @@ async def url2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str
 
     return text
 
+# 本文取得の並列実行の設定
+FETCH_MAX_CONCURRENCY = 8  # 同時に取得するURLの上限
+FETCH_PER_HOST_LIMIT = 2  # 同一ホストへの同時接続数の上限
+FETCH_DEADLINE = 30  # 本文取得全体の締め切り（秒）
+
+HTML_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (compatible; MyWebScraper/1.0)',
+    'Accept': 'text/html,application/xhtml+xml,application/xml',
+    'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
+}
+PDF_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (compatible; MyWebScraper/1.0)',
+    'Accept': 'application/pdf',
+    'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
+}
+
 # 上記の関数を用いてcse_listを更新する関数
 
 
-async def updateSearchResults(cse_list: list, max_length: int = 20_000) -> list:
+async def updateSearchResults(cse_list: list,
+                              max_length: int = 20_000,
+                              timeout: int = 10,
+                              deadline: float = FETCH_DEADLINE,
+                              max_concurrency: int = FETCH_MAX_CONCURRENCY,
+                              per_host_limit: int = FETCH_PER_HOST_LIMIT) -> list:
     """
     google/bingの検索結果からより詳細な内容を取得する
     snippetに追記する形で更新し、詳細取得に失敗した場合はsnippetを更新しない
+    各URLはプロセスで共有するaiohttpセッション上で並列に取得し、deadlineまでに取得できなかったものは
+    snippetを更新せずに残りの結果のみを返す
 
     Args:
         cse_list: 検索結果のリスト
+        max_length: 本文の最大長
+        timeout: URLごとのタイムアウト秒数
+        deadline: 本文取得全体の締め切り秒数
+        max_concurrency: 同時に取得するURLの上限
+        per_host_limit: 同一ホストへの同時接続数の上限
 
     Returns:
         更新された検索結果のリスト
@@ -161,13 +219,42 @@ async def updateSearchResults(cse_list: list, max_length: int = 20_000) -> list:
     if not isinstance(cse_list, list):
         return []
 
-    for item in cse_list:
+    targets = [item for item in cse_list
+               if isinstance(item, dict) and "link" in item and "snippet" in item]
+    if not targets:
+        return cse_list
+
+    # 接続プールはプロセス全体で共有し、同時実行数・ホストごとの同時接続数はセマフォで制限する
+    session = CLIENT_REGISTRY.aiohttp_session()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    host_semaphores = {}
+
+    async def _fetch(url: str) -> str:
+        host = urllib.parse.urlparse(url).netloc
+        host_semaphore = host_semaphores.setdefault(
+            host, asyncio.Semaphore(per_host_limit))
+        async with semaphore, host_semaphore:
+            return await fetch_url_text(session, url, max_length, timeout)
+
+    tasks = {
+        asyncio.create_task(_fetch(item["link"])): item
+        for item in targets
+    }
+    done, pending = await asyncio.wait(tasks.keys(), timeout=deadline)
+
+    # 締め切りまでに終わらなかった取得はキャンセルし、取得済みの結果のみ利用する
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(
+            f"本文取得が締め切り({deadline}秒)に間に合いませんでした: "
+            f"{[tasks[task]['link'] for task in pending]}")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    for task in done:
+        item = tasks[task]
         try:
-            if not isinstance(item, dict) or "link" not in item or "snippet" not in item:
-                continue
-
-            # html_content取得
-            html_content = await url2text(item["link"], max_length)
+            html_content = task.result()
 
             # エラーメッセージが返ってきた場合はスキップ
             if html_content.startswith("URL") or html_content.startswith("無効") or html_content.startswith("予期せぬ"):
@@ -177,11 +264,77 @@ async def updateSearchResults(cse_list: list, max_length: int = 20_000) -> list:
             item["snippet"] += "\n\n## 本文\n\n" + html_content
         except Exception as e:
             # 個別のアイテム処理でエラーが発生しても全体の処理は継続
+            logging.warning(f"本文取得エラー: {item['link']}, {e}")
             continue
 
     return cse_list
 
 
+async def fetch_url_text(session: aiohttp.ClientSession, url: str, max_length: int = 20_000, timeout: int = 10) -> str:
+    """
+    aiohttpのセッションを利用してurlの内容を取得し、url2textと同じ形式のテキストを返却する
+
+    Args:
+        session: 共有するaiohttpのセッション
+        url: 取得対象のURL
+        max_length: 返却するテキストの最大長
+        timeout: リクエストのタイムアウト秒数
+
+    Returns:
+        整形された内容、またはエラーメッセージ
+    """
+    # URLの検証
+    if not is_valid_url(url):
+        return "無効なURLフォーマットです。"
+
+    is_pdf = url.split(".")[-1].lower() == "pdf"
+    headers = PDF_REQUEST_HEADERS if is_pdf else HTML_REQUEST_HEADERS
+
+    try:
+        async with session.get(
+            url,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            allow_redirects=True,
+            max_redirects=10,
+            raise_for_status=True
+        ) as response:
+            # コンテンツサイズの確認（巨大なレスポンスを防ぐ）
+            if not is_pdf and response.content_length and response.content_length > 10_000_000:
+                return "コンテンツが大きすぎます。"
+
+            content = await response.read()
+            if is_pdf:
+                return await _pdf_bytes2text(content, max_length)
+
+            # エンコーディングの適切な処理
+            encoding = response.charset or "utf-8"
+
+        html_content = content.decode(encoding, errors="replace")
+
+        # HTMLの整形はCPU処理のためイベントループを塞がないようスレッドで実行
+        cleaned_content = await asyncio.to_thread(_clean_html, html_content)
+
+        # 最大長を超える場合はトリミング
+        if len(cleaned_content) > max_length:
+            cleaned_content = cleaned_content[:max_length] + "...(省略されました)"
+
+        return cleaned_content
+
+    except asyncio.TimeoutError:
+        if is_pdf:
+            return "PDFの読み込みがタイムアウトしました。"
+        return "URLの読み込みがタイムアウトしました。"
+    except aiohttp.TooManyRedirects:
+        return "リダイレクトが多すぎます。"
+    except aiohttp.ClientError as e:
+        if is_pdf:
+            return f"PDFの読み込み中にエラーが発生しました: {str(e)}"
+        return f"URLの読み込み中にエラーが発生しました: {str(e)}"
+    except Exception as e:
+        return f"予期せぬエラーが発生しました: {str(e)}"
+
+
 async def pdf2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str:
     """
     pdfのurlを受け取り、htmlを取得、不要なタグを削除し整形した内容をstrで返却する
@@ -194,37 +347,12 @@ async def pdf2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str
     Returns:
         整形されたHTML内容、またはエラーメッセージ
     """
-    # LLM用の環境変数を設定（本番では適切な値を設定）
-
-    # FileTextExtractorの初期化
-    extractor = FileTextExtractor(
-        file_extension_list=["pdf",],
-    )
-
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (compatible; MyWebScraper/1.0)',
-        'Accept': 'application/pdf',
-        'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
-    }
     try:
-        response = requests.get(url, headers=headers,
+        response = requests.get(url, headers=PDF_REQUEST_HEADERS,
                                 timeout=timeout, stream=True)
         response.raise_for_status()
         pdf_content = response.content
-        # PDFのテキスト抽出
-        result = await extractor.extract_text(pdf_content, "pdf")
-        if not result or not isinstance(result, list):
-            return "PDFからテキストを抽出できませんでした。"
-        # ページごとのテキストを結合
-        texts = ""
-        for page in result:
-            _num = page.get("page_number", "?")
-            _texts = page.get("texts", "内容を読み取れませんでした")
-            texts += f"<page{_num}>\n{_texts}\n</page{_num}>\n"
-
-        if len(texts) > max_length:
-            texts = texts[:max_length] + "...(省略されました)"
-        return texts if texts else "PDFからテキストを抽出できませんでした。"
+        return await _pdf_bytes2text(pdf_content, max_length)
     except Timeout:
         return "PDFの読み込みがタイムアウトしました。"
     except RequestException as e:
@@ -233,6 +361,31 @@ async def pdf2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str
         return f"予期せぬエラーが発生しました: {str(e)}"
 
 
+async def _pdf_bytes2text(pdf_content: bytes, max_length: int = 20_000) -> str:
+    """
+    取得済みのPDFのバイト列からページごとのテキストを抽出して返却する
+    """
+    # FileTextExtractorの初期化
+    extractor = FileTextExtractor(
+        file_extension_list=["pdf",],
+    )
+
+    # PDFのテキスト抽出
+    result = await extractor.extract_text(pdf_content, "pdf")
+    if not result or not isinstance(result, list):
+        return "PDFからテキストを抽出できませんでした。"
+    # ページごとのテキストを結合
+    texts = ""
+    for page in result:
+        _num = page.get("page_number", "?")
+        _texts = page.get("texts", "内容を読み取れませんでした")
+        texts += f"<page{_num}>\n{_texts}\n</page{_num}>\n"
+
+    if len(texts) > max_length:
+        texts = texts[:max_length] + "...(省略されました)"
+    return texts if texts else "PDFからテキストを抽出できませんでした。"
+
+
 def html2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str:
     """
     urlを受け取り、htmlを取得、不要なタグを削除し整形した内容をstrで返却する
@@ -245,19 +398,11 @@ def html2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str:
     Returns:
         整形されたHTML内容、またはエラーメッセージ
     """
-
-    # リクエストヘッダーの設定
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (compatible; MyWebScraper/1.0)',
-        'Accept': 'text/html,application/xhtml+xml,application/xml',
-        'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
-    }
-
     try:
         # リクエスト実行（タイムアウト、リダイレクト制限あり）
         response = requests.get(
             url,
-            headers=headers,
+            headers=HTML_REQUEST_HEADERS,
             timeout=timeout,
             allow_redirects=True,
             # max_redirects=5,
@@ -277,45 +422,7 @@ def html2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str:
 
         html_content = response.text
 
-        def clean_html() -> str:
-            try:
-                soup = BeautifulSoup(html_content, 'html.parser')
-
-                # 不要な要素を削除
-                for element in ['script', 'style', 'noscript', 'iframe', 'head', 'meta', 'link']:
-                    for tag in soup.find_all(element):
-                        tag.decompose()
-
-                # コメントを削除
-                for comment in soup.find_all(string=lambda string: isinstance(string, Comment)):
-                    comment.extract()
-
-                # divタグを解放
-                allowed_tags = {'table', 'tr', 'td', 'th', 'ul', 'ol', 'li',
-                                'dl', 'dt', 'dd', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
-                for tag in soup.find_all():
-                    if tag.name not in allowed_tags:
-                        tag.unwrap()
-
-                # 空の要素を削除（img と br は除く）
-                for tag in soup.find_all():
-                    if len(tag.get_text(strip=True)) == 0:
-                        tag.extract()
-
-                # 全ての属性を削除
-                for tag in soup.find_all():
-                    tag.attrs = {}
-
-                # 空白行と余分な空白を削除
-                cleaned_html = re.sub(
-                    r'\n\s*\n', '\n', str(soup), flags=re.MULTILINE)
-                cleaned_html = re.sub(r'\s+', ' ', cleaned_html)
-
-                return cleaned_html
-            except Exception as e:
-                return f"HTMLの処理中にエラーが発生しました: {str(e)}"
-
-        cleaned_content = clean_html()
+        cleaned_content = _clean_html(html_content)
 
         # 最大長を超える場合はトリミング
         if len(cleaned_content) > max_length:
@@ -333,6 +440,48 @@ def html2text(url: str, max_length: int = 20_000, timeout: int = 10) -> str:
         return f"予期せぬエラーが発生しました: {str(e)}"
 
 
+def _clean_html(html_content: str) -> str:
+    """
+    htmlから不要なタグ・属性・空白を削除し整形した内容を返却する
+    """
+    try:
+        soup = BeautifulSoup(html_content, 'html.parser')
+
+        # 不要な要素を削除
+        for element in ['script', 'style', 'noscript', 'iframe', 'head', 'meta', 'link']:
+            for tag in soup.find_all(element):
+                tag.decompose()
+
+        # コメントを削除
+        for comment in soup.find_all(string=lambda string: isinstance(string, Comment)):
+            comment.extract()
+
+        # divタグを解放
+        allowed_tags = {'table', 'tr', 'td', 'th', 'ul', 'ol', 'li',
+                        'dl', 'dt', 'dd', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+        for tag in soup.find_all():
+            if tag.name not in allowed_tags:
+                tag.unwrap()
+
+        # 空の要素を削除（img と br は除く）
+        for tag in soup.find_all():
+            if len(tag.get_text(strip=True)) == 0:
+                tag.extract()
+
+        # 全ての属性を削除
+        for tag in soup.find_all():
+            tag.attrs = {}
+
+        # 空白行と余分な空白を削除
+        cleaned_html = re.sub(
+            r'\n\s*\n', '\n', str(soup), flags=re.MULTILINE)
+        cleaned_html = re.sub(r'\s+', ' ', cleaned_html)
+
+        return cleaned_html
+    except Exception as e:
+        return f"HTMLの処理中にエラーが発生しました: {str(e)}"
+
+
 def is_valid_url(url: str) -> bool:
     """URLが有効かつ安全かを検証する"""
     try:
@@ -425,10 +574,8 @@ def change_user_input(messages):
     return {"role": "error", "content": "error"}
 
 
-def check_token(text: str) -> int:
-    encoding = tiktoken.get_encoding("cl100k_base")
-    token_integers = encoding.encode(text)
-    return len(token_integers)
+def check_token(text: str, model_name: str = None) -> int:
+    return TOKEN_BUDGET.count(text, model_name)
 
 
 #########
@@ -512,7 +659,7 @@ async def Brain(messages, mode="", func_list=func_list):
         return "LLM_GOOGLE"
 
     # token数が多い場合の処理
-    if check_token(user_input) > 16_000-4096:
+    if TOKEN_BUDGET.exceeds(user_input, 16_000-4096):
         return "LLM_CHAT"
 
     # model
@@ -594,26 +741,31 @@ async def messages2textMessages(upn: str, messages: list, async_http_client: Asy
         - blobから指定されたblobをダウンロードする(画像とtxtのみ対応)
         - contentを整形する
     ファイルの文字起こし、blobへのアップロード、messagesの整形
+    file, blobの処理は全messageを通して並列に実行し、結果は元の順序で組み立てる
     """
     new_messages = []
     blobs = []
 
-    # Blobサービスクライアントの初期化
-    blob_service_client = BlobServiceClient.from_connection_string(
-        BLOB_CONNECTION_STRING)
-    container_client = blob_service_client.get_container_client(
-        container=FILE_CONTAINER_NAME)
-
-    # コンテナが存在しない場合は作成
-    if not container_client.exists():
-        try:
-            container_client.create_container()
-        except Exception as e:
-            logging.debug(
-                f"Container already exists or error creating container: {e}")
+    # 共有のBlobコンテナクライアント(非同期)を取得（コンテナが存在しない場合は作成）
+    container_client = await CLIENT_REGISTRY.ensure_async_blob_container(
+        FILE_CONTAINER_NAME)
 
     _messages = deepcopy(messages)
 
+    # file, blobの処理を並列に実行
+    reserved_blob_names = set()  # 並列アップロード時のblob名の重複防止
+    jobs = []
+    for message in _messages:
+        if not isinstance(message["content"], list):
+            continue
+        for content in message["content"]:
+            if content["type"] == "file":
+                jobs.append(_file_content2text(
+                    upn, content, container_client, reserved_blob_names, image_required))
+            elif content["type"] == "blob":
+                jobs.append(_blob_content2text(content, container_client))
+    results = iter(await asyncio.gather(*jobs))
+
     for message in _messages:
         content_list = []  # contentを保持するリスト
         text_list = []  # 文字起こし結果を保持するリスト
@@ -627,89 +779,11 @@ async def messages2textMessages(upn: str, messages: list, async_http_client: Asy
             for content in contents:
                 if content["type"] == "text":
                     content_list.append(content)
-                elif content["type"] == "file":
-                    file_name = content["name"]
-                    file_ext = file_name.split(".")[-1].lower()
-                    encoded_content = content["data"].split(",")[-1]
-                    file_content = base64.b64decode(encoded_content)
-
-                    file_text = ""
-
-                    if file_ext in ("png", "jpg", "jpeg"):
-                        # if file_ext in ():
-                        if image_required:
-                            # AOAIに画像の内容を判断させる
-                            image_url = f"data:image/{file_ext};base64,{encoded_content}"
-
-                            # テキストを含まない場合、画像URLをリストに追加
-                            content_list.append({
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": image_url
-                                }
-                            })
-
-                    # 他のファイルタイプの処理
-                    content_text, page_num = file2text(file_content, file_ext)
-                    file_text = f"## [{file_name}]\n{content_text}"
-                    text_list.append(file_text)
-
-                    # ファイルをBlobにアップロード
-                    blob_name = upn + "/" + file_name.replace("/", "_")
-                    blob_client = blob_service_client.get_blob_client(
-                        container=FILE_CONTAINER_NAME, blob=blob_name)
-
-                    base, ext = blob_name.rsplit(".", 1)
-                    while blob_client.exists():  # 既存のファイル名の場合は「UUID」を付与
-                        blob_name = f"{base}_{uuid.uuid4().hex}.{ext}"
-                        blob_client = blob_service_client.get_blob_client(
-                            container=FILE_CONTAINER_NAME, blob=blob_name)
-
-                    # ファイルをアップロード
-                    blob_client.upload_blob(file_content, overwrite=False)
-                    logging.info(f"'{blob_name}' uploaded to blob storage")
-                    if image_required:
-                        blobs.append(
-                            {"name": blob_name, "page": page_num, "file_name": file_name})
-
-                    # txtファイルの作成
-                    text_blob_name = ".".join(
-                        blob_name.split(".")[:-1]) + ".txt"
-                    text_blob_client = blob_service_client.get_blob_client(
-                        container=FILE_CONTAINER_NAME, blob=text_blob_name)
-
-                    # ファイルをアップロード # 元のファイルがtxtだった場合用にoverwriteを有効化
-                    if not text_blob_client.exists():
-                        logging.info(
-                            f"'{text_blob_name}' uploaded to blob storage")
-                    else:
-                        logging.warning(f"'{text_blob_name}' already exists")
-                    text_blob_client.upload_blob(file_text, overwrite=True)
-                    blobs.append(
-                        {"name": text_blob_name, "page": page_num, "file_name": file_name})
-
-                elif content["type"] == "blob":
-                    blob_name = content["name"]
-                    file_ext = blob_name.split(".")[-1].lower()
-                    blob_client = blob_service_client.get_blob_client(
-                        container=FILE_CONTAINER_NAME, blob=blob_name)
-                    try:
-                        if file_ext in ("png", "jpg", "jpeg"):
-                            file_content = blob_client.download_blob().readall()
-                            content_list.append({
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/{file_ext};base64,{base64.b64encode(file_content).decode('utf-8')}"
-                                }
-                            })
-                        elif file_ext == "txt":
-                            file_text = blob_client.download_blob().readall().decode('utf-8')
-                            text_list.append(file_text)
-                        else:
-                            continue
-                    except Exception as e:
-                        logging.warning(f"genie blob: {e}")
-                        text_list.append("ファイルの読み込みに失敗しました。")
+                elif content["type"] in ("file", "blob"):
+                    result = next(results)
+                    content_list.extend(result["contents"])
+                    text_list.extend(result["texts"])
+                    blobs.extend(result["blobs"])
 
                 elif content["type"] == "link":
                     # boxのリンクを追加
@@ -727,6 +801,112 @@ async def messages2textMessages(upn: str, messages: list, async_http_client: Asy
         new_messages.append(message)
     return new_messages, blobs
 
+
+async def _file_content2text(upn: str, content: dict, container_client, reserved_blob_names: set, image_required: bool) -> dict:
+    """
+    messages2textMessagesのfileの処理
+    文字起こしはスレッドプールで実行し、元のファイル・文字起こしファイルを非同期でblobにアップロードする
+    """
+    contents = []
+    blobs = []
+
+    file_name = content["name"]
+    file_ext = file_name.split(".")[-1].lower()
+    encoded_content = content["data"].split(",")[-1]
+    file_content = base64.b64decode(encoded_content)
+
+    file_text = ""
+
+    if file_ext in ("png", "jpg", "jpeg"):
+        # if file_ext in ():
+        if image_required:
+            # AOAIに画像の内容を判断させる
+            image_url = f"data:image/{file_ext};base64,{encoded_content}"
+
+            # テキストを含まない場合、画像URLをリストに追加
+            contents.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url
+                }
+            })
+
+    # 他のファイルタイプの処理（イベントループを塞がないようスレッドプールで実行）
+    loop = asyncio.get_running_loop()
+    content_text, page_num = await loop.run_in_executor(
+        FILE2TEXT_EXECUTOR, file2text, file_content, file_ext)
+    file_text = f"## [{file_name}]\n{content_text}"
+
+    # ファイルをBlobにアップロード
+    blob_name = upn + "/" + file_name.replace("/", "_")
+    blob_client = container_client.get_blob_client(blob_name)
+
+    base, ext = blob_name.rsplit(".", 1)
+    while True:  # 既存のファイル名の場合は「UUID」を付与
+        if blob_name not in reserved_blob_names:
+            reserved_blob_names.add(blob_name)
+            if not await blob_client.exists():
+                break
+        blob_name = f"{base}_{uuid.uuid4().hex}.{ext}"
+        blob_client = container_client.get_blob_client(blob_name)
+
+    # ファイルをアップロード
+    await blob_client.upload_blob(file_content, overwrite=False)
+    logging.info(f"'{blob_name}' uploaded to blob storage")
+    if image_required:
+        blobs.append(
+            {"name": blob_name, "page": page_num, "file_name": file_name})
+
+    # txtファイルの作成
+    text_blob_name = ".".join(
+        blob_name.split(".")[:-1]) + ".txt"
+    text_blob_client = container_client.get_blob_client(
+        text_blob_name)
+
+    # ファイルをアップロード # 元のファイルがtxtだった場合用にoverwriteを有効化
+    if not await text_blob_client.exists():
+        logging.info(
+            f"'{text_blob_name}' uploaded to blob storage")
+    else:
+        logging.warning(f"'{text_blob_name}' already exists")
+    await text_blob_client.upload_blob(file_text, overwrite=True)
+    blobs.append(
+        {"name": text_blob_name, "page": page_num, "file_name": file_name})
+
+    return {"contents": contents, "texts": [file_text], "blobs": blobs}
+
+
+async def _blob_content2text(content: dict, container_client) -> dict:
+    """
+    messages2textMessagesのblobの処理
+    指定されたblobをダウンロードする(画像とtxtのみ対応)
+    """
+    contents = []
+    texts = []
+
+    blob_name = content["name"]
+    file_ext = blob_name.split(".")[-1].lower()
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        if file_ext in ("png", "jpg", "jpeg"):
+            downloader = await blob_client.download_blob()
+            file_content = await downloader.readall()
+            contents.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/{file_ext};base64,{base64.b64encode(file_content).decode('utf-8')}"
+                }
+            })
+        elif file_ext == "txt":
+            downloader = await blob_client.download_blob()
+            file_text = (await downloader.readall()).decode('utf-8')
+            texts.append(file_text)
+    except Exception as e:
+        logging.warning(f"genie blob: {e}")
+        texts.append("ファイルの読み込みに失敗しました。")
+
+    return {"contents": contents, "texts": texts, "blobs": []}
+
 # 社内情報とsuffixの除去
 
 
@@ -868,13 +1048,8 @@ def insert_newline_corrected(text):
 
 
 def remove_repeated_phrases(text):
-    pattern = r'(.*?)\1+'
-    while True:
-        new_text = re.sub(pattern, r'\1', text)
-        if new_text == text:
-            break
-        text = new_text
-    return text
+    # (.*?)\1+ を\1に置換する処理を変化がなくなるまで繰り返すのと同じ結果（線形時間）
+    return collapse_repeats(text)
 
 
 def contains_only_standard_characters(text):
@@ -1002,28 +1177,16 @@ def send_email(subject: str, content: str, send_to=[], attachment_list=[]) -> bo
 
 
 def upload_blob(file_name: str, file_content: str, container_name: str, overwrite: bool = False) -> bool:
-    blob_service_client = BlobServiceClient.from_connection_string(
-        conn_str=BLOB_CONNECTION_STRING
-    )
     # error handling
     status_flag = False
 
-    # コンテナに接続
-    container_client = blob_service_client.get_container_client(
-        container=container_name
-    )
-
     try:
-        # コンテナが存在しない場合は作成
-        try:
-            container_client.create_container()
-        except Exception as e:
-            logging.debug(
-                f"Container already exists or error creating container: {e}")
+        # コンテナに接続（コンテナが存在しない場合は作成）
+        container_client = CLIENT_REGISTRY.blob_container(
+            container_name, create=True)
 
         # Blobクライアントを取得
-        blob_client = blob_service_client.get_blob_client(
-            container=container_name, blob=file_name)
+        blob_client = container_client.get_blob_client(file_name)
 
         # ファイルをアップロード
         blob_client.upload_blob(file_content, overwrite=overwrite)
@@ -1037,14 +1200,11 @@ def upload_blob(file_name: str, file_content: str, container_name: str, overwrit
 
 
 def download_blob(file_name: str, container_name: str) -> bytes:
-    blob_service_client = BlobServiceClient.from_connection_string(
-        conn_str=BLOB_CONNECTION_STRING
-    )
     binary_data = b""
     try:
         # Blobクライアントを取得
-        blob_client = blob_service_client.get_blob_client(
-            container=container_name, blob=file_name)
+        blob_client = CLIENT_REGISTRY.blob_container(
+            container_name).get_blob_client(file_name)
 
         # バイナリデータをダウンロード
         binary_data = blob_client.download_blob().readall()
@@ -1064,11 +1224,7 @@ def get_container_proxy(database_name: str, container_name: str):
     Cosmos DBのデータベース、コンテナを指定して操作を行うためのcontainer proxyを取得する
     """
     try:
-        client = CosmosClient.from_connection_string(
-            conn_str=COSMOS_CONNECTION_STRING)
-        database = client.get_database_client(database_name)
-        container = database.get_container_client(container_name)
-        return container
+        return CLIENT_REGISTRY.cosmos_container(database_name, container_name)
     except Exception as e:
         logging.critical(f"Error in loading Cosmos DB: {e}")
         raise
@@ -1162,9 +1318,29 @@ def file2text(file_content: bytes, file_ext: str) -> tuple[str, int]:
 
     特定の処理がない場合はドキュメントインテリジェンスに投げる
     大きいファイルのアップロード時にエラーが起きるため、pandasは廃止
+    同じ内容のファイルはキャッシュ(FILE_TEXT_CACHE)の結果を返す
+    """
+    content_info, _ = _file2text(file_content, file_ext)
+    return content_info
+
+
+def _file2text(file_content: bytes, file_ext: str) -> tuple[tuple[str, int], bool]:
+    """
+    file2textの本体。((テキスト, ページ数), 読み込みに成功したか)を返す
+    msgの添付ファイルを1つでも読み込めなかった場合は失敗として扱い、キャッシュしない
     """
+    complete = True
     try:
         file_ext = file_ext.lower()
+        uses_di = file_ext not in FILE2TEXT_PARSER_EXTENSIONS
+
+        # キャッシュの確認
+        cache_key = FILE_TEXT_CACHE.make_key(file_content, file_ext)
+        content_info = FILE_TEXT_CACHE.get(cache_key, uses_di=uses_di)
+        if content_info is not None:
+            logging.info(f"file2text: cache hit {cache_key}")
+            return content_info, True
+
         if file_ext in ("pptx", ):
             content_info = pptx2text(file_content)
         elif file_ext in ("xlsx", ):
@@ -1174,13 +1350,24 @@ def file2text(file_content: bytes, file_ext: str) -> tuple[str, int]:
         elif file_ext in ("txt", "csv",):
             content_info = txt2text(file_content)
         elif file_ext in ("msg", ):
-            content_info = msg2text(file_content)
+            content_info, complete = _msg2text(file_content)
         else:  # if file_ext in ("pdf", "png", "jpg", ):
             content_info = img2text(file_content)
+
+        # 読み込みに成功した場合のみキャッシュする
+        if complete:
+            FILE_TEXT_CACHE.set(cache_key, content_info)
+        else:
+            logging.warning(f"file2text: not cached (attachment failed) {cache_key}")
     except Exception as e:
         content_info = "ファイルの内容を読み込めませんでした。", 0
+        complete = False
         logging.critical(f"illegal file_ext: {file_ext}, error: {e}")
-    return content_info
+    return content_info, complete
+
+
+# ドキュメントインテリジェンスを使わずに読み込む拡張子
+FILE2TEXT_PARSER_EXTENSIONS = ("pptx", "xlsx", "docx", "txt", "csv", "msg")
 
 
 def img2text(file_content: bytes) -> tuple[str, int]:
@@ -1345,6 +1532,14 @@ def txt2text(file_content: bytes) -> tuple[str, int]:
 
 
 def msg2text(file_content: bytes) -> tuple[str, int]:
+    content_info, _ = _msg2text(file_content)
+    return content_info
+
+
+def _msg2text(file_content: bytes) -> tuple[tuple[str, int], bool]:
+    """
+    ((テキスト, ページ数), すべての添付ファイルを読み込めたか)を返す
+    """
     msg = extract_msg.Message(io.BytesIO(file_content))
 
     subject = msg.subject if msg.subject else "No Subject"
@@ -1355,6 +1550,7 @@ def msg2text(file_content: bytes) -> tuple[str, int]:
     date = msg.date if msg.date else "Unknown Date"
 
     attachments = []
+    complete = True
     for attachment in msg.attachments:
         file_name = attachment.name
         if not file_name:
@@ -1367,7 +1563,8 @@ def msg2text(file_content: bytes) -> tuple[str, int]:
         else:
             file_content = attachment.data
 
-        content_text, _ = file2text(file_content, file_ext)
+        (content_text, _), attachment_complete = _file2text(file_content, file_ext)
+        complete = complete and attachment_complete
         file_text = f"#### [{file_name}]\n{content_text}"  # ハッシュを2個追加
         attachments.append(file_text)
 
@@ -1392,7 +1589,7 @@ def msg2text(file_content: bytes) -> tuple[str, int]:
 **Attachments**:
 {attachments_text}
 """
-    return text, 1
+    return (text, 1), complete
 
 
 # Function to encode a local image into data URL
@@ -1464,21 +1661,52 @@ def get_news(k: int = 4) -> list:
 
 
 def generate_info_suffix(user_input: str, file_path: str, sheet_name: str, header: int = 1):
+    """
+    ユーザーの入力に設定ファイルのキーワードが含まれる場合、関連サイトのリンクを返す
+    設定ファイルは初回(および更新時)のみ読み込み、キーワードのマッチャーを使い回す
+    """
+    info_sites = _load_info_sites(file_path, sheet_name, header)
 
-    df = pd.read_excel(file_path, sheet_name=sheet_name, header=header)
-    df["keywords"] = df["keywords"].apply(ast.literal_eval)
+    matched_rows = info_sites["matcher"].match(user_input)
 
     info_suffix = ""
-    for i in range(len(df)):
-        flag = False
-        keywords = df["keywords"][i]
-        for keyword in keywords:
-            if keyword.lower() in user_input.lower():
-                flag = True
-        if flag:
+    for i, (url, title) in enumerate(info_sites["links"]):
+        if i in matched_rows:
             info_suffix += "<br><a href='{url}' class='custom-link' target='_blank'>{title}</a>".format(
-                url=df["url"][i], title=df["title"][i])
+                url=url, title=title)
     if len(info_suffix) > 0:
         info_suffix = "【関連サイト】" + info_suffix
 
     return info_suffix
+
+
+# generate_info_suffixの設定ファイルの読み込み結果 {(file_path, sheet_name, header): {...}}
+_INFO_SITES_CACHE = {}
+
+
+def _load_info_sites(file_path: str, sheet_name: str, header: int = 1) -> dict:
+    """
+    設定ファイルを読み込み、キーワードのマッチャーとリンクの一覧を返す
+    ファイルの更新日時が変わった場合のみ読み込み直す
+    """
+    cache_key = (file_path, sheet_name, header)
+    mtime = os.path.getmtime(file_path)
+
+    info_sites = _INFO_SITES_CACHE.get(cache_key)
+    if info_sites is not None and info_sites["mtime"] == mtime:
+        return info_sites
+
+    df = pd.read_excel(file_path, sheet_name=sheet_name, header=header)
+    df["keywords"] = df["keywords"].apply(ast.literal_eval)
+
+    info_sites = {
+        "mtime": mtime,
+        "matcher": KeywordMatcher(
+            (keyword, i) for i, keywords in enumerate(df["keywords"]) for keyword in keywords
+        ),
+        "links": list(zip(df["url"], df["title"])),
+    }
+    _INFO_SITES_CACHE[cache_key] = info_sites
+    logging.info(f"info suffix: loaded {file_path}")
+
+    return info_sites
@@ -0,0 +1,75 @@
+"""
+BLOBのサーバー側でのコピー・移動
+- start_copy_from_urlでコピーするため、BLOBのデータを関数のメモリに読み込まない
+- コンテナクライアント(同期版)を受け取る（container_instance_util.copy_blob / move_blob から共有のクライアントで呼び出す）
+- 待機はtime.sleepで行うため、非同期の処理から呼び出す場合はasyncio.to_threadで呼び出すこと
+"""
+import time
+
+from azure.core import MatchConditions
+
+
+def copy_blob(container_client,
+              source_blob_name: str,
+              destination_blob_name: str,
+              metadata: dict = None,
+              timeout: float = 300,
+              poll_interval: float = 1) -> dict:
+    """
+    start_copy_from_urlでコピーし、完了するまで待つ
+    - metadataを指定しない場合は元のBLOBのメタデータを引き継ぐ
+    - コピー先が既に存在する場合はエラー(save_to_blobのoverwrite=Falseと同じ)
+    コピー先に設定したメタデータを返す
+    """
+    source_blob_client = container_client.get_blob_client(source_blob_name)
+    destination_blob_client = container_client.get_blob_client(
+        destination_blob_name)
+
+    if metadata is None:
+        metadata = source_blob_client.get_blob_properties().metadata
+
+    copy = destination_blob_client.start_copy_from_url(
+        source_blob_client.url,
+        metadata=metadata,
+        etag="*",
+        match_condition=MatchConditions.IfMissing
+    )
+
+    # 同一アカウント内のコピーは通常すぐに完了するが、pendingの場合は完了まで待つ
+    copy_status = copy["copy_status"]
+    deadline = time.monotonic() + timeout
+    while copy_status == "pending":
+        if time.monotonic() > deadline:
+            destination_blob_client.abort_copy(copy["copy_id"])
+            raise TimeoutError(
+                f"Copying {source_blob_name} to {destination_blob_name} timed out.")
+        time.sleep(poll_interval)
+        copy_status = destination_blob_client.get_blob_properties().copy.status
+
+    if copy_status != "success":
+        raise Exception(
+            f"Failed to copy {source_blob_name} to {destination_blob_name}. Copy status:{copy_status}")
+
+    return metadata
+
+
+def move_blob(container_client,
+              source_blob_name: str,
+              destination_blob_name: str,
+              metadata: dict = None,
+              timeout: float = 300,
+              poll_interval: float = 1) -> dict:
+    """
+    コピーの完了後に元のBLOBを削除する
+    コピー先に設定したメタデータを返す
+    """
+    metadata = copy_blob(
+        container_client,
+        source_blob_name,
+        destination_blob_name,
+        metadata=metadata,
+        timeout=timeout,
+        poll_interval=poll_interval
+    )
+    container_client.get_blob_client(source_blob_name).delete_blob()
+    return metadata
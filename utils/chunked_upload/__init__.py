@@ -0,0 +1,216 @@
+"""
+大きなファイルを分割してアップロードするための処理
+- クライアントはバイナリのチャンクを順に送信し、サーバーはBlobのブロックとしてstage_blockする
+- チャンクの受信ごとにステージ済みのサイズを確認し、上限を超える場合はその時点で拒否する
+- 全チャンクの送信後にcommit_block_listでBlobを確定する（確定前のブロックは一覧・Blobトリガーに現れない）
+- アップロードの情報(セッション)はBlobにJSONで保存し、同じupload_idで再開できる
+- セッションには用途(purpose)を保存し、確定時は呼び出したAPIの用途と一致するセッションのみ受け付ける
+- 確定されなかったブロックは7日で破棄されるため、それより古いセッションは期限切れとして削除する
+  (一度も参照されないセッションのBlobは、upload-sessionsコンテナのライフサイクル管理(最終更新から7日で削除)で削除する)
+サーバーのメモリ使用量はチャンクのサイズまでに抑えられる
+"""
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobBlock
+
+from utils.clients import CLIENT_REGISTRY
+
+# 1チャンクの上限(MB)
+CHUNK_SIZE_LIMIT = int(os.environ.get("CHUNKED_UPLOAD_CHUNK_MB", 8)) * 1024 * 1024
+# チャンク数の上限（ブロックIDの桁数）
+MAX_CHUNKS = 50_000
+
+UPLOAD_SESSION_CONTAINER_NAME = os.environ.get(
+    "UPLOAD_SESSION_CONTAINER_NAME", "upload-sessions")
+
+# セッションの有効期限(秒)（確定されなかったブロックがAzureで破棄されるまでの期間）
+SESSION_TTL = 7 * 24 * 60 * 60
+
+# セッションの用途（確定するAPIごと）
+PURPOSE_UPLOAD = "upload"
+PURPOSE_WHISPER = "whisper"
+PURPOSE_AU_AUDIO_UPLOAD = "au_audio_upload"
+
+NOT_FOUND_MESSAGE = "アップロードが見つかりません。最初からアップロードしてください。"
+
+
+class ChunkedUploadError(Exception):
+    """
+    クライアントに返すエラー（messageはそのままレスポンスに使う）
+    """
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class ChunkedUploadStore:
+    """
+    分割アップロードのセッションの作成、チャンクのステージ、確定を行うクラス
+    """
+
+    def __init__(self, session_container_name: str = UPLOAD_SESSION_CONTAINER_NAME):
+        self.session_container_name = session_container_name
+
+    def create(self,
+               container_name: str,
+               blob_name: str,
+               max_size: int,
+               metadata: dict = None,
+               purpose: str = "",
+               extra: dict = None) -> dict:
+        """
+        アップロード先のBlobと上限サイズを指定してセッションを作成する
+        """
+        session = {
+            "upload_id": uuid.uuid4().hex,
+            "container_name": container_name,
+            "blob_name": blob_name,
+            "max_size": max_size,
+            "metadata": metadata or {},
+            "purpose": purpose,
+            "extra": extra or {},
+            "created_at": time.time(),
+        }
+        self._session_blob(session["upload_id"], create=True).upload_blob(
+            json.dumps(session, ensure_ascii=False).encode("utf-8"), overwrite=False)
+        logging.info(f"chunked upload: session {session['upload_id']} created for {container_name}/{blob_name}")
+        return session
+
+    def get(self, upload_id: str, expected_purpose: str = None) -> dict:
+        """
+        セッションを取得する
+        expected_purposeを指定した場合、用途が異なるセッションは見つからない場合と同じエラーにする
+        有効期限(SESSION_TTL)を過ぎたセッションは削除し、見つからない場合と同じエラーにする
+        """
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id or ""):
+            raise ChunkedUploadError(NOT_FOUND_MESSAGE, status=404)
+        try:
+            data = self._session_blob(upload_id).download_blob().readall()
+        except ResourceNotFoundError:
+            raise ChunkedUploadError(NOT_FOUND_MESSAGE, status=404)
+        session = json.loads(data)
+
+        if time.time() - float(session.get("created_at", 0)) > SESSION_TTL:
+            # ステージしたチャンクは既に破棄されている
+            self._delete_session(upload_id)
+            logging.info(f"chunked upload: session {upload_id} expired")
+            raise ChunkedUploadError(NOT_FOUND_MESSAGE, status=404)
+        if expected_purpose is not None and session.get("purpose") != expected_purpose:
+            logging.warning(
+                f"chunked upload: session {upload_id} is for {session.get('purpose')}, not {expected_purpose}")
+            raise ChunkedUploadError(NOT_FOUND_MESSAGE, status=404)
+        return session
+
+    def stage(self, upload_id: str, index: int, data: bytes, expected_purpose: str = None) -> dict:
+        """
+        index番目のチャンクをステージする（同じindexの再送は上書き）
+        ステージ済みのサイズと今回のチャンクの合計が上限を超える場合はエラー
+        """
+        session = self.get(upload_id, expected_purpose)
+        if not 0 <= index < MAX_CHUNKS:
+            raise ChunkedUploadError("チャンクの番号が不正です。")
+        if len(data) == 0:
+            raise ChunkedUploadError("チャンクが空です。")
+        if len(data) > CHUNK_SIZE_LIMIT:
+            raise ChunkedUploadError(
+                f"チャンクのサイズが大きすぎます。{CHUNK_SIZE_LIMIT // (1024 * 1024)}MB以下に分割してください。", status=413)
+
+        blob_client = self._target_blob(session)
+        block_id = self._block_id(index)
+        staged = self._staged_blocks(blob_client)
+        staged_size = sum(size for _block_id, size in staged.items() if _block_id != block_id)
+        if staged_size + len(data) > session["max_size"]:
+            raise ChunkedUploadError(
+                f"データサイズが大きすぎます。アップロードするデータサイズを{session['max_size'] // (1024 * 1024)}MB以下にしてください。", status=413)
+
+        blob_client.stage_block(block_id=block_id, data=data, length=len(data))
+        staged[block_id] = len(data)
+        return self._status(session, staged)
+
+    def status(self, upload_id: str, expected_purpose: str = None) -> dict:
+        """
+        ステージ済みのチャンク番号と合計サイズを返す（中断後の再開に使う）
+        """
+        session = self.get(upload_id, expected_purpose)
+        return self._status(session, self._staged_blocks(self._target_blob(session)))
+
+    def commit(self, upload_id: str, chunk_count: int, expected_purpose: str, metadata: dict = None) -> dict:
+        """
+        0からchunk_count-1番目のチャンクを順に結合してBlobを確定し、セッションを削除する
+        expected_purpose(確定するAPIの用途)と異なる用途のセッションは確定しない
+        metadataを指定した場合はセッション作成時のメタデータに追加する
+        """
+        session = self.get(upload_id, expected_purpose)
+        blob_client = self._target_blob(session)
+        staged = self._staged_blocks(blob_client)
+
+        block_ids = [self._block_id(index) for index in range(chunk_count)]
+        missing = [index for index, block_id in enumerate(block_ids) if block_id not in staged]
+        if chunk_count <= 0 or missing:
+            raise ChunkedUploadError(f"未送信のチャンクがあります。{missing[:10]}")
+
+        size = sum(staged[block_id] for block_id in block_ids)
+        if size > session["max_size"]:
+            raise ChunkedUploadError("データサイズが大きすぎます。", status=413)
+
+        blob_metadata = {**session["metadata"], **(metadata or {})}
+        blob_client.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in block_ids],
+            metadata=blob_metadata
+        )
+        self._delete_session(upload_id)
+        logging.info(f"chunked upload: {session['container_name']}/{session['blob_name']} committed ({size} bytes, {chunk_count} chunks)")
+        return {**session, "size": size, "metadata": blob_metadata}
+
+    ###########
+    # private #
+    ###########
+
+    @staticmethod
+    def _block_id(index: int) -> str:
+        # ブロックIDは同じBlob内で同じ長さにする必要がある
+        return f"{index:06d}"
+
+    @staticmethod
+    def _staged_blocks(blob_client) -> dict:
+        try:
+            _, uncommitted = blob_client.get_block_list(block_list_type="uncommitted")
+        except ResourceNotFoundError:
+            # まだ1つもステージしていない場合
+            return {}
+        return {block.id: block.size for block in uncommitted}
+
+    def _status(self, session: dict, staged: dict) -> dict:
+        return {
+            "upload_id": session["upload_id"],
+            "received_chunks": sorted(int(block_id) for block_id in staged),
+            "received_bytes": sum(staged.values()),
+            "max_size": session["max_size"],
+            "chunk_size_limit": CHUNK_SIZE_LIMIT,
+        }
+
+    def _target_blob(self, session: dict):
+        return CLIENT_REGISTRY.blob_container(
+            session["container_name"], create=True).get_blob_client(session["blob_name"])
+
+    def _session_blob(self, upload_id: str, create: bool = False):
+        return CLIENT_REGISTRY.blob_container(
+            self.session_container_name, create=create).get_blob_client(f"{upload_id}.json")
+
+    def _delete_session(self, upload_id: str):
+        try:
+            self._session_blob(upload_id).delete_blob()
+        except Exception as e:
+            logging.warning(f"chunked upload: failed to delete session {upload_id}. {e}")
+
+
+# プロセス全体で共有するストア
+CHUNKED_UPLOAD_STORE = ChunkedUploadStore()
@@ -0,0 +1,332 @@
+"""
+プロセス内で共有するクライアントの管理
+- ハンドラごとにクライアントを生成せず、初回利用時に生成したものを同一ワーカー内の呼び出し間で再利用する
+- aiohttpのセッション、Blob(同期/非同期)のコンテナクライアント、Cosmos DBのデータベースプロキシ、
+  Azure OpenAIの非同期クライアント(エンドポイントごと)を保持する
+"""
+import asyncio
+import logging
+import threading
+import time
+
+import aiohttp
+from azure.cosmos import CosmosClient, DatabaseProxy, ContainerProxy
+from azure.storage.blob import BlobServiceClient, ContainerClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from azure.storage.blob.aio import ContainerClient as AsyncContainerClient
+from openai import AsyncAzureOpenAI
+
+from config import BLOB_CONNECTION_STRING, COSMOS_CLIENT, BLOB_SERVICE_CLIENT
+from i_style.aiohttp import AsyncHttpClient
+
+
+class ClientRegistry:
+    """
+    プロセス全体で共有するクライアントのレジストリ
+    - 各クライアントは初回利用時に生成し、以降は同じインスタンスを返す
+    - aiohttpのセッション・Azure OpenAIのクライアントはイベントループに紐づくため、ループが変わった場合・閉じられた場合は作り直す
+    - stats()で生成・再利用の回数とプールの設定、health_check()で接続確認を行う
+    """
+
+    def __init__(self,
+                 blob_connection_string: str,
+                 cosmos_client: CosmosClient,
+                 async_blob_service_client: AsyncBlobServiceClient = None,
+                 http_pool_limit: int = 100,
+                 http_pool_limit_per_host: int = 20):
+        self._blob_connection_string = blob_connection_string
+        self._cosmos_client = cosmos_client
+        self._async_blob_service_client = async_blob_service_client
+        self._blob_service_client = None
+        self._http_pool_limit = http_pool_limit
+        self._http_pool_limit_per_host = http_pool_limit_per_host
+
+        self._http_client = None
+        self._session = None
+        self._session_loop = None
+
+        self._blob_containers: dict[str, ContainerClient] = {}
+        self._async_blob_containers: dict[str, AsyncContainerClient] = {}
+        self._ensured_containers: set[str] = set()
+        self._cosmos_databases: dict[str, DatabaseProxy] = {}
+        self._openai_clients: dict[tuple, tuple[AsyncAzureOpenAI, asyncio.AbstractEventLoop]] = {}
+
+        self._lock = threading.Lock()
+        self._created = {}
+        self._reused = {}
+        self._started_at = time.time()
+
+    ########
+    # http #
+    ########
+
+    def http_client(self) -> AsyncHttpClient:
+        """
+        各ハンドラで共有するAsyncHttpClientを取得する
+        """
+        with self._lock:
+            if self._http_client is None:
+                self._http_client = AsyncHttpClient()
+                self._count_created("http_client")
+            else:
+                self._count_reused("http_client")
+            return self._http_client
+
+    def aiohttp_session(self) -> aiohttp.ClientSession:
+        """
+        接続プールを共有するaiohttpのセッションを取得する
+        実行中のイベントループ内から呼び出すこと
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._session is None or self._session.closed or self._session_loop is not loop:
+                if self._session is not None and not self._session.closed:
+                    logging.warning("aiohttp session: イベントループが変わったため作り直します。")
+                connector = aiohttp.TCPConnector(
+                    limit=self._http_pool_limit,
+                    limit_per_host=self._http_pool_limit_per_host,
+                )
+                self._session = aiohttp.ClientSession(connector=connector)
+                self._session_loop = loop
+                self._count_created("aiohttp_session")
+            else:
+                self._count_reused("aiohttp_session")
+            return self._session
+
+    ########
+    # blob #
+    ########
+
+    def blob_service(self) -> BlobServiceClient:
+        """
+        同期版のBlobサービスクライアントを取得する
+        """
+        with self._lock:
+            return self._get_blob_service()
+
+    def blob_container(self, container_name: str, create: bool = False) -> ContainerClient:
+        """
+        同期版のBlobコンテナクライアントを取得する
+        create=Trueの場合、プロセス内で初回のみコンテナの存在確認・作成を行う
+        """
+        with self._lock:
+            container_client = self._blob_containers.get(container_name)
+            if container_client is None:
+                container_client = self._get_blob_service().get_container_client(
+                    container=container_name)
+                self._blob_containers[container_name] = container_client
+                self._count_created("blob_container")
+            else:
+                self._count_reused("blob_container")
+
+        if create and container_name not in self._ensured_containers:
+            # コンテナが存在しない場合は作成(作成競合時は無視)
+            try:
+                if not container_client.exists():
+                    container_client.create_container()
+            except Exception as e:
+                logging.debug(
+                    f"Container already exists or error creating container: {e}")
+            self._ensured_containers.add(container_name)
+
+        return container_client
+
+    def async_blob_service(self) -> AsyncBlobServiceClient:
+        """
+        非同期版のBlobサービスクライアントを取得する
+        """
+        with self._lock:
+            return self._get_async_blob_service()
+
+    def async_blob_container(self, container_name: str) -> AsyncContainerClient:
+        """
+        非同期版のBlobコンテナクライアントを取得する
+        """
+        with self._lock:
+            container_client = self._async_blob_containers.get(container_name)
+            if container_client is None:
+                container_client = self._get_async_blob_service().get_container_client(
+                    container=container_name)
+                self._async_blob_containers[container_name] = container_client
+                self._count_created("async_blob_container")
+            else:
+                self._count_reused("async_blob_container")
+            return container_client
+
+    async def ensure_async_blob_container(self, container_name: str) -> AsyncContainerClient:
+        """
+        非同期版のBlobコンテナクライアントを取得する
+        プロセス内で初回のみコンテナの存在確認・作成を行う
+        """
+        container_client = self.async_blob_container(container_name)
+
+        if container_name not in self._ensured_containers:
+            # コンテナが存在しない場合は作成(作成競合時は無視)
+            try:
+                if not await container_client.exists():
+                    await container_client.create_container()
+            except Exception as e:
+                logging.debug(
+                    f"Container already exists or error creating container: {e}")
+            self._ensured_containers.add(container_name)
+
+        return container_client
+
+    ##########
+    # cosmos #
+    ##########
+
+    def cosmos_database(self, database_name: str) -> DatabaseProxy:
+        """
+        Cosmos DBのデータベースプロキシを取得する
+        """
+        with self._lock:
+            database = self._cosmos_databases.get(database_name)
+            if database is None:
+                database = self._cosmos_client.get_database_client(database_name)
+                self._cosmos_databases[database_name] = database
+                self._count_created("cosmos_database")
+            else:
+                self._count_reused("cosmos_database")
+            return database
+
+    def cosmos_container(self, database_name: str, container_name: str) -> ContainerProxy:
+        """
+        Cosmos DBのコンテナプロキシを取得する
+        """
+        return self.cosmos_database(database_name).get_container_client(container_name)
+
+    ##########
+    # openai #
+    ##########
+
+    def async_openai(self, endpoint: str, api_key: str, api_version: str) -> AsyncAzureOpenAI:
+        """
+        エンドポイント・APIバージョンごとに共有するAzure OpenAIの非同期クライアントを取得する
+        タイムアウトなど呼び出しごとの設定は with_options で指定する（接続プールは共有される）
+        実行中のイベントループ内から呼び出すこと
+        """
+        loop = asyncio.get_running_loop()
+        key = (endpoint, api_version)
+        with self._lock:
+            client, client_loop = self._openai_clients.get(key, (None, None))
+            if client is None or client.is_closed() or client_loop is not loop or client.api_key != api_key:
+                if client is not None and not client.is_closed():
+                    logging.warning(f"openai client: {endpoint} を作り直します。")
+                client = AsyncAzureOpenAI(
+                    azure_endpoint=endpoint,
+                    api_key=api_key,
+                    api_version=api_version,
+                    max_retries=2,
+                )
+                self._openai_clients[key] = (client, loop)
+                self._count_created("openai_client")
+            else:
+                self._count_reused("openai_client")
+            return client
+
+    ###########
+    # monitor #
+    ###########
+
+    def stats(self) -> dict:
+        """
+        クライアントの生成・再利用の回数とプールの状態を返す
+        """
+        with self._lock:
+            session = self._session
+            return {
+                "uptime_sec": round(time.time() - self._started_at, 1),
+                "created": dict(self._created),
+                "reused": dict(self._reused),
+                "aiohttp_session": {
+                    "open": session is not None and not session.closed,
+                    "limit": self._http_pool_limit,
+                    "limit_per_host": self._http_pool_limit_per_host,
+                },
+                "blob_containers": sorted(self._blob_containers),
+                "async_blob_containers": sorted(self._async_blob_containers),
+                "cosmos_databases": sorted(self._cosmos_databases),
+                "openai_endpoints": sorted(endpoint for endpoint, _ in self._openai_clients),
+            }
+
+    async def health_check(self) -> dict:
+        """
+        生成済みのクライアントについて接続確認を行う
+        未生成のクライアントは確認のために生成しない
+        """
+        result = {}
+
+        if self._session is not None:
+            result["aiohttp_session"] = not self._session.closed
+
+        if self._blob_service_client is not None:
+            result["blob"] = await self._check(
+                lambda: asyncio.to_thread(self._blob_service_client.get_account_information))
+
+        if self._async_blob_service_client is not None:
+            result["async_blob"] = await self._check(
+                self._async_blob_service_client.get_account_information)
+
+        for database_name, database in list(self._cosmos_databases.items()):
+            result[f"cosmos:{database_name}"] = await self._check(
+                lambda database=database: asyncio.to_thread(database.read))
+
+        return {
+            "healthy": all(result.values()),
+            "checks": result,
+        }
+
+    async def close(self):
+        """
+        保持しているaiohttpのセッション、非同期のBlobクライアント、Azure OpenAIのクライアントを閉じる
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        for client, _ in list(self._openai_clients.values()):
+            await client.close()
+        self._openai_clients.clear()
+        if self._async_blob_service_client is not None:
+            await self._async_blob_service_client.close()
+        self._async_blob_containers.clear()
+
+    ###########
+    # private #
+    ###########
+
+    def _get_blob_service(self) -> BlobServiceClient:
+        if self._blob_service_client is None:
+            self._blob_service_client = BlobServiceClient.from_connection_string(
+                conn_str=self._blob_connection_string)
+            self._count_created("blob_service")
+        return self._blob_service_client
+
+    def _get_async_blob_service(self) -> AsyncBlobServiceClient:
+        if self._async_blob_service_client is None:
+            self._async_blob_service_client = AsyncBlobServiceClient.from_connection_string(
+                conn_str=self._blob_connection_string)
+            self._count_created("async_blob_service")
+        return self._async_blob_service_client
+
+    def _count_created(self, name: str):
+        self._created[name] = self._created.get(name, 0) + 1
+
+    def _count_reused(self, name: str):
+        self._reused[name] = self._reused.get(name, 0) + 1
+
+    @staticmethod
+    async def _check(check_func, timeout: float = 5) -> bool:
+        try:
+            await asyncio.wait_for(check_func(), timeout=timeout)
+            return True
+        except Exception as e:
+            logging.warning(f"health check error: {e}")
+            return False
+
+
+# プロセス全体で共有するレジストリ
+CLIENT_REGISTRY = ClientRegistry(
+    blob_connection_string=BLOB_CONNECTION_STRING,
+    cosmos_client=COSMOS_CLIENT,
+    async_blob_service_client=BLOB_SERVICE_CLIENT,
+)
@@ -0,0 +1,162 @@
+"""
+Azure Container Instances(whisperコンテナ)の状態をまとめて取得・保持するモジュール
+- 認証情報・ContainerInstanceManagementClientはプロセス内で1つを使い回す
+- コンテナグループの一覧を1回取得し、利用中のname_prefixを名前に含むグループのinstance viewのみ並列に取得する
+  (list_by_resource_groupの結果にはinstance viewが含まれないため、getは省略できない)
+- 一部のグループの取得に失敗した場合(更新中に削除された場合など)は、そのグループのみ"Unknown"とする
+- 取得した状態は短いTTLのスナップショットとして保持し、タイマー・HTTPトリガーの各処理で共有する
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.identity import DefaultAzureCredential
+from azure.mgmt.containerinstance import ContainerInstanceManagementClient
+
+
+class ContainerFleetState:
+    """
+    リソースグループ内のコンテナグループの状態({コンテナグループ名: 状態})のスナップショットを保持するクラス
+    - snapshot(): TTL内であれば前回の結果を返し、期限切れの場合は再取得する
+    - mark_state(): 起動・停止を行った際に、再取得を待たずにスナップショットの状態を更新する
+    """
+
+    def __init__(self,
+                 subscription_id: str,
+                 resource_group_name: str,
+                 ttl: float = 15,
+                 max_workers: int = 8):
+        self.subscription_id = subscription_id
+        self.resource_group_name = resource_group_name
+        self.ttl = ttl
+        self.max_workers = max_workers
+
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._states: dict[str, str] = {}
+        # snapshotで指定されたname_prefix（再取得ではこれらを名前に含むグループのみgetする）
+        self._prefixes: set[str] = set()
+        self._fetched_at = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "snapshot_hit": 0,
+            "refresh": 0,
+            "arm_calls": 0,
+            "fetch_errors": 0,
+            "last_refresh_seconds": None,
+            "last_refresh_groups": 0,
+        }
+
+    def client(self) -> ContainerInstanceManagementClient:
+        """
+        共有のContainerInstanceManagementClientを返す（初回のみ作成）
+        """
+        with self._client_lock:
+            if self._client is None:
+                self._client = ContainerInstanceManagementClient(
+                    DefaultAzureCredential(), self.subscription_id)
+            return self._client
+
+    def snapshot(self, name_prefix: str = "whisper", refresh: bool = False) -> dict:
+        """
+        name_prefixを名前に含むコンテナグループの{名前: 状態}を返す
+        instance viewが取得できないグループの状態は"Unknown"
+        """
+        with self._refresh_lock:
+            if name_prefix not in self._prefixes:
+                # 新しいname_prefixは前回の取得対象に含まれていないため取得し直す
+                self._prefixes.add(name_prefix)
+                refresh = True
+            if refresh or not self._is_fresh():
+                self._refresh()
+            else:
+                self._count("snapshot_hit")
+            states = dict(self._states)
+        return {name: state for name, state in states.items() if name_prefix in name}
+
+    def names_in_state(self, state: str, name_prefix: str = "whisper") -> list:
+        """
+        指定した状態のコンテナグループ名の一覧を返す
+        """
+        return [name for name, _state in self.snapshot(name_prefix).items() if _state == state]
+
+    def get_state(self, container_group_name: str) -> str:
+        """
+        1つのコンテナグループの最新の状態を取得し、スナップショットにも反映する
+        """
+        state = self._fetch_state(container_group_name)
+        self.mark_state(container_group_name, state)
+        return state
+
+    def mark_state(self, container_group_name: str, state: str):
+        """
+        スナップショット上の状態を更新する（起動・停止の直後に同じコンテナを選ばないようにする）
+        """
+        with self._refresh_lock:
+            if self._fetched_at is not None:
+                self._states[container_group_name] = state
+
+    def invalidate(self):
+        with self._refresh_lock:
+            self._fetched_at = None
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
+
+    ###########
+    # private #
+    ###########
+
+    def _is_fresh(self) -> bool:
+        return self._fetched_at is not None and time.monotonic() - self._fetched_at < self.ttl
+
+    def _refresh(self):
+        start_time = time.monotonic()
+        client = self.client()
+
+        # 一覧の取得は1回のみ
+        self._count("arm_calls")
+        names = [container_group.name for container_group in
+                 client.container_groups.list_by_resource_group(
+                     resource_group_name=self.resource_group_name)
+                 if any(prefix in container_group.name for prefix in self._prefixes)]
+
+        # 各グループのinstance viewを並列に取得
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            states = list(executor.map(self._fetch_state_or_unknown, names))
+
+        self._states = dict(zip(names, states))
+        self._fetched_at = time.monotonic()
+
+        elapsed = self._fetched_at - start_time
+        with self._stats_lock:
+            self._stats["refresh"] += 1
+            self._stats["last_refresh_seconds"] = round(elapsed, 3)
+            self._stats["last_refresh_groups"] = len(names)
+        logging.info(f"container fleet: refreshed {len(names)} container groups in {elapsed:.2f}s")
+
+    def _fetch_state(self, container_group_name: str) -> str:
+        self._count("arm_calls")
+        container = self.client().container_groups.get(
+            self.resource_group_name, container_group_name).containers[0]
+        if container.instance_view != None:
+            return container.instance_view.current_state.state
+        return "Unknown"
+
+    def _fetch_state_or_unknown(self, container_group_name: str) -> str:
+        """
+        1つのグループの取得に失敗しても、スナップショット全体は失敗させない
+        """
+        try:
+            return self._fetch_state(container_group_name)
+        except Exception as e:
+            self._count("fetch_errors")
+            logging.warning(f"container fleet: failed to get {container_group_name}. {e}")
+            return "Unknown"
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
@@ -12,10 +12,15 @@ from .authority_verification import AuthorityVerification
 class EnqAPICall:
     def __init__(self, req_json: dict, authority_verification: AuthorityVerification):
         self._req_json = req_json
-        self.authority_verification = authority_verification(
-            upn=self._req_json['upn'])
+        self._authority_verification_class = authority_verification
+        self.authority_verification = None
 
     async def call_apis(self) -> dict:
+        # 権限の確認（DBへの問い合わせはイベントループ外で行う）
+        if self.authority_verification is None:
+            self.authority_verification = await self._authority_verification_class.create(
+                upn=self._req_json['upn'])
+
         api_instances = self._get_api_instances()
         futures = [asyncio.create_task(self._call_api(
             api_instance)) for api_instance in api_instances]
@@ -1,22 +1,135 @@
 import os
+import time
+import asyncio
+import threading
 import psycopg2
+import psycopg2.pool
 import logging
 
 
+AUTHORITY_DB_PARAMS = {
+    "host": os.environ.get("AUTHORITY_DB_URL"),
+    "port": "5432",
+    "db_name": os.environ.get("AUTHORITY_DB_NAME"),
+    "schema_name": "company_spo_authority",
+    "table_name": "sites",
+    "column_name": "user_principal_name",
+    "user": "estyleuser",
+    "password": os.environ.get("AUTHORITY_DB_PASSWORD")
+}
+
+
+class AuthorityDBPool:
+    """
+    権限DB(PostgreSQL)への接続をプロセス内で使い回すためのコネクションプール
+    - 初回利用時にプールを作成する
+    - 切断済みの接続を取得した場合は破棄して1回だけ再接続する
+    """
+
+    def __init__(self, db_params: dict, minconn: int = 1, maxconn: int = 5):
+        self.db_params = db_params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+        # プールが枯渇した場合はエラーにせず空きを待つ
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def fetch_sites(self, upn: str) -> list:
+        """
+        upnに紐づくサイトの情報を取得する
+        """
+        with self._slots:
+            return self._fetch_sites(upn)
+
+    def _fetch_sites(self, upn: str) -> list:
+        for attempt in range(2):
+            pool = self._get_pool()
+            conn = pool.getconn()
+            broken = False
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f"SELECT * FROM {self.db_params['schema_name']}.{self.db_params['table_name']} WHERE {self.db_params['column_name']} = %s", (upn,))
+                    user_authority_data = cur.fetchall()
+                conn.rollback()  # 読み取りのトランザクションを終了してからプールに戻す
+                return user_authority_data
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                broken = True
+                if attempt == 0:
+                    logging.warning(f"authority db: reconnect, {e}")
+                    continue
+                raise
+            finally:
+                pool.putconn(conn, close=broken or conn.closed != 0)
+
+    def _get_pool(self) -> psycopg2.pool.ThreadedConnectionPool:
+        with self._lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.minconn,
+                    self.maxconn,
+                    dbname=self.db_params["db_name"],
+                    user=self.db_params["user"],
+                    password=self.db_params["password"],
+                    host=self.db_params["host"],
+                    port=self.db_params["port"],
+                    sslmode='require'
+                )
+            return self._pool
+
+
+class SiteMembershipCache:
+    """
+    upnごとの所属サイトの集合をTTL付きで保持するキャッシュ
+    """
+
+    def __init__(self, ttl: float = 600, max_items: int = 10_000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items: dict[str, tuple[float, frozenset]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, upn: str):
+        with self._lock:
+            item = self._items.get(upn)
+            if item is not None and time.monotonic() - item[0] < self.ttl:
+                return item[1]
+            return None
+
+    def set(self, upn: str, sites: frozenset):
+        with self._lock:
+            if len(self._items) >= self.max_items:
+                # 期限切れのものを削除し、それでも多い場合は古いものから削除
+                now = time.monotonic()
+                self._items = {key: value for key, value in self._items.items()
+                               if now - value[0] < self.ttl}
+                while len(self._items) >= self.max_items:
+                    self._items.pop(next(iter(self._items)))
+            self._items[upn] = (time.monotonic(), sites)
+
+
+# プロセス全体で共有するプール・キャッシュ
+AUTHORITY_DB_POOL = AuthorityDBPool(AUTHORITY_DB_PARAMS)
+SITE_MEMBERSHIP_CACHE = SiteMembershipCache()
+
+
 class AuthorityVerification:
-    def __init__(self, upn: str):
+    def __init__(self, upn: str, fetch: bool = True):
         self.upn = upn
-        self.authority_db_params = {
-            "host": os.environ.get("AUTHORITY_DB_URL"),
-            "port": "5432",
-            "db_name": os.environ.get("AUTHORITY_DB_NAME"),
-            "schema_name": "company_spo_authority",
-            "table_name": "sites",
-            "column_name": "user_principal_name",
-            "user": "estyleuser",
-            "password": os.environ.get("AUTHORITY_DB_PASSWORD")
-        }
-        self.user_authority_data = self._fetch_user_authority_data()
+        self.authority_db_params = AUTHORITY_DB_PARAMS
+        self.sites = frozenset()
+        if fetch:
+            self.sites = self._get_sites()
+
+    @classmethod
+    async def create(cls, upn: str) -> "AuthorityVerification":
+        """
+        DBへの問い合わせをイベントループ外で行い、インスタンスを作成する
+        """
+        authority_verification = cls(upn, fetch=False)
+        authority_verification.sites = await asyncio.to_thread(authority_verification._get_sites)
+        return authority_verification
 
     def verify_eneka_authority(self) -> bool:
         try:
@@ -67,37 +180,41 @@ class AuthorityVerification:
             logging.error(f"An unexpected error occurred: {e}")
             return False
 
-    def _fetch_user_authority_data(self) -> list:
-        conn = None
+    def _get_sites(self) -> frozenset:
+        """
+        所属サイトの集合を取得する（キャッシュにない場合はDBから取得する）
+        取得したレコードの文字列の値をすべて集合に入れ、サイト名の判定をO(1)で行えるようにする
+        """
+        sites = SITE_MEMBERSHIP_CACHE.get(self.upn)
+        if sites is not None:
+            return sites
+
+        user_authority_data = self._fetch_user_authority_data()
+        if user_authority_data is None:
+            # DBエラー時は権限なしとして扱い、次回再取得するためキャッシュしない
+            return frozenset()
+
+        sites = frozenset(value for site_data in user_authority_data
+                          for value in site_data if isinstance(value, str))
+        SITE_MEMBERSHIP_CACHE.set(self.upn, sites)
+        return sites
+
+    def _fetch_user_authority_data(self):
+        """
+        DBからupnのレコードを取得する。エラー時はNoneを返す
+        """
         try:
-            conn = psycopg2.connect(
-                dbname=self.authority_db_params["db_name"],
-                user=self.authority_db_params["user"],
-                password=self.authority_db_params["password"],
-                host=self.authority_db_params["host"],
-                port=self.authority_db_params["port"],
-                sslmode='require'
-            )
-
-            with conn.cursor() as cur:
-                cur.execute(
-                    f"SELECT * FROM {self.authority_db_params['schema_name']}.{self.authority_db_params['table_name']} WHERE {self.authority_db_params['column_name']} = %s", (self.upn,))
-                user_authority_data = cur.fetchall()
-
-            return user_authority_data
+            return AUTHORITY_DB_POOL.fetch_sites(self.upn)
 
         except psycopg2.DatabaseError as e:
             logging.error(f"Database error occurred: {e}")
-            return []
+            return None
         except KeyError as e:
             logging.error(f"Key error: {e}")
-            return []
+            return None
         except Exception as e:
             logging.error(f"An unexpected error occurred: {e}")
-            return []
-        finally:
-            if conn is not None:
-                conn.close()
+            return None
 
     def _verify_user_authority(self, company: str) -> bool:
-        return any([True for site_data in self.user_authority_data if company in site_data])
+        return company in self.sites
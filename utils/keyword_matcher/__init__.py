@@ -0,0 +1,70 @@
+"""
+複数キーワードの部分一致をまとめて判定するためのマッチャー(Aho-Corasick法)
+- 事前に全キーワードからオートマトンを構築し、入力文字列を1回走査するだけで一致したキーワードを求める
+"""
+from collections import deque
+from typing import Hashable, Iterable
+
+
+class KeywordMatcher:
+    """
+    キーワードと任意のラベル(行番号など)の組からAho-Corasickのオートマトンを構築するクラス
+    - match()は入力文字列の部分文字列として現れるキーワードのラベルの集合を返す
+    - 大文字小文字は区別しない（キーワード・入力ともにlower()して比較する）
+    - 空文字のキーワードは常に一致する（`"" in text`と同じ挙動）
+    """
+
+    def __init__(self, keywords: Iterable[tuple[str, Hashable]]):
+        # ノードごとの遷移・失敗遷移・出力(ラベル)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[set] = [set()]
+
+        for keyword, label in keywords:
+            self._add(keyword.lower(), label)
+        self._build()
+
+    def match(self, text: str) -> set:
+        """
+        textに含まれるキーワードのラベルの集合を返す
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+
+        labels = set(output[0])
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                labels |= output[state]
+        return labels
+
+    def _add(self, keyword: str, label: Hashable):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+            state = next_state
+        self._output[state].add(label)
+
+    def _build(self):
+        """
+        幅優先で失敗遷移を設定し、失敗遷移先の出力を各ノードの出力にまとめる
+        """
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail_state = self._fail[state]
+                while fail_state and char not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                self._fail[next_state] = self._goto[fail_state].get(char, 0)
+                self._output[next_state] |= self._output[self._fail[next_state]]
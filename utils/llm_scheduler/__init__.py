@@ -0,0 +1,227 @@
+"""
+複数ファイル×複数プロンプトのLLM呼び出しをまとめて実行するスケジューラー
+- 1回のリクエスト(バッチ)のすべての呼び出しを1つの待ち行列に入れ、限られた数のワーカーで順に実行する
+- モデル(デプロイ)ごとの同時実行数の上限はプロセス全体で共有し、複数のリクエストが重なっても上限を超えない
+- 結果は呼び出しを登録した順番で返すため、呼び出し元はファイルごとの並び順をそのまま組み立てられる
+- バッチごとの処理時間と待ち行列での待ち時間をログに出力し、集計する
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Awaitable, Callable
+
+from config import NON_CHAT_MAX_CONCURRENCY
+
+
+class LLMScheduler:
+    """
+    LLM呼び出しをモデルごとの同時実行数の上限内で実行するクラス
+    - run(jobs, name): jobs [(model_name, 呼び出し処理)] を実行し、jobsと同じ順番で結果を返す
+    - run_groups(groups, handler, name): ファイルごとのjobsを1つのバッチとして実行し、ファイルの呼び出しが終わり次第handlerを開始する
+    - stats(): バッチ数、待ち時間・処理時間、直近のバッチの結果を返す
+    """
+
+    def __init__(self, max_concurrency: dict[str, int], default_concurrency: int = 4):
+        self.max_concurrency = max_concurrency
+        self.default_concurrency = default_concurrency
+
+        self._loop = None
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "jobs": 0,
+            "failed": 0,
+            "queued": 0,
+            "inflight": 0,
+            "wall_sum": 0.0,
+            "wall_max": 0.0,
+            "wait_sum": 0.0,
+            "wait_max": 0.0,
+        }
+        self._last_batch = None
+
+    async def run(self,
+                  jobs: list[tuple[str, Callable[[], Awaitable]]],
+                  name: str = "batch",
+                  return_exceptions: bool = False) -> list:
+        """
+        jobsの呼び出し処理を実行し、jobsと同じ順番で結果を返す
+        呼び出し処理は引数なしで呼び出せるもの(lambdaなど)を渡す（待ち行列で順番が来てから呼び出す）
+        return_exceptions=Trueの場合は例外も結果として返す(asyncio.gatherと同じ)
+        Falseの場合はすべての呼び出しが終わった後に最初の例外を送出する
+        """
+        results = await self._run(jobs, name)
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    async def run_groups(self,
+                         groups: list[list[tuple[str, Callable[[], Awaitable]]]],
+                         handler: Callable[[int, list], Awaitable],
+                         name: str = "batch",
+                         return_exceptions: bool = False) -> list:
+        """
+        groups(ファイルごとのjobsのリスト)を1つのバッチとして実行する
+        グループのすべての呼び出しが終わった時点でhandler(グループの番号, 結果のリスト)を開始し、
+        前のファイルの後処理(Excelの生成など)と次のファイルの呼び出しを重ねる
+        handlerの戻り値をgroupsと同じ順番で返す
+        return_exceptions=Falseの場合、例外を含むグループのhandlerは呼び出さず、最後に最初の例外を送出する
+        """
+        jobs = [job for group in groups for job in group]
+        owners = [group_index for group_index, group in enumerate(groups) for _ in group]
+        offsets = []
+        offset = 0
+        for group in groups:
+            offsets.append(offset)
+            offset += len(group)
+        remaining = [len(group) for group in groups]
+        handler_tasks = [None] * len(groups)
+        errors = []
+
+        def start(group_index: int, results: list):
+            group_results = results[offsets[group_index]:offsets[group_index] + len(groups[group_index])]
+            error = next((result for result in group_results if isinstance(result, Exception)), None)
+            if error is not None and not return_exceptions:
+                errors.append(error)
+                return
+            handler_tasks[group_index] = asyncio.create_task(handler(group_index, group_results))
+
+        def on_done(index: int, results: list):
+            group_index = owners[index]
+            remaining[group_index] -= 1
+            if remaining[group_index] == 0:
+                start(group_index, results)
+
+        try:
+            results = await self._run(jobs, name, on_done)
+            # 呼び出しのないグループ
+            for group_index, group in enumerate(groups):
+                if not group:
+                    start(group_index, results)
+            if errors:
+                raise errors[0]
+            return await asyncio.gather(*handler_tasks)
+        finally:
+            for task in handler_tasks:
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            last_batch = self._last_batch
+        batches = stats["batches"] or 1
+        jobs = stats["jobs"] or 1
+        stats["wall_avg"] = round(stats.pop("wall_sum") / batches, 3)
+        stats["wall_max"] = round(stats["wall_max"], 3)
+        stats["wait_avg"] = round(stats.pop("wait_sum") / jobs, 3)
+        stats["wait_max"] = round(stats["wait_max"], 3)
+        stats["last_batch"] = last_batch
+        return stats
+
+    ###########
+    # private #
+    ###########
+
+    async def _run(self, jobs: list, name: str, on_done: Callable[[int, list], None] = None) -> list:
+        """
+        jobsを実行し、例外を含む結果をjobsと同じ順番で返す
+        on_done(index, results)は各呼び出しの終了時に呼び出す
+        """
+        if not jobs:
+            return []
+
+        started_at = time.monotonic()
+        results = [None] * len(jobs)
+        waits = [0.0] * len(jobs)
+        queue = asyncio.Queue()
+        for index, (model_name, call) in enumerate(jobs):
+            queue.put_nowait((index, model_name, call))
+        self._update("queued", len(jobs))
+
+        # ワーカー数はバッチで使うモデルの上限の合計まで（それ以上は待ち行列で待つ）
+        models = {model_name for model_name, _ in jobs}
+        workers = min(len(jobs), sum(self._limit(model_name) for model_name in models))
+        try:
+            await asyncio.gather(*(self._work(queue, results, waits, started_at, on_done) for _ in range(workers)))
+        finally:
+            # キャンセルされた場合に残った待ち行列の分
+            self._update("queued", -queue.qsize())
+
+        wall = time.monotonic() - started_at
+        failed = sum(isinstance(result, Exception) for result in results)
+        self._record(name, len(jobs), failed, wall, waits, models)
+        return results
+
+    def _limit(self, model_name: str) -> int:
+        return max(1, self.max_concurrency.get(model_name, self.default_concurrency))
+
+    def _semaphore(self, model_name: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphores = {}
+            self._loop = loop
+        semaphore = self._semaphores.get(model_name)
+        if semaphore is None:
+            semaphore = self._semaphores[model_name] = asyncio.Semaphore(self._limit(model_name))
+        return semaphore
+
+    async def _work(self, queue: asyncio.Queue, results: list, waits: list, started_at: float, on_done=None):
+        while True:
+            try:
+                index, model_name, call = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = False
+            try:
+                async with self._semaphore(model_name):
+                    waits[index] = time.monotonic() - started_at
+                    started = True
+                    self._update("queued", -1)
+                    self._update("inflight", 1)
+                    try:
+                        results[index] = await call()
+                    except Exception as e:
+                        results[index] = e
+                    finally:
+                        self._update("inflight", -1)
+            finally:
+                if not started:
+                    self._update("queued", -1)
+            if on_done is not None:
+                on_done(index, results)
+
+    def _update(self, name: str, value: int):
+        with self._lock:
+            self._stats[name] += value
+
+    def _record(self, name: str, jobs: int, failed: int, wall: float, waits: list, models: set):
+        wait_avg = sum(waits) / len(waits)
+        wait_max = max(waits)
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["jobs"] += jobs
+            self._stats["failed"] += failed
+            self._stats["wall_sum"] += wall
+            self._stats["wall_max"] = max(self._stats["wall_max"], wall)
+            self._stats["wait_sum"] += sum(waits)
+            self._stats["wait_max"] = max(self._stats["wait_max"], wait_max)
+            self._last_batch = {
+                "name": name,
+                "jobs": jobs,
+                "failed": failed,
+                "wall": round(wall, 3),
+                "wait_avg": round(wait_avg, 3),
+                "wait_max": round(wait_max, 3),
+            }
+        logging.info(
+            f"llm scheduler: {name} {jobs} jobs ({', '.join(sorted(models))}), failed {failed}, "
+            f"wall {wall:.2f}s, queue wait avg {wait_avg:.2f}s max {wait_max:.2f}s")
+
+
+# NON_CHAT_REGISTRYのモデルの呼び出し(OCR業務パターン・議事録)で共有するスケジューラー
+OCR_LLM_SCHEDULER = LLMScheduler(NON_CHAT_MAX_CONCURRENCY)
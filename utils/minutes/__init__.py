@@ -0,0 +1,248 @@
+"""
+長い文字起こしからの議事録の作成
+- 文字起こしは最初に1回だけトークン数で分割し、チャンク(改行・「。」で区切る)の計画を作成する
+- map_reduce: チャンクごとの議事録を並列に作成し(同時実行数はLLMSchedulerで制限)、最後に1つの議事録に統合する
+  統合する議事録が1回の入力に収まらない場合は、収まる単位でまとめて統合することを繰り返す
+- refine: 従来どおり、前のチャンクまでの議事録を踏まえてチャンクごとに順に作成し直す
+- 文字起こし全体が1回の入力に収まる場合は、どちらのモードもLLMを1回だけ呼び出す
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from functools import partial
+
+from config import NON_CHAT_REGISTRY, MINUTES_MODE, MINUTES_MAP_CHUNK_TOKENS
+from i_style.llm import AzureOpenAI
+from utils.llm_scheduler import LLMScheduler, OCR_LLM_SCHEDULER
+from utils.token_budget import TOKEN_BUDGET
+
+MODE_MAP_REDUCE = "map_reduce"
+MODE_REFINE = "refine"
+MODES = (MODE_MAP_REDUCE, MODE_REFINE)
+
+
+@dataclass
+class MinutesPrompts:
+    """
+    議事録の作成に使うプロンプト
+    - system: 1回で作成する場合・refineで使うシステムプロンプト
+    - map_system: チャンクごとの議事録のシステムプロンプト（{index}, {total}を置換する）
+    - reduce_system: 議事録を統合するシステムプロンプト
+    - refine_prefix: refineで2つ目以降のチャンクの先頭に付ける文
+    """
+    system: str
+    map_system: str
+    reduce_system: str
+    refine_prefix: str
+
+
+class MinutesEngine:
+    """
+    文字起こしから議事録を作成するクラス
+    - plan(transcript, budget, model_name): チャンクの計画 [(開始位置, 終了位置, トークン数)]
+    - create(transcript, prompts, model_name, mode): 議事録を作成し、最後のLLMの応答を返す
+    - stats(): モードごとの実行回数、処理時間、直近の実行の結果を返す
+    """
+
+    def __init__(self,
+                 scheduler: LLMScheduler,
+                 map_chunk_tokens: int,
+                 default_mode: str = MODE_MAP_REDUCE,
+                 reserve_tokens: int = 8_000,
+                 registry=NON_CHAT_REGISTRY):
+        self.scheduler = scheduler
+        self.map_chunk_tokens = map_chunk_tokens
+        self.default_mode = default_mode if default_mode in MODES else MODE_MAP_REDUCE
+        # refineで前のチャンクまでの議事録のために残しておくトークン数
+        self.reserve_tokens = reserve_tokens
+        self.registry = registry
+
+        self._lock = threading.Lock()
+        self._stats = {mode: {"runs": 0, "calls": 0, "wall_sum": 0.0, "wall_max": 0.0} for mode in MODES}
+        self._last_run = None
+
+    def plan(self, transcript: str, budget: int, model_name: str) -> list:
+        """
+        文字起こしをbudgetトークン以下のチャンクに分割する
+        """
+        return TOKEN_BUDGET.split(transcript, max(budget, 1), model_name)
+
+    async def create(self, transcript: str, prompts: MinutesPrompts, model_name: str, mode: str = None) -> dict:
+        """
+        議事録を作成し、最後のLLMの応答(AzureOpenAIの応答)を返す
+        modeを指定しない場合・不明なmodeの場合はdefault_modeで作成する
+        """
+        if mode not in MODES:
+            if mode is not None:
+                logging.warning(f"minutes: unknown mode {mode}, use {self.default_mode}")
+            mode = self.default_mode
+
+        started_at = time.monotonic()
+        max_tokens = self.registry.models[model_name].max_tokens
+        # 入力のトークン数の上限（出力の分を除く）
+        budget = max_tokens["input"] - max_tokens["output"] - 1
+        system_tokens = TOKEN_BUDGET.count(prompts.system, model_name)
+
+        if not TOKEN_BUDGET.exceeds([prompts.system, transcript], budget, model_name):
+            chunks = [(0, len(transcript), None)]
+            response = await self._complete(
+                model_name, prompts.system, transcript, raise_for_error=False)
+            calls = 1
+        elif mode == MODE_REFINE:
+            prefix_tokens = TOKEN_BUDGET.count(prompts.refine_prefix, model_name)
+            chunks = self.plan(
+                transcript, budget - system_tokens - prefix_tokens - self.reserve_tokens, model_name)
+            response, calls = await self._refine(transcript, chunks, prompts, model_name, budget)
+        else:
+            map_tokens = TOKEN_BUDGET.count(prompts.map_system, model_name)
+            chunks = self.plan(
+                transcript, min(self.map_chunk_tokens, budget - map_tokens), model_name)
+            response, calls = await self._map_reduce(transcript, chunks, prompts, model_name, budget)
+
+        self._record(mode, len(transcript), len(chunks), calls, time.monotonic() - started_at)
+        return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {mode: dict(values) for mode, values in self._stats.items()}
+            last_run = self._last_run
+        for values in stats.values():
+            runs = values["runs"] or 1
+            values["wall_avg"] = round(values.pop("wall_sum") / runs, 3)
+            values["wall_max"] = round(values["wall_max"], 3)
+        stats["default_mode"] = self.default_mode
+        stats["last_run"] = last_run
+        return stats
+
+    ###########
+    # private #
+    ###########
+
+    async def _complete(self, model_name: str, system_content: str, user_content: str,
+                        assistant_content: str = None, raise_for_error: bool = True) -> dict:
+        messages = [{"role": "system", "content": system_content}]
+        if assistant_content is not None:
+            messages.append({"role": "assistant", "content": assistant_content})
+        messages.append({"role": "user", "content": user_content})
+        return await AzureOpenAI(
+            messages,
+            temperature=0,
+            model_name=model_name,
+            max_retries=2,
+            timeout=230,
+            raise_for_error=raise_for_error,
+            registry=self.registry
+        )
+
+    async def _refine(self, transcript: str, chunks: list, prompts: MinutesPrompts,
+                      model_name: str, budget: int) -> tuple:
+        """
+        チャンクごとに順に議事録を作成し直す
+        前の議事録が長くチャンクが入力に収まらない場合は、そのチャンクを収まる長さに分割し直す
+        """
+        pending = [(start, end) for start, end, _ in chunks]
+        response = None
+        response_content = None
+        calls = 0
+        while pending:
+            start, end = pending.pop(0)
+            text = transcript[start:end]
+            if response_content is None:
+                user_content = text
+            else:
+                user_content = prompts.refine_prefix + text
+                contents = [prompts.system, response_content, user_content]
+                if TOKEN_BUDGET.exceeds(contents, budget, model_name):
+                    available = budget - TOKEN_BUDGET.count(
+                        prompts.system + response_content + prompts.refine_prefix, model_name)
+                    if available <= 0:
+                        raise ValueError("minutes: previous minutes exceed the input budget")
+                    pieces = self.plan(text, available, model_name)
+                    logging.warning(f"minutes: re-split chunk {start}-{end} into {len(pieces)}")
+                    pending[:0] = [(start + piece_start, start + piece_end) for piece_start, piece_end, _ in pieces]
+                    continue
+
+            response = await self._complete(
+                model_name, prompts.system, user_content, response_content, raise_for_error=False)
+            calls += 1
+            response_content = response["choices"][0]["message"]["content"]
+            logging.info(f"minutes refine: {calls}, chars {start}-{end}")
+        return response, calls
+
+    async def _map_reduce(self, transcript: str, chunks: list, prompts: MinutesPrompts,
+                          model_name: str, budget: int) -> tuple:
+        """
+        チャンクごとの議事録を並列に作成し、1つに統合する
+        """
+        jobs = [
+            (model_name, partial(
+                self._complete, model_name,
+                prompts.map_system.format(index=index, total=len(chunks)),
+                transcript[start:end]))
+            for index, (start, end, _) in enumerate(chunks, start=1)
+        ]
+        responses = await self.scheduler.run(jobs, name="minutes map")
+        partials = [response["choices"][0]["message"]["content"] for response in responses]
+        calls = len(jobs)
+
+        reduce_tokens = TOKEN_BUDGET.count(prompts.reduce_system, model_name)
+        while True:
+            groups = self._group(partials, budget - reduce_tokens, model_name)
+            if len(partials) > 1 and len(groups) == len(partials):
+                raise ValueError("minutes: partial minutes exceed the input budget")
+            jobs = [
+                (model_name, partial(
+                    self._complete, model_name, prompts.reduce_system, self._join(partials[first:last])))
+                for first, last in groups
+            ]
+            responses = await self.scheduler.run(jobs, name="minutes reduce")
+            calls += len(jobs)
+            if len(responses) == 1:
+                return responses[0], calls
+            partials = [response["choices"][0]["message"]["content"] for response in responses]
+            logging.info(f"minutes reduce: {len(partials)} partial minutes remain")
+
+    @staticmethod
+    def _join(partials: list) -> str:
+        return "\n\n".join(
+            f"## 議事録 {index}/{len(partials)}\n{content}" for index, content in enumerate(partials, start=1))
+
+    def _group(self, partials: list, budget: int, model_name: str) -> list:
+        """
+        議事録を先頭から順に、1回の入力(budget)に収まる単位にまとめる [(最初, 最後+1)]
+        """
+        # 見出しの分を含めて数える
+        tokens = [TOKEN_BUDGET.count(f"## 議事録 {len(partials)}/{len(partials)}\n{content}\n\n", model_name)
+                  for content in partials]
+        groups = []
+        first = 0
+        total = 0
+        for index, count in enumerate(tokens):
+            if index > first and total + count > budget:
+                groups.append((first, index))
+                first = index
+                total = 0
+            total += count
+        groups.append((first, len(partials)))
+        return groups
+
+    def _record(self, mode: str, chars: int, chunks: int, calls: int, wall: float):
+        with self._lock:
+            stats = self._stats[mode]
+            stats["runs"] += 1
+            stats["calls"] += calls
+            stats["wall_sum"] += wall
+            stats["wall_max"] = max(stats["wall_max"], wall)
+            self._last_run = {
+                "mode": mode,
+                "chars": chars,
+                "chunks": chunks,
+                "calls": calls,
+                "wall": round(wall, 3),
+            }
+        logging.info(f"minutes: {mode} {chars} chars, {chunks} chunks, {calls} calls, wall {wall:.2f}s")
+
+
+# プロセス全体で共有する議事録の作成
+MINUTES_ENGINE = MinutesEngine(OCR_LLM_SCHEDULER, MINUTES_MAP_CHUNK_TOKENS, MINUTES_MODE)
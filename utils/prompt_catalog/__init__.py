@@ -0,0 +1,334 @@
+"""
+プロンプト集(Excel)の読み込み結果と検索用の索引
+- プロンプト集のディレクトリを読み込んだ結果をプロセス内に保持し、リクエストごとにExcelを読み込まない
+- ファイルの更新日時・サイズが変わった場合は内容のハッシュを比較し、変わったファイルのみ読み込み直す
+- タイトルとプロンプトの1文字・2文字の索引(n-gram)で候補を絞り、部分一致(query in ...)で確認する
+- お気に入りは索引には含めず、検索結果を返すときに付与する
+"""
+import hashlib
+import io
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import pandas as pd
+
+# 並び順の優先度
+ORDER_LABELS = ["全社", "繊維", "金属", "食料", "機械", "エネ化", "住生活", "情金", "第8"]
+# 絞り込みを行わないクエリ
+EMPTY_QUERIES = ("", " ", "　")
+
+
+class PromptCatalog:
+    """
+    プロンプト集のディレクトリを読み込み、カテゴリごとのプロンプトと索引を保持するクラス
+    - search(query, favorite_list): process_promptと同じ形式でカテゴリごとのプロンプトを返す
+    - sample(category, k): カテゴリからランダムにk個のプロンプトを返す
+    - refresh(): ファイルの変更を確認し、変わっていれば読み込み直す
+    """
+
+    def __init__(self, prompt_dir: str, check_interval: float = 30, order_labels: list = ORDER_LABELS):
+        self.prompt_dir = prompt_dir
+        self.check_interval = check_interval
+        self.order_priority = {label: idx for idx, label in enumerate(order_labels)}
+
+        # ファイル名ごとの読み込み結果 {file_name: {"stat", "digest", "category", "prompts"}}
+        self._files = {}
+        # 検索に使う読み込み結果(リクエスト中に差し替わっても同じものを使う)
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {
+            "builds": 0,
+            "files_loaded": 0,
+            "files_unchanged": 0,
+            "searches": 0,
+            "build_ms": 0.0,
+        }
+
+    def search(self, query: str = "", favorite_list: list = ()) -> list:
+        """
+        queryをタイトルまたはプロンプトに含むプロンプトをカテゴリごとに返す
+        各プロンプトはリクエストごとに作成し、お気に入りの場合はfavoriteを1にする
+        """
+        snapshot = self._get_snapshot()
+        favorite_set = set(favorite_list)
+        with self._lock:
+            self._stats["searches"] += 1
+
+        matched = None
+        if query not in EMPTY_QUERIES:
+            matched = self._match(snapshot, query)
+
+        result_list = []
+        for category, prompt_list in snapshot["categories"]:
+            adjusted_list = [
+                {**prompt, "favorite": 1 if prompt["id"] in favorite_set else 0}
+                for number, prompt in prompt_list
+                if matched is None or number in matched
+            ]
+            if adjusted_list:
+                result_list.append({
+                    "category": category,
+                    "prompt_list": adjusted_list
+                })
+        return result_list
+
+    def sample(self, category: str, k: int, rng=random) -> list:
+        """
+        カテゴリからランダムにk個（k個以下の場合はすべて）のプロンプトを返す
+        各プロンプトにはfavorite(0)とcategoryを付与する
+        """
+        snapshot = self._get_snapshot()
+        prompt_list = []
+        for name, _prompt_list in snapshot["categories"]:
+            if name == category:
+                prompt_list += [prompt for _, prompt in _prompt_list]
+        if len(prompt_list) > k:
+            prompt_list = rng.sample(prompt_list, k)
+        return [{**prompt, "favorite": 0, "category": category} for prompt in prompt_list]
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        ファイルの変更を確認し、変わっていれば読み込み直す
+        読み込み直した場合はTrueを返す
+        """
+        with self._lock:
+            if not force and self._snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return False
+            started_at = time.perf_counter()
+            changed = self._scan() or self._snapshot is None
+            if changed:
+                self._snapshot = self._build()
+                self._stats["builds"] += 1
+                self._stats["build_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+                logging.info(f"prompt catalog: built {self._snapshot['size']} prompts in {self._stats['build_ms']}ms")
+            self._checked_at = time.monotonic()
+            return changed
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot = self._snapshot
+            return {
+                **self._stats,
+                "files": len(self._files),
+                "prompts": snapshot["size"] if snapshot else 0,
+                "grams": len(snapshot["index"]) if snapshot else 0,
+            }
+
+    ###########
+    # private #
+    ###########
+
+    def _get_snapshot(self) -> dict:
+        self.refresh()
+        return self._snapshot
+
+    def _scan(self) -> bool:
+        """
+        ディレクトリの各ファイルを確認し、変わったファイルのみ読み込む
+        追加・削除・内容の変更があった場合はTrueを返す
+        """
+        try:
+            file_names = [
+                f for f in os.listdir(self.prompt_dir) if f.endswith(".xlsx") and not f.startswith("~$")
+            ]
+        except FileNotFoundError:
+            logging.warning(f"prompt directory not found: {self.prompt_dir}")
+            file_names = []
+
+        changed = set(self._files) != set(file_names)
+        files = {}
+        for file_name in file_names:
+            file_path = os.path.join(self.prompt_dir, file_name)
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                changed = True
+                continue
+            stat_key = (stat.st_mtime_ns, stat.st_size)
+
+            loaded = self._files.get(file_name)
+            if loaded is not None and loaded["stat"] == stat_key:
+                files[file_name] = loaded
+                continue
+
+            try:
+                with open(file_path, "rb") as f:
+                    content = f.read()
+            except OSError as e:
+                logging.warning(f"prompt load failed: {file_path}, error: {e}")
+                changed = True
+                continue
+            digest = hashlib.sha256(content).hexdigest()
+
+            # 更新日時のみ変わった場合（デプロイし直した場合など）は読み込み直さない
+            if loaded is not None and loaded["digest"] == digest:
+                files[file_name] = {**loaded, "stat": stat_key}
+                self._stats["files_unchanged"] += 1
+                continue
+
+            category = _parse_category_name(file_name)
+            files[file_name] = {
+                "stat": stat_key,
+                "digest": digest,
+                "category": category,
+                "prompts": _load_prompts(content, file_path, category),
+            }
+            self._stats["files_loaded"] += 1
+            changed = True
+
+        # listdirと同じ順番で保持する
+        self._files = files
+        return changed
+
+    def _build(self) -> dict:
+        """
+        カテゴリの並べ替えと索引の作成を行う
+        """
+        categories = [
+            (loaded["category"], loaded["prompts"]) for loaded in self._files.values() if loaded["prompts"]
+        ]
+        categories.sort(key=lambda item: self.order_priority.get(item[0], len(self.order_priority)))
+
+        index = {}
+        numbered_categories = []
+        number = 0
+        for category, prompts in categories:
+            numbered = []
+            for prompt in prompts:
+                for gram in _grams(prompt["title"]) | _grams(prompt["prompt"]):
+                    index.setdefault(gram, set()).add(number)
+                numbered.append((number, prompt))
+                number += 1
+            # 並べ替え後にカテゴリ名へサフィックスを付与（全社以外）
+            if category and category != "全社":
+                category = f"{category}Co"
+            numbered_categories.append((category, numbered))
+
+        return {
+            "categories": numbered_categories,
+            "prompts": [prompt for _, numbered in numbered_categories for _, prompt in numbered],
+            "index": index,
+            "size": number,
+        }
+
+    @staticmethod
+    def _match(snapshot: dict, query: str) -> set:
+        """
+        queryをタイトルまたはプロンプトに含むプロンプトの番号の集合を返す
+        """
+        index = snapshot["index"]
+        grams = [query] if len(query) == 1 else {query[i:i + 2] for i in range(len(query) - 1)}
+
+        candidates = None
+        for postings in sorted((index.get(gram, set()) for gram in grams), key=len):
+            candidates = postings if candidates is None else candidates & postings
+            if not candidates:
+                return set()
+
+        prompts = snapshot["prompts"]
+        return {
+            number for number in candidates
+            if query in prompts[number]["title"] or query in prompts[number]["prompt"]
+        }
+
+
+def _grams(text: str) -> set:
+    """
+    1文字と2文字の部分文字列の集合
+    """
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _safe_int(value, default=1000):
+    """値を安全に整数に変換する"""
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def _parse_category_name(file_name: str) -> str:
+    base_name, _ = os.path.splitext(file_name)
+    base_name = base_name.strip()
+    match = re.search(r"【([^】]+)】", base_name)
+    if match:
+        label = match.group(1).strip()
+        return label
+    return base_name
+
+
+def _load_prompts(content: bytes, file_path: str, category: str) -> list:
+    """Excelからプロンプトを読み込み、プロンプトのリストを返す"""
+    try:
+        # ヘッダーは2行目を使用する（Excel上で2行目が列名）
+        df = pd.read_excel(io.BytesIO(content), header=1)
+    except Exception as e:
+        logging.warning(f"prompt load failed: {file_path}, error: {e}")
+        return []
+
+    if df is None or df.empty:
+        return []
+
+    # 列名の正規化
+    rename_map = {}
+    for col in df.columns:
+        col_str = str(col).strip()
+        lower = col_str.lower()
+        if col_str in {"#", "＃"} or lower in {"no", "id"}:
+            rename_map[col] = "id"
+        elif "title" in lower:
+            rename_map[col] = "title"
+        elif "prompt" in lower:
+            rename_map[col] = "prompt"
+
+    df = df.rename(columns=rename_map)
+
+    # 必須列の確認
+    required_columns = {"title", "prompt"}
+    if not required_columns.issubset(set(df.columns)):
+        logging.warning(f"prompt load skipped: {file_path}, missing columns: {required_columns - set(df.columns)}")
+        return []
+
+    # 列名が重複する場合は1列目を使う
+    records = df.loc[:, ~df.columns.duplicated()].to_dict("records")
+
+    prompt_list = []
+    for idx, row in enumerate(records, start=1):
+        raw_title = row.get("title")
+        raw_prompt = row.get("prompt")
+
+        # NaN/None/空白はスキップ
+        if pd.isna(raw_title) or pd.isna(raw_prompt):
+            continue
+
+        title = str(raw_title).strip()
+        prompt_text = str(raw_prompt).strip()
+
+        # タイトルまたはプロンプトが空の行はスキップ
+        if not title or not prompt_text:
+            continue
+
+        # サンプル行（"(例)"を含むタイトル）はスキップ
+        if "(例)" in title:
+            continue
+
+        prompt_id = _safe_int(row.get("id"), default=idx)
+
+        prompt_list.append({
+            "id": f"{category}_{prompt_id}",
+            "title": title,
+            "prompt": prompt_text,
+        })
+
+    return prompt_list
+
+
+# プロセス全体で共有するプロンプト集
+PROMPT_CATALOG = PromptCatalog("data/プロンプト集")
@@ -0,0 +1,92 @@
+"""
+文字起こしの繰り返し(ハルシネーション)を除去するための処理
+- 正規表現の(.*?)\1+ や ((.+?)\2{2,}) と同じ規則で、先頭から最短の周期の繰り返しを探して置換する
+- 周期の候補は「同じ文字が次に現れる位置」のみをたどり、周期はmax_period以下に制限する
+  (1文字あたりの比較はmax_period回以下のため、テキストの長さに対して線形の時間で終わる)
+- 正規表現の.と同じく、改行を含む繰り返しは対象にしない
+"""
+
+# 繰り返しとみなす周期(文字数)の上限
+MAX_PERIOD = 200
+# 変化がなくなるまで繰り返す場合の走査回数の上限
+MAX_PASSES = 20
+
+
+def collapse_repeats(text: str,
+                     min_repeat: int = 2,
+                     keep: int = 1,
+                     max_period: int = MAX_PERIOD,
+                     until_stable: bool = True,
+                     max_passes: int = MAX_PASSES) -> str:
+    """
+    min_repeat回以上連続する繰り返しを、繰り返しの単位keep個分に置き換える
+    - 各位置で最短の周期の繰り返しを選び、繰り返しの回数は最大まで伸ばす（正規表現の最短一致・最長一致と同じ）
+    - until_stable=Trueの場合は変化がなくなるまで繰り返す（最大max_passes回）
+
+    remove_repeated_phrases: collapse_repeats(text)  # (.*?)\1+ を\1に置換
+    remove_repeated_words: collapse_repeats(text, min_repeat=3, keep=0, until_stable=False)  # ((.+?)\2{2,}) を削除
+    """
+    for _ in range(max_passes if until_stable else 1):
+        new_text = _collapse_once(text, min_repeat, keep, max_period)
+        if new_text == text:
+            break
+        text = new_text
+    return text
+
+
+def _collapse_once(text: str, min_repeat: int, keep: int, max_period: int) -> str:
+    """
+    先頭から1回走査して繰り返しを置換する
+    """
+    n = len(text)
+    if n < min_repeat:
+        return text
+
+    # 各位置の文字が次に現れる位置と、各位置以降で最初の改行の位置
+    next_same = [n] * n
+    next_newline = [n] * n
+    last_seen = {}
+    newline = n
+    for i in range(n - 1, -1, -1):
+        char = text[i]
+        next_same[i] = last_seen.get(char, n)
+        last_seen[char] = i
+        if char == "\n":
+            newline = i
+        next_newline[i] = newline
+
+    pieces = []
+    last = 0
+    p = 0
+    while p < n:
+        # 改行を含まない範囲で、min_repeat個分の繰り返しが収まる周期のみが候補
+        limit = next_newline[p] - p
+        max_length = min(max_period, limit // min_repeat)
+        q = next_same[p]
+        period = 0
+        while q - p <= max_length:
+            length = q - p
+            # 周期lengthでmin_repeat回繰り返す ⇔ ずらした範囲が一致する
+            if text[p:p + (min_repeat - 1) * length] == text[q:q + (min_repeat - 1) * length]:
+                period = length
+                break
+            q = next_same[q]
+
+        if not period:
+            p += 1
+            continue
+
+        # 繰り返しの回数を最大まで伸ばす
+        unit = text[p:p + period]
+        end = p + min_repeat * period
+        while text.startswith(unit, end):
+            end += period
+
+        pieces.append(text[last:p])
+        pieces.append(unit * keep)
+        last = p = end
+
+    if last == 0:
+        return text
+    pieces.append(text[last:])
+    return "".join(pieces)
@@ -0,0 +1,198 @@
+"""
+LLMの回答をストリーミングで返すための共通処理
+- stream_chat_completion: モデルの回答を差分(テキスト)ごとに返す
+- CodeFenceStripper: genieで行っている```html のコードブロック除去を差分ごとに行う
+- StreamMetrics: 最初のトークンまでの時間(TTFT)・全体の時間を集計する
+"""
+import json
+import logging
+import re
+import threading
+from typing import AsyncIterator
+
+from config import LLM_REGISTRY, GPT_API_VERSION
+from i_style.llm import AzureOpenAI, ClaudeGenerate
+from utils.clients import CLIENT_REGISTRY
+
+# genieで回答から除去するコードブロックのパターン（genieの非ストリーミングの処理と同じ）
+CODE_FENCE_PATTERN = re.compile(r"```([a-zA-Z0-9]+)?\s*\n?(.*?)```", flags=re.DOTALL)
+CODE_FENCE = "```"
+
+
+def sse_event(data: dict) -> str:
+    """
+    Server-Sent Eventsの1イベント分の文字列を作成する
+    """
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def parse_sse_events(lines: AsyncIterator[bytes]) -> AsyncIterator[dict]:
+    """
+    Server-Sent Eventsの行を読み込み、dataのJSONを1イベントずつ返す
+    """
+    async for line in lines:
+        line = line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+        yield json.loads(line[len("data:"):].strip())
+
+
+class CodeFenceStripper:
+    """
+    CODE_FENCE_PATTERNとhtml_replacerによる置換を、ストリーミングの差分ごとに行うクラス
+    - コードブロックの外側のテキストはそのまま返す（```の一部かもしれない末尾の`のみ保留する）
+    - コードブロックは閉じられるまで保留し、閉じた時点で一括置換と同じ規則で置換して返す
+    - 最後まで閉じられなかったコードブロックはそのまま返す
+    すべての差分の出力を結合したものは、全文に対してre.subを行った結果と一致する
+    """
+
+    def __init__(self, replacer):
+        self.replacer = replacer
+        self._buffer = ""
+        self._in_fence = False
+
+    def feed(self, text: str) -> str:
+        """
+        差分を受け取り、確定した部分のテキストを返す
+        """
+        self._buffer += text
+        output = ""
+        while True:
+            if not self._in_fence:
+                index = self._buffer.find(CODE_FENCE)
+                if index == -1:
+                    # ```の開始になりうる末尾の`は次の差分まで保留する
+                    keep = len(self._buffer) - len(self._buffer.rstrip("`"))
+                    keep = min(keep, len(CODE_FENCE) - 1)
+                    output += self._buffer[:len(self._buffer) - keep]
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    return output
+                output += self._buffer[:index]
+                self._buffer = self._buffer[index:]
+                self._in_fence = True
+            else:
+                end = self._buffer.find(CODE_FENCE, len(CODE_FENCE))
+                if end == -1:
+                    return output
+                block = self._buffer[:end + len(CODE_FENCE)]
+                output += CODE_FENCE_PATTERN.sub(self.replacer, block)
+                self._buffer = self._buffer[end + len(CODE_FENCE):]
+                self._in_fence = False
+
+    def finish(self) -> str:
+        """
+        保留しているテキストをすべて返す
+        """
+        output, self._buffer, self._in_fence = self._buffer, "", False
+        return output
+
+
+class StreamMetrics:
+    """
+    回答の返却にかかった時間をモードごとに集計するクラス
+    - ttft: リクエストを受けてから最初のテキストを返すまでの時間
+    - total: リクエストを受けてから回答をすべて返すまでの時間
+    非ストリーミングの場合はttft = totalとして記録し、比較に使う
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name: str, ttft: float, total: float):
+        logging.info(f"response metrics: {name}, ttft: {ttft:.3f}s, total: {total:.3f}s")
+        with self._lock:
+            stats = self._stats.setdefault(
+                name, {"count": 0, "ttft_sum": 0.0, "ttft_max": 0.0, "total_sum": 0.0})
+            stats["count"] += 1
+            stats["ttft_sum"] += ttft
+            stats["ttft_max"] = max(stats["ttft_max"], ttft)
+            stats["total_sum"] += total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "count": stats["count"],
+                    "ttft_avg": round(stats["ttft_sum"] / stats["count"], 3),
+                    "ttft_max": round(stats["ttft_max"], 3),
+                    "total_avg": round(stats["total_sum"] / stats["count"], 3),
+                }
+                for name, stats in self._stats.items()
+            }
+
+
+# プロセス全体で共有する集計
+STREAM_METRICS = StreamMetrics()
+
+
+async def stream_chat_completion(messages: list,
+                                 model_name: str,
+                                 timeout: int = 230,
+                                 reasoning_effort: str = None,
+                                 verbosity: str = None) -> AsyncIterator[str]:
+    """
+    チャットの回答をテキストの差分ごとに返す
+    - Azure OpenAIのモデルはstream=Trueで呼び出す（クライアントはCLIENT_REGISTRYでエンドポイントごとに共有する）
+    - それ以外（Claudeなど）は通常の呼び出しの結果を1つの差分として返す
+    """
+    model_config = LLM_REGISTRY.models.get(model_name)
+    if model_config is None or getattr(model_config, "service", None) != "aoai":
+        yield await _generate_at_once(messages, model_name, timeout, reasoning_effort, verbosity)
+        return
+
+    client = CLIENT_REGISTRY.async_openai(
+        model_config.endpoint, model_config.key, GPT_API_VERSION).with_options(timeout=timeout)
+    options = {}
+    if reasoning_effort:
+        options["reasoning_effort"] = reasoning_effort
+    if verbosity:
+        options["verbosity"] = verbosity
+
+    stream = await client.chat.completions.create(
+        model=model_config.deployment_name,
+        messages=messages,
+        stream=True,
+        **options
+    )
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        # 途中で打ち切られた場合も応答を閉じて接続をプールに戻す
+        await stream.close()
+
+
+async def _generate_at_once(messages: list, model_name: str, timeout: int, reasoning_effort: str, verbosity: str) -> str:
+    """
+    ストリーミングに対応していないモデルの回答をまとめて取得する
+    """
+    if model_name.startswith("claude-"):
+        response = await ClaudeGenerate(
+            messages,
+            model_name=model_name,
+            max_retries=2,
+            timeout=timeout,
+            raise_for_error=True,
+            registry=LLM_REGISTRY
+        )
+    else:
+        options = {}
+        if reasoning_effort:
+            options["reasoning_effort"] = reasoning_effort
+        if verbosity:
+            options["verbosity"] = verbosity
+        response = await AzureOpenAI(
+            messages,
+            model_name=model_name,
+            max_retries=2,
+            timeout=timeout,
+            raise_for_error=True,
+            registry=LLM_REGISTRY,
+            **options
+        )
+    return response["choices"][0]["message"]["content"]
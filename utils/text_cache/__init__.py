@@ -0,0 +1,177 @@
+"""
+ファイルの文字起こし結果(file2text)のキャッシュ
+- キーはファイル内容のSHA-256、拡張子、抽出処理のバージョン
+- 1段目はプロセス内のLRU、2段目はBlobに保存し、同じファイルの再アップロード時はDocument Intelligenceや各種パーサーを呼ばない
+- キーがファイル内容そのもののハッシュのため、同じファイルを持つユーザー以外がキャッシュを参照することはない
+- Blobの内容は保存日時から ttl 経過後は参照しない（コンテナーのライフサイクル管理の削除日数も同じ日数に設定する）
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from utils.clients import CLIENT_REGISTRY
+
+# 抽出処理(file2text)の内容を変更した場合は更新する。古いキャッシュは参照されなくなる
+# 2: msgの添付ファイルの読み込みに失敗した結果をキャッシュしない
+FILE2TEXT_VERSION = "2"
+
+FILE_TEXT_CACHE_CONTAINER_NAME = os.environ.get(
+    "FILE_TEXT_CACHE_CONTAINER_NAME", "file-text-cache")
+# Blobのキャッシュの有効期間(日)
+FILE_TEXT_CACHE_TTL_DAYS = float(os.environ.get("FILE_TEXT_CACHE_TTL_DAYS", 30))
+
+
+class FileTextCache:
+    """
+    file2textの結果(テキスト, ページ数)をファイル内容のハッシュをキーにキャッシュするクラス
+    """
+
+    def __init__(self,
+                 container_name: str,
+                 version: str = FILE2TEXT_VERSION,
+                 max_items: int = 128,
+                 max_chars: int = 20_000_000,
+                 persistent: bool = True,
+                 ttl: float = FILE_TEXT_CACHE_TTL_DAYS * 86400):
+        self.container_name = container_name
+        self.version = version
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.persistent = persistent
+        self.ttl = ttl
+
+        self._items: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hit": 0,
+            "blob_hit": 0,
+            "miss": 0,
+            "blob_error": 0,
+            "blob_expired": 0,
+            "di_calls_saved": 0,
+            "di_pages_saved": 0,
+        }
+
+    def make_key(self, file_content: bytes, file_ext: str) -> str:
+        """
+        キャッシュのキーを作成する
+        """
+        digest = hashlib.sha256(file_content).hexdigest()
+        return f"v{self.version}/{file_ext.lower()}/{digest}"
+
+    def get(self, key: str, uses_di: bool = False):
+        """
+        キャッシュから(テキスト, ページ数)を取得する。存在しない場合はNoneを返す
+        uses_di: Document Intelligenceを利用する拡張子の場合はTrue（削減できたDIの呼び出しを集計する）
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self._count_hit("memory_hit", value, uses_di)
+                return value
+
+        value = self._get_from_blob(key)
+        if value is None:
+            with self._lock:
+                self._stats["miss"] += 1
+            return None
+
+        with self._lock:
+            self._count_hit("blob_hit", value, uses_di)
+        self._set_memory(key, value)
+        return value
+
+    def set(self, key: str, value: tuple[str, int]):
+        """
+        キャッシュに(テキスト, ページ数)を保存する
+        """
+        self._set_memory(key, value)
+        self._set_to_blob(key, value)
+
+    def stats(self) -> dict:
+        """
+        ヒット率や削減できたDocument Intelligenceの呼び出し回数・ページ数を返す
+        """
+        with self._lock:
+            hits = self._stats["memory_hit"] + self._stats["blob_hit"]
+            total = hits + self._stats["miss"]
+            return {
+                **self._stats,
+                "hit_rate": round(hits / total, 3) if total else None,
+                "memory_items": len(self._items),
+                "memory_chars": self._chars,
+            }
+
+    ###########
+    # private #
+    ###########
+
+    def _count_hit(self, name: str, value: tuple[str, int], uses_di: bool):
+        self._stats[name] += 1
+        if uses_di:
+            self._stats["di_calls_saved"] += 1
+            self._stats["di_pages_saved"] += value[1]
+
+    def _set_memory(self, key: str, value: tuple[str, int]):
+        size = len(value[0])
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._items:
+                self._chars -= len(self._items.pop(key)[0])
+            self._items[key] = value
+            self._chars += size
+
+            # 件数・文字数の上限を超えた場合は古いものから削除
+            while len(self._items) > self.max_items or self._chars > self.max_chars:
+                _, old_value = self._items.popitem(last=False)
+                self._chars -= len(old_value[0])
+
+    def _get_from_blob(self, key: str):
+        if not self.persistent:
+            return None
+        try:
+            blob_client = CLIENT_REGISTRY.blob_container(
+                self.container_name).get_blob_client(f"{key}.json")
+            data = json.loads(blob_client.download_blob().readall())
+            # 保存日時がない(古い形式の)もの・有効期間を過ぎたものは使わない
+            if time.time() - float(data.get("cached_at", 0)) > self.ttl:
+                with self._lock:
+                    self._stats["blob_expired"] += 1
+                return None
+            return data["text"], int(data["page"])
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            with self._lock:
+                self._stats["blob_error"] += 1
+            logging.warning(f"file text cache: blobの読み込みに失敗しました。{e}")
+            return None
+
+    def _set_to_blob(self, key: str, value: tuple[str, int]):
+        if not self.persistent:
+            return
+        try:
+            blob_client = CLIENT_REGISTRY.blob_container(
+                self.container_name, create=True).get_blob_client(f"{key}.json")
+            data = json.dumps(
+                {"text": value[0], "page": value[1], "version": self.version, "cached_at": time.time()},
+                ensure_ascii=False
+            )
+            blob_client.upload_blob(data.encode("utf-8"), overwrite=True)
+        except Exception as e:
+            with self._lock:
+                self._stats["blob_error"] += 1
+            logging.warning(f"file text cache: blobへの保存に失敗しました。{e}")
+
+
+# プロセス全体で共有するキャッシュ
+FILE_TEXT_CACHE = FileTextCache(container_name=FILE_TEXT_CACHE_CONTAINER_NAME)
@@ -1,3 +1,10 @@
+import asyncio
+import logging
+import time
+
+import jwt
+
+from i_style.aiohttp import AsyncHttpClient
 from i_style.token import EntraIDTokenManager
 
 
@@ -10,3 +17,145 @@ def decode_id_token(id_token, keys):
 
     user_info = client.get_user_info()
     return user_info["upn"], user_info["mail"], user_info["name"]
+
+
+class OpenIDKeyCache:
+    """
+    Entra IDの公開鍵(JWKS)をプロセス内でキャッシュするクラス
+    - ttl秒以内はキャッシュをそのまま返す
+    - ttlを過ぎてもstale_ttl秒以内であればキャッシュを返しつつ、バックグラウンドで更新する
+    - id_tokenのkidがキャッシュにない場合は、鍵の更新とみなして1回だけ強制的に取得し直す
+    - 同時に複数のリクエストが来ても取得は1回にまとめる（singleflight）
+    """
+
+    def __init__(self, ttl: float = 3600, stale_ttl: float = 86400, min_force_interval: float = 60):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_force_interval = min_force_interval
+
+        self._keys = None
+        self._kids: set = set()
+        self._fetched_at = 0.0
+        self._refresh_task: asyncio.Task = None
+
+        self._stats = {
+            "hit": 0,
+            "stale_hit": 0,
+            "miss": 0,
+            "forced_refresh": 0,
+            "fetch": 0,
+            "fetch_error": 0,
+        }
+
+    async def get_keys(self, async_http_client: AsyncHttpClient, id_token: str = None):
+        """
+        公開鍵を取得する
+        id_tokenを渡した場合はヘッダーのkidがキャッシュ内に存在するかも確認する
+        """
+        kid = self._get_kid(id_token)
+        age = time.monotonic() - self._fetched_at
+
+        if self._keys is not None and self._kids and kid is not None and kid not in self._kids:
+            # 未知のkid: 鍵のローテーションとみなして強制的に取得し直す（連続しての強制取得は行わない）
+            if age >= self.min_force_interval:
+                self._stats["forced_refresh"] += 1
+                logging.info(f"openid keys: unknown kid {kid}, refresh keys")
+                return await self._refresh(async_http_client)
+
+        if self._keys is not None and age < self.ttl:
+            self._stats["hit"] += 1
+            return self._keys
+
+        if self._keys is not None and age < self.ttl + self.stale_ttl:
+            # 期限切れだが利用可能な鍵を返し、裏で更新する
+            self._stats["stale_hit"] += 1
+            self._start_refresh(async_http_client)
+            return self._keys
+
+        self._stats["miss"] += 1
+        return await self._refresh(async_http_client)
+
+    def stats(self) -> dict:
+        """
+        キャッシュのヒット・ミスの回数などを返す
+        """
+        return {
+            **self._stats,
+            "age_sec": round(time.monotonic() - self._fetched_at, 1) if self._keys is not None else None,
+            "kids": len(self._kids),
+        }
+
+    def clear(self):
+        """
+        キャッシュを破棄する
+        """
+        self._keys = None
+        self._kids = set()
+        self._fetched_at = 0.0
+
+    async def _refresh(self, async_http_client: AsyncHttpClient):
+        """
+        取得中の処理があればその結果を待ち、なければ新たに取得する
+        """
+        task = self._start_refresh(async_http_client)
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            # 取得に失敗した場合でも利用可能な鍵があれば返す
+            if self._keys is not None and time.monotonic() - self._fetched_at < self.ttl + self.stale_ttl:
+                return self._keys
+            raise
+
+    def _start_refresh(self, async_http_client: AsyncHttpClient) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(
+                self._fetch(async_http_client))
+            # バックグラウンド更新の失敗は_fetch内でログ出力済みのため、例外を回収しておく
+            self._refresh_task.add_done_callback(
+                lambda task: task.cancelled() or task.exception())
+        return self._refresh_task
+
+    async def _fetch(self, async_http_client: AsyncHttpClient):
+        self._stats["fetch"] += 1
+        try:
+            keys = await EntraIDTokenManager.get_entra_openid_keys(async_http_client)
+        except Exception as e:
+            self._stats["fetch_error"] += 1
+            logging.warning(f"openid keys fetch error: {e}")
+            raise
+
+        self._keys = keys
+        self._kids = self._extract_kids(keys)
+        self._fetched_at = time.monotonic()
+        return keys
+
+    @staticmethod
+    def _get_kid(id_token: str):
+        if not id_token:
+            return None
+        try:
+            return jwt.get_unverified_header(id_token).get("kid")
+        except Exception:
+            return None
+
+    @staticmethod
+    def _extract_kids(keys) -> set:
+        """
+        JWKS({"keys": [...]})または鍵のリストからkidの一覧を取り出す
+        """
+        if isinstance(keys, dict):
+            keys = keys.get("keys", [])
+        if not isinstance(keys, list):
+            return set()
+        return {key.get("kid") for key in keys if isinstance(key, dict) and key.get("kid")}
+
+
+# プロセス全体で共有する公開鍵のキャッシュ
+OPENID_KEY_CACHE = OpenIDKeyCache()
+
+
+async def get_openid_keys(async_http_client: AsyncHttpClient, id_token: str = None):
+    """
+    キャッシュを経由してEntra IDの公開鍵を取得する
+    """
+    return await OPENID_KEY_CACHE.get_keys(async_http_client, id_token)
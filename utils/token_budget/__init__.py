@@ -0,0 +1,238 @@
+"""
+トークン数の見積もりと上限の確認、トークン数での分割
+- エンコーダー(tiktoken)はモデルの系統ごとに1つ作成して使い回す
+- 上限の確認は、まずUTF-8のバイト数(トークン数の上限)で判定し、明らかに上限内の場合はエンコードしない
+- 上限付近の場合のみ区切り位置ごとにエンコードし、上限を超えた時点・残りを足しても上限内と分かった時点で打ち切る
+- 区切り位置はtiktokenの前処理(正規表現)で必ず区切られる位置のみを使うため、区切りごとのトークン数の合計は全体のトークン数と一致する
+"""
+import logging
+import re
+import threading
+import time
+
+import tiktoken
+
+# モデル名の先頭とエンコーディングの対応（一致しない場合はDEFAULT_ENCODING）
+MODEL_ENCODINGS = {
+    "o200k_base": ("gpt4o", "gpt-4o", "gpt4.1", "gpt-4.1", "gpt5", "gpt-5", "o1", "o3", "o4"),
+}
+DEFAULT_ENCODING = "cl100k_base"
+
+# 上限付近の確認で1回にエンコードする文字数の目安
+SEGMENT_CHARS = 8_192
+
+# tiktokenの前処理で必ず区切られる位置
+# - 改行の後（次の文字が空白以外）
+# - 文字・数字の直後の「。」の前
+_BOUNDARY_PATTERN = re.compile(r"\n(?=\S)|(?<=[^\W_])(?=。)")
+
+
+class TokenBudget:
+    """
+    トークン数の確認を行うクラス
+    - count(text, model_name): トークン数
+    - upper_bound(text): エンコードせずに求めるトークン数の上限（UTF-8のバイト数）
+    - exceeds(text, limit, model_name): トークン数がlimitを超えるか（textはリストも可、合計で判定する）
+    - split(text, max_tokens, model_name): max_tokens以下のチャンク [(開始位置, 終了位置, トークン数)] に分割する
+    """
+
+    def __init__(self, model_encodings: dict = MODEL_ENCODINGS, default_encoding: str = DEFAULT_ENCODING):
+        self.model_encodings = model_encodings
+        self.default_encoding = default_encoding
+
+        self._encodings = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "checks": 0,
+            "skipped": 0,
+            "encoded_checks": 0,
+            "encoded_chars": 0,
+            "checked_chars": 0,
+            "splits": 0,
+            "encode_ms": 0.0,
+        }
+
+    def encoding(self, model_name: str = None) -> tiktoken.Encoding:
+        """
+        モデルの系統のエンコーディングを返す（作成済みの場合は使い回す）
+        tiktokenが対応していないエンコーディングの場合はDEFAULT_ENCODINGを使う
+        """
+        name = self._encoding_name(model_name)
+        encoding = self._encodings.get(name)
+        if encoding is not None:
+            return encoding
+
+        with self._lock:
+            encoding = self._encodings.get(name)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.get_encoding(name)
+                except ValueError as e:
+                    logging.warning(f"token budget: {name} is not available, use {self.default_encoding}. {e}")
+                    encoding = tiktoken.get_encoding(self.default_encoding)
+                self._encodings[name] = encoding
+        return encoding
+
+    def count(self, text: str, model_name: str = None) -> int:
+        """
+        トークン数（特殊トークンの文字列も通常のテキストとして数える）
+        """
+        started_at = time.perf_counter()
+        tokens = len(self.encoding(model_name).encode_ordinary(text))
+        self._record_encode(len(text), started_at)
+        return tokens
+
+    @staticmethod
+    def upper_bound(text: str) -> int:
+        """
+        トークン数の上限
+        1トークンは1バイト以上のため、UTF-8のバイト数はトークン数を下回らない（日本語は1文字3バイト）
+        """
+        if text.isascii():
+            return len(text)
+        return len(text.encode("utf-8"))
+
+    def exceeds(self, text, limit: int, model_name: str = None) -> bool:
+        """
+        トークン数がlimitを超える場合はTrueを返す
+        textにリストを渡した場合は各テキストのトークン数の合計で判定する
+        """
+        texts = [text] if isinstance(text, str) else list(text)
+        remaining = sum(self.upper_bound(t) for t in texts)
+        with self._lock:
+            self._stats["checks"] += 1
+            self._stats["checked_chars"] += sum(len(t) for t in texts)
+            if remaining <= limit:
+                self._stats["skipped"] += 1
+                return False
+            self._stats["encoded_checks"] += 1
+
+        encoding = self.encoding(model_name)
+        tokens = 0
+        for t in texts:
+            for start, end in self._segments(t, SEGMENT_CHARS):
+                segment = t[start:end]
+                started_at = time.perf_counter()
+                tokens += len(encoding.encode_ordinary(segment))
+                self._record_encode(len(segment), started_at)
+                remaining -= self.upper_bound(segment)
+                if tokens > limit:
+                    return True
+                if tokens + remaining <= limit:
+                    return False
+        return tokens > limit
+
+    def split(self, text: str, max_tokens: int, model_name: str = None) -> list:
+        """
+        textを1回の走査でmax_tokens以下のチャンクに分割し、[(開始位置, 終了位置, トークン数)] を返す
+        チャンクは改行または「。」の後で区切る（区切れない長さの文のみ文の途中で区切る）
+        トークン数はチャンクごとにエンコードした値と数トークン以内の差がある
+        """
+        if not text:
+            return []
+        with self._lock:
+            self._stats["splits"] += 1
+        if self.upper_bound(text) <= max_tokens:
+            return [(0, len(text), self.count(text, model_name))]
+
+        encoding = self.encoding(model_name)
+        # 「。」の前で区切った場合は「。」を前のチャンクに含めるため、その分を残しておく
+        period_tokens = len(encoding.encode_ordinary("。"))
+
+        chunks = []
+        chunk_start = 0
+        chunk_tokens = 0
+        for start, end in self._segments(text, 0):
+            segment = text[start:end]
+            started_at = time.perf_counter()
+            tokens = len(encoding.encode_ordinary(segment))
+            self._record_encode(len(segment), started_at)
+            tail = period_tokens if text.startswith("。", end) else 0
+
+            if chunk_tokens and chunk_tokens + tokens + tail > max_tokens:
+                chunks.append(self._close(text, chunk_start, start, chunk_tokens, period_tokens))
+                chunk_start = chunks[-1][1]
+                chunk_tokens = 0
+
+            if tokens + tail > max_tokens:
+                # 1文でmax_tokensを超える場合はトークンの位置で区切る
+                pieces = self._split_tokens(encoding, segment, max_tokens - tail)
+                for piece_start, piece_end, piece_tokens in pieces[:-1]:
+                    chunks.append((max(chunk_start, start + piece_start), start + piece_end, piece_tokens))
+                chunk_start = max(chunk_start, start + pieces[-1][0])
+                chunk_tokens = pieces[-1][2]
+                continue
+            chunk_tokens += tokens
+
+        chunks.append((chunk_start, len(text), chunk_tokens))
+        return chunks
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["encode_ms"] = round(stats["encode_ms"], 1)
+        stats["encodings"] = sorted(self._encodings)
+        return stats
+
+    ###########
+    # private #
+    ###########
+
+    def _encoding_name(self, model_name: str = None) -> str:
+        if model_name:
+            for name, prefixes in self.model_encodings.items():
+                if model_name.startswith(prefixes):
+                    return name
+        return self.default_encoding
+
+    @staticmethod
+    def _segments(text: str, min_chars: int):
+        """
+        textを区切り位置で分割し、(開始位置, 終了位置)を順に返す
+        各区間はmin_chars以上（最後の区間を除く）で、次の区切り位置まで伸ばす
+        """
+        start = 0
+        length = len(text)
+        while start < length:
+            match = _BOUNDARY_PATTERN.search(text, start + max(min_chars, 1))
+            end = match.end() if match else length
+            yield start, end
+            start = end
+
+    @staticmethod
+    def _close(text: str, chunk_start: int, end: int, chunk_tokens: int, period_tokens: int) -> tuple:
+        """
+        チャンクを閉じる。終了位置が「。」の前の場合は「。」を含める
+        """
+        if text.startswith("。", end):
+            return chunk_start, end + 1, chunk_tokens + period_tokens
+        return chunk_start, end, chunk_tokens
+
+    @staticmethod
+    def _split_tokens(encoding: tiktoken.Encoding, segment: str, max_tokens: int) -> list:
+        """
+        1つの区間をmax_tokensごとに区切り、[(開始位置, 終了位置, トークン数)] を返す
+        1文字が複数のトークンに分かれる場合は、文字の途中で区切らない
+        """
+        tokens = encoding.encode_ordinary(segment)
+        _, offsets = encoding.decode_with_offsets(tokens)
+        offsets.append(len(segment))
+
+        pieces = []
+        index = 0
+        while index < len(tokens):
+            end = min(index + max_tokens, len(tokens))
+            while index + 1 < end < len(tokens) and offsets[end] == offsets[end - 1]:
+                end -= 1
+            pieces.append((offsets[index], offsets[end], end - index))
+            index = end
+        return pieces
+
+    def _record_encode(self, chars: int, started_at: float):
+        with self._lock:
+            self._stats["encoded_chars"] += chars
+            self._stats["encode_ms"] += (time.perf_counter() - started_at) * 1000
+
+
+# プロセス全体で共有するトークン数の確認
+TOKEN_BUDGET = TokenBudget()
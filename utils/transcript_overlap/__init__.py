@@ -0,0 +1,95 @@
+"""
+連続する文字起こしの重複部分をローカルで取り除くための処理
+- 音声は前後のマージン分だけ重ねて分割しているため、今回の文字起こしの先頭は前回の末尾と重複する
+- 正規化した文字列(NFKC、小文字化、空白・句読点の除去)で、前回の末尾と今回の先頭の対応をdifflibで求める
+- 一致の割合が高い場合のみ確定し、確信が持てない場合はLLMでの重複判定に任せる
+"""
+import difflib
+import unicodedata
+
+# 重複とみなす最小の文字数(正規化後)
+MIN_OVERLAP_CHARS = 4
+# 確定とする一致の割合
+CONFIDENCE_THRESHOLD = 0.8
+# 一致とみなすブロックの最小の長さ（1文字の偶然の一致を除く）
+MIN_BLOCK_SIZE = 2
+# 重複部分の中で許容する不一致の長さ（音声認識の揺れ）
+MAX_GAP = 4
+
+# 重複部分を除いた後の先頭から取り除く文字
+LEADING_PUNCTUATION = " 　、。,.!?！？・…"
+
+
+def normalize_transcript(text: str) -> tuple[str, list]:
+    """
+    比較用に正規化した文字列と、正規化後の各文字に対応する元の文字列の位置を返す
+    """
+    chars = []
+    positions = []
+    for index, char in enumerate(text):
+        for normalized in unicodedata.normalize("NFKC", char).lower():
+            category = unicodedata.category(normalized)
+            # 空白・句読点・記号は比較に使わない
+            if category[0] in ("Z", "P", "S", "C"):
+                continue
+            chars.append(normalized)
+            positions.append(index)
+    return "".join(chars), positions
+
+
+def resolve_overlap(previous_text: str, current_text: str) -> dict:
+    """
+    前回の末尾と重複する今回の先頭を取り除く
+    TranscriptionDeduplicationと同じnew_content, duplicate_contentに加えて
+    - confidence: 重複部分の一致の割合
+    - confident: ローカルの結果を採用してよいか（Falseの場合はLLMで判定する）
+    を返す
+    """
+    result = {
+        "new_content": current_text,
+        "duplicate_content": "",
+        "confidence": 0.0,
+        "confident": False,
+    }
+    previous, _ = normalize_transcript(previous_text)
+    current, positions = normalize_transcript(current_text)
+    if len(previous) < MIN_OVERLAP_CHARS or len(current) < MIN_OVERLAP_CHARS:
+        return result
+
+    matcher = difflib.SequenceMatcher(None, previous, current, autojunk=False)
+    blocks = [block for block in matcher.get_matching_blocks() if block.size >= MIN_BLOCK_SIZE]
+    if not blocks:
+        return result
+
+    # 前回の末尾まで届いている一致から、不一致が短い範囲で前にたどったものを重複部分とする
+    last = blocks[-1]
+    tail_gap = len(previous) - (last.a + last.size)
+    first = last
+    matched = last.size
+    for block in reversed(blocks[:-1]):
+        if first.a - (block.a + block.size) > MAX_GAP or first.b - (block.b + block.size) > MAX_GAP:
+            break
+        first = block
+        matched += block.size
+
+    overlap_end = last.b + last.size
+    head_gap = first.b
+    span = (len(previous) - first.a) + overlap_end
+    confidence = 2 * matched / span
+
+    result["confidence"] = round(confidence, 3)
+    if (
+        tail_gap > MAX_GAP
+        or head_gap > MAX_GAP
+        or matched < MIN_OVERLAP_CHARS
+        or confidence < CONFIDENCE_THRESHOLD
+        # 今回の文字起こしがすべて重複している場合は判定をLLMに任せる
+        or overlap_end >= len(current)
+    ):
+        return result
+
+    cut = positions[overlap_end - 1] + 1
+    result["duplicate_content"] = current_text[:cut]
+    result["new_content"] = current_text[cut:].lstrip(LEADING_PUNCTUATION)
+    result["confident"] = True
+    return result
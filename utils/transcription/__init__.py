@@ -0,0 +1,244 @@
+"""
+文字起こし(gpt-4o-transcribe)の呼び出しをプロセス内で共有するゲートウェイ
+- AsyncAzureOpenAIのクライアントはイベントループごとに1つを使い回す
+- デプロイのRPMに合わせたトークンバケットと同時実行数のセマフォで、リクエストを順番待ちさせる
+- 429の場合はRetry-Afterの間すべてのリクエストを止めてから再試行する（各リクエストが個別に再試行しない）
+- 待ち行列の長さ・待ち時間・処理時間を集計する
+"""
+import asyncio
+import io
+import logging
+import random
+import threading
+import time
+
+import openai
+from openai import AsyncAzureOpenAI
+
+from config import (
+    GPT_API_VERSION,
+    GPT4O_TRANSCRIBE_API_ENDPOINT,
+    GPT4O_TRANSCRIBE_API_KEY,
+    GPT4O_TRANSCRIBE_DEPLOYMENT_NAME,
+    GPT4O_TRANSCRIBE_RPM,
+    GPT4O_TRANSCRIBE_MAX_CONCURRENCY,
+)
+
+
+class TranscriptionGateway:
+    """
+    文字起こしのリクエストをレート制限内で順に実行するクラス
+    - transcribe(audio, file_name, **options): 順番を待って文字起こしを実行する
+    - stats(): 待ち行列の長さ、429の回数、待ち時間・処理時間などを返す
+    """
+
+    def __init__(self,
+                 endpoint: str,
+                 api_key: str,
+                 deployment_name: str,
+                 api_version: str,
+                 rpm: int = 60,
+                 max_concurrency: int = 8,
+                 max_attempts: int = 3,
+                 burst: int = None,
+                 timeout: float = 120):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment_name = deployment_name
+        self.api_version = api_version
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        # トークンバケット（1分あたりrpm個を補充し、既定では10秒分まで貯める）
+        # Azure OpenAIのレート制限は1分より短い区間で評価されるため、1分分のバーストは許可しない
+        self._rate = rpm / 60
+        self._capacity = max(1, burst if burst is not None else rpm // 6)
+        self._tokens = float(self._capacity)
+        self._refilled_at = time.monotonic()
+        # 429を受けた場合にすべてのリクエストを止めておく時刻
+        self._paused_until = 0.0
+
+        self._client = None
+        self._loop = None
+        self._semaphore = None
+        self._rate_lock = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "completed": 0,
+            "failed": 0,
+            "throttled": 0,
+            "retries": 0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "inflight": 0,
+            "wait_sum": 0.0,
+            "wait_max": 0.0,
+            "latency_sum": 0.0,
+            "latency_max": 0.0,
+        }
+
+    async def transcribe(self, audio: bytes, file_name: str, **options):
+        """
+        音声(bytes)を文字起こしする
+        optionsはaudio.transcriptions.createの引数(prompt, language, temperature, response_format など)
+        レート制限・一時的なエラーの場合はmax_attempts回まで再試行し、それでも失敗した場合は例外を送出する
+        """
+        semaphore, rate_lock = self._primitives()
+        self._count("requests")
+
+        for attempt in range(1, self.max_attempts + 1):
+            queued_at = time.monotonic()
+            self._update_queue(1, 0)
+            queued = True
+            try:
+                async with semaphore:
+                    await self._acquire_token(rate_lock)
+                    self._update_queue(-1, 1)
+                    queued = False
+                    waited = time.monotonic() - queued_at
+                    started_at = time.monotonic()
+                    try:
+                        with io.BytesIO(audio) as audio_buffer:
+                            audio_buffer.name = file_name  # ファイル名を設定。これがないとエラーになる。
+                            transcription = await self._get_client().audio.transcriptions.create(
+                                file=audio_buffer,
+                                model=self.deployment_name,
+                                **options
+                            )
+                    finally:
+                        self._update_queue(0, -1)
+            except Exception as e:
+                if not self._is_retryable(e) or attempt >= self.max_attempts:
+                    self._count("failed")
+                    raise
+                self._count("retries")
+                wait = self._retry_after(e)
+                if self._is_rate_limited(e):
+                    # 他のリクエストもまとめて止める
+                    self._count("throttled")
+                    self._paused_until = max(self._paused_until, time.monotonic() + wait)
+                    logging.warning(f"transcription: 429, pause {wait:.1f}s (attempt {attempt})")
+                else:
+                    logging.warning(f"transcription: {e}, retry after {wait:.1f}s (attempt {attempt})")
+                    await asyncio.sleep(wait)
+                continue
+            finally:
+                # 順番待ちの間にキャンセルされた場合
+                if queued:
+                    self._update_queue(-1, 0)
+
+            self._record(waited, time.monotonic() - started_at)
+            return transcription
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        completed = stats["completed"] or 1
+        stats["wait_avg"] = round(stats.pop("wait_sum") / completed, 3)
+        stats["wait_max"] = round(stats["wait_max"], 3)
+        stats["latency_avg"] = round(stats.pop("latency_sum") / completed, 3)
+        stats["latency_max"] = round(stats["latency_max"], 3)
+        stats["paused_sec"] = round(max(self._paused_until - time.monotonic(), 0), 1)
+        stats["rpm"] = self.rpm
+        stats["max_concurrency"] = self.max_concurrency
+        return stats
+
+    ###########
+    # private #
+    ###########
+
+    def _primitives(self) -> tuple[asyncio.Semaphore, asyncio.Lock]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._rate_lock = asyncio.Lock()
+            self._client = None
+            self._loop = loop
+        return self._semaphore, self._rate_lock
+
+    def _get_client(self) -> AsyncAzureOpenAI:
+        # 再試行はこのクラスで行うため、クライアント側の再試行は無効にする
+        if self._client is None:
+            self._client = AsyncAzureOpenAI(
+                api_version=self.api_version,
+                azure_endpoint=self.endpoint,
+                api_key=self.api_key,
+                timeout=self.timeout,
+                max_retries=0,
+            )
+        return self._client
+
+    async def _acquire_token(self, rate_lock: asyncio.Lock):
+        """
+        トークンを1つ取得する（取得できるまで順番に待つ）
+        """
+        async with rate_lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self._capacity, self._tokens + (now - self._refilled_at) * self._rate)
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    @staticmethod
+    def _is_rate_limited(e: Exception) -> bool:
+        return isinstance(e, openai.RateLimitError) or getattr(e, "status_code", None) == 429
+
+    def _is_retryable(self, e: Exception) -> bool:
+        if self._is_rate_limited(e):
+            return True
+        if isinstance(e, (openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        return (getattr(e, "status_code", None) or 0) >= 500
+
+    def _retry_after(self, e: Exception) -> float:
+        """
+        Retry-After(ms)ヘッダーの秒数を返す。ない場合はジッター付きの既定値
+        """
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        base = 60 / self.rpm if self._is_rate_limited(e) else 1
+        return base * (1 + random.random())
+
+    def _update_queue(self, queue: int, inflight: int):
+        with self._lock:
+            self._stats["queue_depth"] += queue
+            self._stats["inflight"] += inflight
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._stats["queue_depth"])
+
+    def _record(self, waited: float, latency: float):
+        with self._lock:
+            self._stats["completed"] += 1
+            self._stats["wait_sum"] += waited
+            self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+            self._stats["latency_sum"] += latency
+            self._stats["latency_max"] = max(self._stats["latency_max"], latency)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+
+# プロセス全体で共有するゲートウェイ
+TRANSCRIPTION_GATEWAY = TranscriptionGateway(
+    endpoint=GPT4O_TRANSCRIBE_API_ENDPOINT,
+    api_key=GPT4O_TRANSCRIBE_API_KEY,
+    deployment_name=GPT4O_TRANSCRIBE_DEPLOYMENT_NAME,
+    api_version=GPT_API_VERSION,
+    rpm=GPT4O_TRANSCRIBE_RPM,
+    max_concurrency=GPT4O_TRANSCRIBE_MAX_CONCURRENCY,
+)
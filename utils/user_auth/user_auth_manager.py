@@ -1,5 +1,8 @@
 import os
+import time
 import logging
+import threading
+from collections import OrderedDict
 from collections.abc import Iterator
 
 import pymssql
@@ -30,6 +33,7 @@ class UserDivisionFetchService:
     def fetch_user_attributes(self, upn: str) -> list:
         """
         SGの情報を取得し、必要な情報に整形する
+        取得結果はUSER_ATTRIBUTE_CACHEに一定時間保持する
         ----
         サンプル
             ```python
@@ -45,11 +49,17 @@ class UserDivisionFetchService:
             ]
             ```
         """
+        # キャッシュの確認
+        user_attributes = USER_ATTRIBUTE_CACHE.get(upn)
+        if user_attributes is not None:
+            return user_attributes
+
         user_authority_data = self._fetch_user_authority_data(upn)
 
         # datetime型やSGのIDをドロップし、ユーザーの所属情報のみ抽出する
         user_attributes = [upn] + [item[3] for item in user_authority_data]
 
+        USER_ATTRIBUTE_CACHE.set(upn, user_attributes)
         return user_attributes
 
     def _fetch_user_authority_data(self, upn: str) -> list:
@@ -96,16 +106,18 @@ class MenuPermissionService:
 
     def fetch_menu_permissions(self, user_attributes: list) -> dict:
         """
-        CosmosDBにアクセスし、upnと所属情報を用いて、表示可能なメニューの一覧を返す
+        upnと所属情報を用いて、表示可能なメニューの一覧を返す
         - すべてのmenu名とpermission typeを取得
         - CUSTOM typeのmenuのみ、SG情報を用いて許可リスト内に存在するか確認する
+        CosmosDBの内容はMENU_PERMISSION_SNAPSHOTに定期的に読み込み、判定はメモリ上の集合演算で行う
         """
         allowed = []
         guide = []
-        # メニューの制御の取得
-        all_menu = self._fetch_permission_type_list()
+        # メニューの制御・許可リストの取得
+        snapshot = MENU_PERMISSION_SNAPSHOT.get(self)
+        attributes = set(user_attributes)
 
-        for menu in all_menu:
+        for menu in snapshot["menus"]:
             resource_id = menu.get("ID")
             permission_type: str = menu.get("permission_type")
 
@@ -115,7 +127,7 @@ class MenuPermissionService:
             assert permission_type in ("CUSTOM", "GUIDE")
 
             # 許可リストの確認
-            if self._is_allowed(user_attributes, resource_id):
+            if not attributes.isdisjoint(snapshot["allowed_attributes"].get(resource_id, ())):
                 allowed.append(resource_id)
             elif permission_type == "GUIDE":
                 guide.append(resource_id)
@@ -132,56 +144,46 @@ class MenuPermissionService:
         # 参照可能なメニュー一覧を返す
         return permissions
 
-    def _fetch_permission_type_list(self) -> Iterator[dict]:
+    def load_snapshot(self) -> dict:
         """
-        menu名とpermission_typeのセットの一覧を取得する
+        メニューの制御と許可リストをすべて読み込む
+        - menus: menu名とpermission_typeの一覧（CosmosDBの取得順）
+        - allowed_attributes: {menu名: 許可された所属情報の集合}
         """
-        container_name = self.cosmos_db_params["containers"]["auth"]
+        menus = list(self._fetch_permission_type_list())
+
+        container_name = self.cosmos_db_params["containers"]["allow"]
         database = self._get_cosmos_db_client()
         container = database.get_container_client(container_name)
 
-        return container.read_all_items()
+        # 許可リストはmenu名がパーティションキーのため、パーティションキーのパスからmenu名を取得する
+        partition_key_path = container.read()["partitionKey"]["paths"][0]
+        partition_key_fields = partition_key_path.strip("/").split("/")
+
+        allowed_attributes = {}
+        for item in container.read_all_items():
+            resource_id = item
+            for field in partition_key_fields:
+                resource_id = resource_id.get(field) if isinstance(resource_id, dict) else None
+            if resource_id is None:
+                continue
+            allowed_attributes.setdefault(resource_id, set()).add(
+                item.get("allowed_attribute"))
+
+        return {
+            "menus": menus,
+            "allowed_attributes": allowed_attributes
+        }
 
-    def _is_allowed(self, user_attributes: list, resource_id: str) -> bool:
+    def _fetch_permission_type_list(self) -> Iterator[dict]:
         """
-        ユーザーの所属、対象メニュー名を受け取り、対象メニューが許可リストに入っているか確認する
+        menu名とpermission_typeのセットの一覧を取得する
         """
-        container_name = self.cosmos_db_params["containers"]["allow"]
+        container_name = self.cosmos_db_params["containers"]["auth"]
         database = self._get_cosmos_db_client()
         container = database.get_container_client(container_name)
 
-        # sqlインジェクション対策をした
-        placeholders = ", ".join(
-            [f"@attr{i}" for i in range(len(user_attributes))])
-        query = f"""
-                SELECT *
-                FROM c
-                WHERE c.allowed_attribute IN ({placeholders})
-                ORDER BY c._ts DESC
-                OFFSET 0 LIMIT 1
-                """
-
-        # 各プレースホルダに対応するパラメータを定義
-        parameters = [{"name": f"@attr{i}", "value": attr}
-                      for i, attr in enumerate(user_attributes)]
-
-        try:
-            result = container.query_items(
-                query=query,
-                parameters=parameters,
-                partition_key=resource_id
-            )
-            item = next(result)
-            logging.debug(f"allowed: {item}")
-
-            return True
-
-        except StopIteration:
-            logging.debug("not allowed")
-        except Exception as e:
-            logging.critical(f"SQL Error: {e}")
-
-        return False
+        return container.read_all_items()
 
     def _get_cosmos_db_client(self) -> DatabaseProxy:
         """
@@ -198,3 +200,98 @@ class MenuPermissionService:
         except Exception as e:
             logging.error(f"Load DB Error: {e}")
             raise
+
+
+class UserAttributeCache:
+    """
+    upnごとの所属情報をTTL付きで保持するキャッシュ
+    """
+
+    def __init__(self, ttl: float = 600, max_items: int = 10_000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items: OrderedDict[str, tuple[float, list]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, upn: str):
+        """
+        有効期限内の所属情報を返す。存在しない場合はNoneを返す
+        """
+        with self._lock:
+            item = self._items.get(upn)
+            if item is not None and time.monotonic() - item[0] < self.ttl:
+                self._items.move_to_end(upn)
+                self.hits += 1
+                return list(item[1])
+            self.misses += 1
+            return None
+
+    def set(self, upn: str, user_attributes: list):
+        with self._lock:
+            self._items[upn] = (time.monotonic(), list(user_attributes))
+            self._items.move_to_end(upn)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, upn: str = None):
+        """
+        指定したupn（省略時はすべて）のキャッシュを破棄する
+        """
+        with self._lock:
+            if upn is None:
+                self._items.clear()
+            else:
+                self._items.pop(upn, None)
+
+
+class MenuPermissionSnapshot:
+    """
+    メニューの制御・許可リストのスナップショットを保持するクラス
+    - 初回はCosmosDBから読み込むまで待つ
+    - refresh_interval秒を過ぎた場合は1つのリクエストのみが読み込み直し、他のリクエストは古いスナップショットを使う
+    """
+
+    def __init__(self, refresh_interval: float = 300, retry_interval: float = 30):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    def get(self, service: "MenuPermissionService") -> dict:
+        if self._snapshot is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            return self._snapshot
+
+        # 古いスナップショットがあれば、更新中の他のリクエストを待たない
+        if not self._lock.acquire(blocking=self._snapshot is None):
+            return self._snapshot
+        try:
+            if self._snapshot is None or time.monotonic() - self._loaded_at >= self.refresh_interval:
+                try:
+                    self._snapshot = service.load_snapshot()
+                    self._loaded_at = time.monotonic()
+                    self.refreshes += 1
+                    logging.info("menu permission snapshot: reloaded")
+                except Exception as e:
+                    if self._snapshot is None:
+                        raise
+                    # 読み込みに失敗した場合は古いスナップショットを使い、少し時間をおいて再度読み込む
+                    self._loaded_at = time.monotonic() - self.refresh_interval + self.retry_interval
+                    logging.critical(f"menu permission snapshot reload error: {e}")
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """
+        スナップショットを次回の参照時に読み込み直す
+        """
+        self._loaded_at = 0.0
+
+
+# プロセス全体で共有するキャッシュ
+USER_ATTRIBUTE_CACHE = UserAttributeCache()
+MENU_PERMISSION_SNAPSHOT = MenuPermissionSnapshot()
@@ -0,0 +1,206 @@
+"""
+サインイン時にユーザーごとの情報を先読みするための処理
+- id_tokenのデコード時などにschedule(upn)を呼ぶと、登録した取得処理をバックグラウンドで並列に実行する
+- 取得結果は短いTTLでユーザーごとに保持し、後続のリクエストはtake()で受け取る
+  (取得中の場合は完了を待って同じ結果を使う。順番待ちの場合は待たずに各リクエストで取得する)
+- 同じユーザーの先読みはcooldown秒に1回まで、同時に実行する取得処理の数・待ちの数には上限を設ける
+- invalidate()の後に完了した取得中の先読みの結果は保持しない（更新前の情報で上書きしない）
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+
+class SignInWarmup:
+    """
+    ユーザーごとの先読み処理と、その結果を保持するクラス
+    - register(kind, fetcher): 先読みする情報の種類と取得処理(async def fetcher(upn))を登録する
+    - schedule(upn, skip): 登録した種類(skipを除く)の先読みを開始する（重複・上限超過の場合は何もしない）
+    - take(kind, upn): 先読みの結果を返す。先読みしていない場合はNone
+    - put(kind, upn, value): 呼び出し元で取得した情報を先読みの結果として保持する
+    - invalidate(kind, upn): 先読みの結果を破棄し、取得中の先読みの結果も保持しないようにする
+    """
+
+    def __init__(self,
+                 ttl: float = 60,
+                 cooldown: float = 60,
+                 max_concurrency: int = 16,
+                 max_pending: int = 200,
+                 max_items: int = 5_000):
+        self.ttl = ttl
+        self.cooldown = cooldown
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.max_items = max_items
+
+        self._fetchers: dict[str, Callable[[str], Awaitable]] = {}
+        self._items: OrderedDict[tuple, tuple[float, object]] = OrderedDict()
+        self._scheduled_at: OrderedDict[str, float] = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self._started: set[tuple] = set()
+        self._semaphore = None
+        self._semaphore_loop = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "scheduled": 0,
+            "deduplicated": 0,
+            "dropped": 0,
+            "prefetch_ok": 0,
+            "prefetch_error": 0,
+            "cancelled": 0,
+            "stale": 0,
+            "hit": 0,
+            "inflight_hit": 0,
+            "miss": 0,
+        }
+
+    def register(self, kind: str, fetcher: Callable[[str], Awaitable]):
+        """
+        先読みする情報の種類を登録する
+        """
+        self._fetchers[kind] = fetcher
+
+    def schedule(self, upn: str, skip: tuple = ()) -> bool:
+        """
+        upnの先読みを開始する（実行中のイベントループ内から呼び出すこと）
+        skipの種類は呼び出し元で取得するため先読みしない
+        開始した場合はTrueを返す
+        """
+        if not upn or not self._fetchers:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            scheduled_at = self._scheduled_at.get(upn)
+            if scheduled_at is not None and now - scheduled_at < self.cooldown:
+                self._stats["deduplicated"] += 1
+                return False
+            # サインインが集中した場合は先読みを諦め、各リクエストで通常通り取得する
+            if len(self._inflight) + len(self._fetchers) > self.max_pending:
+                self._stats["dropped"] += 1
+                logging.debug(f"sign-in warmup: dropped {upn}, pending: {len(self._inflight)}")
+                return False
+            self._scheduled_at[upn] = now
+            self._scheduled_at.move_to_end(upn)
+            while len(self._scheduled_at) > self.max_items:
+                self._scheduled_at.popitem(last=False)
+            self._stats["scheduled"] += 1
+
+            for kind in self._fetchers:
+                key = (kind, upn)
+                if kind in skip or key in self._inflight:
+                    continue
+                task = asyncio.create_task(self._prefetch(kind, upn))
+                self._inflight[key] = task
+                task.add_done_callback(lambda _task, key=key: self._discard_inflight(key, _task))
+        return True
+
+    async def take(self, kind: str, upn: str, keep: bool = False):
+        """
+        先読みの結果を返す（取得中の場合は完了を待つ）
+        keep=Falseの場合は1回受け取ると破棄する（更新されうる情報に使う）
+        先読みしていない・失敗した・期限切れ・順番待ちの場合はNone
+        """
+        key = (kind, upn)
+        task = self._inflight.get(key)
+        hit = "hit"
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            if key in self._started:
+                try:
+                    await asyncio.shield(task)
+                except Exception:
+                    pass
+                hit = "inflight_hit"
+            else:
+                # 順番待ちの先読みを待つと通常の取得より遅くなるため、取り消して呼び出し元で取得する
+                task.cancel()
+                with self._lock:
+                    self._stats["cancelled"] += 1
+
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] >= self.ttl:
+                self._items.pop(key, None)
+                self._stats["miss"] += 1
+                return None
+            if not keep:
+                del self._items[key]
+            self._stats[hit] += 1
+            return item[1]
+
+    def put(self, kind: str, upn: str, value):
+        """
+        呼び出し元で取得した情報を先読みの結果として保持する（後続の先読み・リクエストで使う）
+        """
+        with self._lock:
+            self._store((kind, upn), value)
+
+    def invalidate(self, kind: str, upn: str):
+        """
+        先読みの結果を破棄する（ユーザーが情報を更新した場合に呼び出す）
+        取得中の先読みは対象から外し、完了しても結果を保持しない（順番待ちの場合は取り消す）
+        """
+        key = (kind, upn)
+        with self._lock:
+            self._items.pop(key, None)
+            task = self._inflight.pop(key, None)
+        if task is not None and key not in self._started:
+            task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "inflight": len(self._inflight),
+                "items": len(self._items),
+            }
+
+    ###########
+    # private #
+    ###########
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def _discard_inflight(self, key: tuple, task: asyncio.Task):
+        with self._lock:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+
+    def _store(self, key: tuple, value):
+        self._items[key] = (time.monotonic(), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    async def _prefetch(self, kind: str, upn: str):
+        key = (kind, upn)
+        try:
+            async with self._get_semaphore():
+                self._started.add(key)
+                value = await self._fetchers[kind](upn)
+        except Exception as e:
+            with self._lock:
+                self._stats["prefetch_error"] += 1
+            logging.warning(f"sign-in warmup: {kind} for {upn} failed. {e}")
+            return
+        finally:
+            self._started.discard(key)
+
+        with self._lock:
+            # 取得中にinvalidate()された場合（対象から外れた場合）は更新前の情報のため保持しない
+            if self._inflight.get(key) is not asyncio.current_task():
+                self._stats["stale"] += 1
+                return
+            self._store(key, value)
+            self._stats["prefetch_ok"] += 1
+
+
+# プロセス全体で共有する先読み
+SIGNIN_WARMUP = SignInWarmup()
@@ -0,0 +1,30 @@
+"""
+辞書({置換後: [置換前, ...]})による語の置換
+- llm_docsのプロンプトの置換(replace_dict)で使う
+"""
+import re
+
+
+def compile_replace_dict(replace_dict: dict):
+    """
+    {置換後: [置換前, ...]}の辞書から、1回の走査で置換を行う関数を作成する
+    - 置換前の語を長い順に並べた正規表現を事前にコンパイルし、各位置で最長一致の語を置換する
+    - 置換結果に対して再度置換は行わないため、辞書の順序に依存しない
+    - 同じ語が複数の置換後に登録されている場合は、先に登録されたものを優先する
+    """
+    word_to_key = {}
+    for key, word_list in replace_dict.items():
+        for word in word_list:
+            if word:
+                word_to_key.setdefault(word, key)
+
+    if not word_to_key:
+        return lambda text: text
+
+    pattern = re.compile("|".join(
+        re.escape(word) for word in sorted(word_to_key, key=len, reverse=True)))
+
+    def replace_words(text: str) -> str:
+        return pattern.sub(lambda m: word_to_key[m.group(0)], text)
+
+    return replace_words
@@ -0,0 +1,164 @@
+"""
+Excel(xlsx)の内容の組み立てと書き出し
+- シートの内容は行のリストとして組み立て、列幅は行を追加するたびに求める（書き込み後に全セルを走査しない）
+- 書き出しはopenpyxlのwrite_onlyモードで行う（セルのオブジェクトをすべて保持しない）
+  (XlsxWriterではなくopenpyxlを使うのは、リッチテキスト・書式を含め従来のopenpyxlの出力と同じ内容にするため)
+- 組み立てた内容はpickle可能なため、render_workbookはプロセスプールで実行できる
+  (このモジュールはopenpyxl以外を読み込まない。プール・Blobへの保存は utils.workbook.renderer)
+"""
+import io
+from dataclasses import dataclass
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.rich_text import CellRichText, TextBlock
+from openpyxl.cell.text import InlineFont
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+
+# 列幅の最小・最大（文字数）
+MIN_COLUMN_WIDTH = 8
+MAX_COLUMN_WIDTH = 50
+
+
+@dataclass
+class StyledCell:
+    """
+    書式付きのセル
+    - runs: 文字色ごとのテキスト [(色, テキスト), ...]。指定した場合はリッチテキストとして書き込む
+    - wrap: 折り返して上揃えで表示する
+    - number_format: 表示形式("@"など)
+    """
+    value: object = None
+    runs: list = None
+    wrap: bool = False
+    number_format: str = None
+
+    def text(self) -> str:
+        if self.runs:
+            return "".join(text for _, text in self.runs)
+        return str(self.value) if self.value is not None else ""
+
+
+class SheetBuilder:
+    """
+    1シート分の行と列幅を保持するクラス
+    openpyxlのワークシートと同じくappend(行)で追加する
+    """
+
+    def __init__(self, title: str, auto_width: bool = True, text_format: bool = False):
+        self.title = title
+        self.auto_width = auto_width
+        # Trueの場合は数値以外のセルを文字列("@")、数値のセルを"General"の表示形式にする
+        self.text_format = text_format
+        self.rows = []
+        self._max_lengths = []
+
+    def append(self, row):
+        row = list(row)
+        self.rows.append(row)
+        if len(row) > len(self._max_lengths):
+            self._max_lengths += [0] * (len(row) - len(self._max_lengths))
+        for column, value in enumerate(row):
+            if isinstance(value, StyledCell):
+                length = len(value.text())
+            else:
+                length = len(str(value)) if value is not None else 0
+            if length > self._max_lengths[column]:
+                self._max_lengths[column] = length
+
+    def column_widths(self) -> list:
+        """
+        各列の幅（内容の最大文字数+2、最小8・最大50）
+        """
+        return [min(max(length + 2, MIN_COLUMN_WIDTH), MAX_COLUMN_WIDTH) for length in self._max_lengths]
+
+    def to_dict(self) -> dict:
+        return {
+            "title": self.title,
+            "rows": self.rows,
+            "widths": self.column_widths() if self.auto_width else [],
+            "text_format": self.text_format,
+        }
+
+
+class WorkbookBuilder:
+    """
+    ワークブックの内容(シートの並び)を保持するクラス
+    openpyxlのWorkbookと同じくcreate_sheet(title), sheetnames, wb[title]で扱える
+    """
+
+    def __init__(self):
+        self.sheets: list[SheetBuilder] = []
+
+    @property
+    def sheetnames(self) -> list:
+        return [sheet.title for sheet in self.sheets]
+
+    def create_sheet(self, title: str, **options) -> SheetBuilder:
+        sheet = SheetBuilder(title, **options)
+        self.sheets.append(sheet)
+        return sheet
+
+    def __getitem__(self, title: str) -> SheetBuilder:
+        for sheet in self.sheets:
+            if sheet.title == title:
+                return sheet
+        raise KeyError(f"Worksheet {title} does not exist.")
+
+    def to_spec(self) -> list:
+        """
+        render_workbookに渡す内容(pickle可能なリスト)
+        """
+        return [sheet.to_dict() for sheet in self.sheets]
+
+
+def render_workbook(spec: list) -> bytes:
+    """
+    WorkbookBuilder.to_spec()の内容をxlsxのバイト列に書き出す
+    """
+    wb = Workbook(write_only=True)
+    fonts = {}
+    alignment = Alignment(wrap_text=True, vertical='top')
+
+    for sheet in spec:
+        ws = wb.create_sheet(title=sheet["title"])
+        # write_onlyモードでは列幅を行より先に設定する
+        for column, width in enumerate(sheet["widths"], start=1):
+            ws.column_dimensions[get_column_letter(column)].width = width
+
+        text_format = sheet["text_format"]
+        for row in sheet["rows"]:
+            if not text_format and not any(isinstance(value, StyledCell) for value in row):
+                ws.append(row)
+                continue
+
+            cells = []
+            for value in row:
+                if isinstance(value, StyledCell):
+                    cell = WriteOnlyCell(ws)
+                    if value.runs:
+                        blocks = [
+                            TextBlock(fonts.setdefault(color, InlineFont(color=color)), text)
+                            for color, text in value.runs if text
+                        ]
+                        cell.value = CellRichText(blocks) if blocks else None
+                    else:
+                        cell.value = value.value
+                    if value.wrap:
+                        cell.alignment = alignment
+                    number_format = value.number_format
+                    value = value.value
+                else:
+                    cell = WriteOnlyCell(ws, value=value)
+                    number_format = None
+                if text_format and number_format is None:
+                    number_format = "General" if isinstance(value, (int, float)) else "@"
+                if number_format:
+                    cell.number_format = number_format
+                cells.append(cell)
+            ws.append(cells)
+
+    with io.BytesIO() as buffer:
+        wb.save(buffer)
+        return buffer.getvalue()
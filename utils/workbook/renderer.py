@@ -0,0 +1,147 @@
+"""
+Excel(xlsx)の生成と返却を行うサービス
+- 生成(render_workbook)はプロセスプールで行い、イベントループ・他のリクエストを止めない
+  (プールを作成・利用できない場合はスレッドで生成する)
+- 生成したファイルはbase64でレスポンスに含めるか、Blob(file-data)に保存して参照を返す
+  参照(blob_name)は genie/blob でダウンロードできる（blob名の先頭がupnのもののみ）
+"""
+import asyncio
+import base64
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import FILE_CONTAINER_NAME, WORKBOOK_RENDER_PROCESSES
+from utils.clients import CLIENT_REGISTRY
+from utils.workbook import WorkbookBuilder, render_workbook
+
+# レスポンスでの返し方
+DELIVERY_INLINE = "inline"
+DELIVERY_BLOB = "blob"
+
+
+class WorkbookRenderer:
+    """
+    WorkbookBuilderの内容をxlsxに書き出し、レスポンス用の形式で返すクラス
+    - render(workbook): xlsxのバイト列を返す
+    - deliver(data, file_name, upn, delivery, blob_name): {"fileName", "data"} または {"fileName", "blob_name"} を返す
+    """
+
+    def __init__(self, max_workers: int, container_name: str):
+        self.max_workers = max_workers
+        self.container_name = container_name
+
+        self._executor = None
+        self._disabled = max_workers <= 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "rendered": 0,
+            "process": 0,
+            "thread": 0,
+            "render_ms_sum": 0.0,
+            "render_ms_max": 0.0,
+            "bytes": 0,
+            "inline": 0,
+            "blob": 0,
+        }
+
+    async def render(self, workbook: WorkbookBuilder) -> bytes:
+        """
+        ワークブックをxlsxのバイト列に書き出す
+        """
+        spec = workbook.to_spec()
+        started_at = time.perf_counter()
+        mode = "thread"
+        executor = self._get_executor()
+        if executor is not None:
+            try:
+                data = await asyncio.get_running_loop().run_in_executor(executor, render_workbook, spec)
+                mode = "process"
+            except (BrokenProcessPool, OSError) as e:
+                # ワーカーが異常終了した場合などはスレッドに切り替える
+                logging.warning(f"workbook renderer: process pool unavailable, use thread. {e}")
+                self._shutdown()
+        if mode == "thread":
+            data = await asyncio.to_thread(render_workbook, spec)
+
+        self._record(mode, (time.perf_counter() - started_at) * 1000, len(data))
+        return data
+
+    async def deliver(self, data: bytes, file_name: str, upn: str, delivery: str = DELIVERY_INLINE,
+                      blob_name: str = None) -> dict:
+        """
+        レスポンスに含める形式で返す
+        delivery="blob"の場合はBlobに保存し、base64の代わりにblob名を返す
+        呼び出し元で同じコンテナに保存済みの場合はblob_nameを渡す（再度アップロードせずにその参照を返す）
+        """
+        if delivery != DELIVERY_BLOB:
+            self._count(DELIVERY_INLINE)
+            return {
+                "fileName": file_name,
+                "data": base64.b64encode(data).decode('utf-8')
+            }
+
+        if blob_name is None:
+            blob_name = f"{upn}/workbooks/{file_name}"
+            container_client = await CLIENT_REGISTRY.ensure_async_blob_container(self.container_name)
+            await container_client.get_blob_client(blob_name).upload_blob(data, overwrite=True)
+        self._count(DELIVERY_BLOB)
+        return {
+            "fileName": file_name,
+            "blob_name": blob_name
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        rendered = stats["rendered"] or 1
+        stats["render_ms_avg"] = round(stats.pop("render_ms_sum") / rendered, 1)
+        stats["render_ms_max"] = round(stats["render_ms_max"], 1)
+        stats["max_workers"] = 0 if self._disabled else self.max_workers
+        return stats
+
+    ###########
+    # private #
+    ###########
+
+    def _get_executor(self):
+        if self._disabled:
+            return None
+        with self._lock:
+            if self._executor is None:
+                try:
+                    # Functionsのワーカーはスレッドを持つため、forkではなくspawnでプロセスを作成する
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                except (OSError, ValueError, NotImplementedError) as e:
+                    logging.warning(f"workbook renderer: failed to create process pool, use thread. {e}")
+                    self._disabled = True
+            return self._executor
+
+    def _shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._disabled = True
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _record(self, mode: str, render_ms: float, size: int):
+        with self._lock:
+            self._stats["rendered"] += 1
+            self._stats[mode] += 1
+            self._stats["render_ms_sum"] += render_ms
+            self._stats["render_ms_max"] = max(self._stats["render_ms_max"], render_ms)
+            self._stats["bytes"] += size
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+
+# プロセス全体で共有するExcelの生成サービス
+WORKBOOK_RENDERER = WorkbookRenderer(WORKBOOK_RENDER_PROCESSES, FILE_CONTAINER_NAME)
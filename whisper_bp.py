@@ -1,10 +1,7 @@
 import asyncio
-from azure.storage.blob.aio import BlobServiceClient
 import azure.functions as func
 import azure.durable_functions as d_func
 import openai
-from openai import AsyncAzureOpenAI
-import io
 import os
 import logging
 import json
@@ -16,11 +13,11 @@ from prompt import transcribe_prompt_dict, DUPLICATION_EXTRACTION_SYSTEM_CONTENT
 from whisper_util import remove_repeated_words, pcm_to_wav
 
 from i_style.llm import AzureOpenAI
-from i_style.aiohttp import AsyncHttpClient
-from config import (
-    GPT_API_VERSION, GPT4O_TRANSCRIBE_API_ENDPOINT, GPT4O_TRANSCRIBE_API_KEY, GPT4O_TRANSCRIBE_DEPLOYMENT_NAME, LLM_REGISTRY
-)
-from util import BLOB_CONNECTION_STRING, AUDIO_CONTAINER_NAME
+from config import LLM_REGISTRY
+from util import AUDIO_CONTAINER_NAME
+from utils.clients import CLIENT_REGISTRY
+from utils.transcript_overlap import resolve_overlap
+from utils.transcription import TRANSCRIPTION_GATEWAY
 
 
 ##
@@ -65,6 +62,8 @@ def whisper_(context: d_func.DurableOrchestrationContext):
     interval = 30
     whisper_results = []
     max_index = 0
+    # 重複除去の集計（ローカルで確定した回数・LLMで判定した回数）
+    dedup_stats = {"local": 0, "llm": 0}
 
     # continue as new
     # 開始時に渡されたデータを取得
@@ -84,6 +83,7 @@ def whisper_(context: d_func.DurableOrchestrationContext):
 
         # whisper results
         whisper_results = payload["whisper_results"]
+        dedup_stats = payload.get("dedup_stats", dedup_stats)
 
         if not context.is_replaying:
             logging.debug(f"continue as new, counter: {counter}")
@@ -92,6 +92,7 @@ def whisper_(context: d_func.DurableOrchestrationContext):
     upn = payload["upn"]
     res_json["session_id"] = session_id = payload.get("session_id")
     res_json["title"] = payload.get("title", "No title")
+    res_json["dedup_stats"] = dedup_stats
 
     # customStatusの設定
     context.set_custom_status(res_json)
@@ -108,6 +109,7 @@ def whisper_(context: d_func.DurableOrchestrationContext):
     whisper_data["blob_prefix"] = payload["blob_prefix"]
     whisper_data["results"] = whisper_results
     whisper_data["fail_counter"] = fail_counter
+    whisper_data["dedup_stats"] = dedup_stats
 
     # 履歴用
     whisper_data["upn"] = upn
@@ -155,6 +157,7 @@ def whisper_(context: d_func.DurableOrchestrationContext):
         counter += 1
         fail_counter = whisper_data["fail_counter"]
         interval = whisper_data["interval"]
+        dedup_stats = whisper_data.get("dedup_stats", dedup_stats)
 
     except Exception as e:
         logging.warning(f"no key: {e}")
@@ -177,6 +180,7 @@ def whisper_(context: d_func.DurableOrchestrationContext):
 
     payload["text"] = res_json["text"]
     payload["whisper_results"] = whisper_results
+    payload["dedup_stats"] = dedup_stats
     logging.debug("call continue as new")
     context.continue_as_new(input_=payload)
 
@@ -219,6 +223,7 @@ async def transcribe_(input: dict) -> dict:
 
     # 前回の文字起こしの結果
     prev_text = input.get("results", [])
+    dedup_stats = dict(input.get("dedup_stats") or {"local": 0, "llm": 0})
 
     # blob name
     access_token = input["access_token"]
@@ -231,12 +236,9 @@ async def transcribe_(input: dict) -> dict:
     next_blob_name = f"{blob_prefix}/{access_token}_{start_time+INTERVAL}_{end_time+INTERVAL}.pcm"
 
     # Blobクライアントを取得
-    blob_service_client = BlobServiceClient.from_connection_string(
-        BLOB_CONNECTION_STRING)
-    blob_client = blob_service_client.get_blob_client(
-        container=AUDIO_CONTAINER_NAME, blob=blob_name)
-    next_blob_client = blob_service_client.get_blob_client(
-        container=AUDIO_CONTAINER_NAME, blob=next_blob_name)
+    container_client = CLIENT_REGISTRY.async_blob_container(AUDIO_CONTAINER_NAME)
+    blob_client = container_client.get_blob_client(blob_name)
+    next_blob_client = container_client.get_blob_client(next_blob_name)
 
     # blobがあるか確認
     max_retries = 6
@@ -263,32 +265,10 @@ async def transcribe_(input: dict) -> dict:
     blob_download_stream = await blob_client.download_blob()
     pcm_audio: bytes = await blob_download_stream.readall()
 
-    try:
-        client = AsyncAzureOpenAI(
-            api_version=GPT_API_VERSION,
-            azure_endpoint=GPT4O_TRANSCRIBE_API_ENDPOINT,
-            api_key=GPT4O_TRANSCRIBE_API_KEY
-        )
-    except Exception as e:
-        logging.critical(f"Failed to initialize AsyncAzureOpenAI client: {e}")
-        return {
-            "results": [],
-            "text": "文字起こしできませんでした。",
-            "interval": 5,
-            "fail_counter": fail_counter + 1,
-            "session_id": session_id,
-            "title": title
-        }
-
     # デフォルトで日本語のプロンプトを選択。
     # 基本的にプロンプトの言語ではなく、音声データの言語によって文字起こしされている模様。
     selected_transcribe_prompt = transcribe_prompt_dict.get("ja", "")
 
-    # 　最大繰り返し回数
-    max_number_of_attempts = 2
-    attempts_count = 0
-    text = ""
-
     try:
         wav_data = pcm_to_wav(pcm_audio)
     except Exception as e:
@@ -304,46 +284,18 @@ async def transcribe_(input: dict) -> dict:
     finally:
         del pcm_audio  # メモリ解放
 
-    while True:
-        try:
-            with io.BytesIO(wav_data) as wav_buffer:
-                wav_buffer.name = "audio.wav"  # ファイル名を設定。これがないとエラーになる。
-
-                # transcribeモデルでの文字起こし実行
-                transcription = await client.audio.transcriptions.create(
-                    file=wav_buffer,
-                    model=GPT4O_TRANSCRIBE_DEPLOYMENT_NAME,
-                    prompt=selected_transcribe_prompt,
-                    temperature=0.0,
-                    response_format="json"
-                )
-
-                # 文字起こしの結果の後処理
-                text = transcription.text
-                # 成功した場合はループを抜ける
-                break
-
-        except Exception as e:
-            attempts_count += 1
-            error_str = str(e)
-            logging.warning(
-                f"Transcription attempt {attempts_count} failed: {error_str}")
-
-            # 最大試行回数に達した場合は終了
-            if attempts_count >= max_number_of_attempts:
-                logging.error(
-                    f"Transcription failed after {max_number_of_attempts} attempts")
-                break
-
-            # レート制限エラーの場合は少し長めに待機
-            if (hasattr(e, 'status_code') and e.status_code == 429) or "429" in error_str:
-                logging.warning("429 error. Retry!")
-                await asyncio.sleep(5)
-            else:
-                await asyncio.sleep(1)
-
-    # 最終的に失敗した場合
-    if not text and attempts_count >= max_number_of_attempts:
+    # 共有のゲートウェイで文字起こしを実行（レート制限・429の再試行はゲートウェイで行う）
+    try:
+        transcription = await TRANSCRIPTION_GATEWAY.transcribe(
+            wav_data,
+            file_name="audio.wav",
+            prompt=selected_transcribe_prompt,
+            temperature=0.0,
+            response_format="json"
+        )
+        text = transcription.text
+    except Exception as e:
+        logging.error(f"Transcription failed: {e}")
         return {
             "results": [],
             "text": "文字起こしできませんでした。",
@@ -358,16 +310,30 @@ async def transcribe_(input: dict) -> dict:
         "results": [],
         "text": "",
         "interval": 0,
-        "fail_counter": 0  # 成功したためリセット
+        "fail_counter": 0,  # 成功したためリセット
+        "dedup_stats": dedup_stats
     }
 
     # 前回の文字起こしがある場合、今回の文字起こしとの重複を排除する
-    if prev_text and len(prev_text) > 0:
+    # まずローカルで前回の末尾と今回の先頭を照合し、確信が持てない場合のみLLMで判定する
+    overlap = None
+    if prev_text and len(prev_text) > 0 and text.strip():
+        # 前回のテキストを取得する
+        last_prev_text = prev_text[-1] if isinstance(
+            prev_text, list) and prev_text else str(prev_text)
+        overlap = resolve_overlap(last_prev_text, text)
+        logging.info(f"overlap confidence: {overlap['confidence']}, local: {overlap['confident']}")
+
+    if overlap is not None and overlap["confident"]:
+        dedup_stats["local"] += 1
+        text = overlap["new_content"]
+        if overlap["duplicate_content"]:
+            logging.debug(
+                f"重複した文章: {overlap['duplicate_content'][:100]}...")
+
+    elif overlap is not None:
+        dedup_stats["llm"] += 1
         try:
-            # 前回のテキストを取得する
-            last_prev_text = prev_text[-1] if isinstance(
-                prev_text, list) and prev_text else str(prev_text)
-
             system_prompt = DUPLICATION_EXTRACTION_SYSTEM_CONTENT.format(
                 previous_text=last_prev_text,
                 current_text=text
@@ -403,6 +369,10 @@ async def transcribe_(input: dict) -> dict:
             logging.warning(f"重複排除処理でエラー: {e}")
             # エラーが発生した場合は元のテキストをそのまま使用
 
+    if overlap is not None:
+        logging.info(
+            f"dedup stats: local {dedup_stats['local']}, llm {dedup_stats['llm']} (LLM calls avoided: {dedup_stats['local']})")
+
     if text.strip():
         # 重複した単語を正規表現を使用して取り除く
         text = remove_repeated_words(text)
@@ -441,7 +411,7 @@ async def transcribe_(input: dict) -> dict:
             ]
         }
 
-        async_http_client = AsyncHttpClient()
+        async_http_client = CLIENT_REGISTRY.http_client()
 
         # history_base_url: https://itc-history-functions.azurewebsites.net
         url = f"{history_base_url}/api/history/minutes"
@@ -515,7 +485,7 @@ async def start_durable_whisper(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(json.dumps(json_response))
 
     # 非同期http通信クライアントのインスタンス化
-    async_http_client = AsyncHttpClient()
+    async_http_client = CLIENT_REGISTRY.http_client()
 
     # requestの準備
     base_url = os.environ.get("DURABLE_URL")
@@ -1,10 +1,11 @@
 import pandas as pd
 from typing import List, Dict, Union, Tuple
-import re
 from functools import reduce
 import io
 import wave
 
+from utils.repetition import collapse_repeats
+
 
 # 採用する区間の単語データフレーム取得
 def get_intermediate_words(
@@ -107,11 +108,8 @@ def remove_hallucination(df, margin=0.5):
 
 # 特定の文字列の3回以上の繰り返しを削除
 def remove_repeated_words(text):
-    # 文字列とパターンを定義
-    pattern = r"((.+?)\2{2,})"
-    text = re.sub(pattern, "", text)
-
-    return text
+    # ((.+?)\2{2,}) に一致する部分を削除するのと同じ結果（線形時間）
+    return collapse_repeats(text, min_repeat=3, keep=0, until_stable=False)
 
 
 # PCMデータをWAV形式に変換する
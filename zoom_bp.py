@@ -1,7 +1,6 @@
 import os
 import asyncio
 import json
-import time
 import base64
 import random
 import logging
@@ -13,7 +12,6 @@ from datetime import datetime, timedelta
 import azure.functions as func
 import azure.durable_functions as d_func
 
-from azure.storage.blob import BlobServiceClient
 from azure.identity import DefaultAzureCredential
 from azure.mgmt.containerinstance import ContainerInstanceManagementClient
 from azure.mgmt.containerinstance.models import (
@@ -23,8 +21,8 @@ from azure.mgmt.containerinstance.models import (
 
 import requests
 
+from utils.clients import CLIENT_REGISTRY
 from util import (
-    BLOB_CONNECTION_STRING,
     AUDIO_CONTAINER_NAME,
     upload_blob,
     date_time_ite,
@@ -46,6 +44,17 @@ INTERVAL = 10
 LEAD_MARGIN = 5
 TRAIL_MARGIN = 3
 
+# 音声の取得形式
+# - binary: 生のPCMをapplication/octet-streamで取得（X-Max-Index, X-Segment-Countヘッダー）
+# - hex: JSONのfile_dataに16進数文字列のリストで取得（従来の形式）
+AUDIO_FORMAT_BINARY = "binary"
+AUDIO_FORMAT_HEX = "hex"
+
+# resource.phpの1回の取得のタイムアウト(秒)
+RESOURCE_REQUEST_TIMEOUT = 30
+# リトライの待機秒数に加える揺らぎの割合
+RETRY_JITTER_RATIO = 0.2
+
 AUDIO_EVENT_NAME = "audio_input"
 ZOOM_ENTITY_NAME = "myZoomEntity"
 
@@ -72,6 +81,7 @@ class ZoomBot:
         self.time = LEAD_MARGIN  # 最初からマージンをとる
         self.max_index = 0
         self.fail_count = 0
+        self.audio_format = AUDIO_FORMAT_BINARY
         self.status = self.start()
 
     # --- クラスメソッド ---
@@ -95,6 +105,7 @@ class ZoomBot:
         bot.time = data["time"]
         bot.max_index = data["max_index"]
         bot.fail_count = data.get("fail_count", 0)
+        bot.audio_format = data.get("audio_format", AUDIO_FORMAT_BINARY)
         bot.status = data.get("status", "error")
 
         return bot
@@ -159,12 +170,13 @@ class ZoomBot:
         }
         return self.__initialize_bot(base_url, params_dict)
 
-    def audio(
+    async def audio(
         self,
-    ) -> bytearray:
+    ) -> bytes:
         """
         音声の取得を行い、バイナリで返却
         インターバル、前後にマージンを設定している
+        待機はasyncio.sleepで行うため、1つのworkerで複数の会議の音声を並行して取得できる
 
         # エラーの条件
         ## 開始時
@@ -181,7 +193,7 @@ class ZoomBot:
         start_time = params_dict["start"]
         end_time = params_dict["end"]
 
-        file_data, max_index = self.__retrieve_audio_data(url, end_time)
+        file_data, max_index = await self.__retrieve_audio_data(url, end_time)
 
         # 音声が取得できなかった場合
         if not file_data:
@@ -270,16 +282,17 @@ class ZoomBot:
         start_time = self.time - LEAD_MARGIN
         end_time = self.time + INTERVAL + TRAIL_MARGIN - 1
         logging.info(f"audio start: {start_time}, end: {end_time}")
-        return {"start": start_time, "end": end_time, "access_token": self.access_token}
+        return {"start": start_time, "end": end_time, "access_token": self.access_token, "format": self.audio_format}
 
-    def __retrieve_audio_data(self, url: str, end_time: int) -> tuple[list, int]:
+    async def __retrieve_audio_data(self, url: str, end_time: int) -> tuple[list, int]:
         self.fail_count = 0
         max_index = self.max_index
+        session = CLIENT_REGISTRY.aiohttp_session()
 
         while True:
             pre_max_index = max_index
-            response = requests.get(url)
-            res_json = json.loads(response.text)
+            async with session.get(url, timeout=RESOURCE_REQUEST_TIMEOUT) as response:
+                res_json = await self.__parse_audio_response(response)
 
             # コンテナから正常レスポンスの場合
             if int(res_json["status"]) == 200:
@@ -287,36 +300,65 @@ class ZoomBot:
                 try:
                     max_index = int(res_json["max_index"])
                     logging.debug(
-                        f"max_index: {max_index}, file_data: {len(file_data)}"
+                        f"max_index: {max_index}, file_data: {res_json['segment_count']}"
                     )
                 except Exception as e:
                     logging.warning(f"{e}")
                     continue
 
                 # 音声の長さが指定通りの場合
-                if len(file_data) == LEAD_MARGIN + INTERVAL + TRAIL_MARGIN:
+                if res_json["segment_count"] == LEAD_MARGIN + INTERVAL + TRAIL_MARGIN:
                     self.fail_count = 0
                     logging.info(f"bot_response: {res_json['message']}")
                     return file_data, max_index
                 # 音声の長さが足りない場合（頻出）
-                if self.__handle_failure_conditions(pre_max_index, max_index, end_time):
+                ended, wait = self.__handle_failure_conditions(pre_max_index, max_index, end_time)
+                if ended:
                     return None, max_index
 
             # 録音が開始できているかの確認
-            elif self.__handle_no_resource_file(res_json):
-                return None, max_index
-
-            # 想定外のレスポンスの場合
             else:
+                ended, wait = self.__handle_no_resource_file(res_json)
+                if ended:
+                    return None, max_index
+                # 想定外のレスポンスの場合（録音開始待ちの場合も同様に待機を追加）
                 logging.warning(f"no audio, {res_json['message']}")
-                time.sleep(5)
+                wait += 5
+
+            await asyncio.sleep(self.__jitter(wait))
 
-    def __handle_failure_conditions(self, pre_max_index, max_index, end_time) -> bool:
+    async def __parse_audio_response(self, response) -> dict:
+        """
+        resource.phpのレスポンスを形式によらず同じ辞書にする
+        - binary: ヘッダーから状態を取得し、file_dataはPCMのbytes
+        - hex(JSON): file_dataは16進数文字列のリスト(または辞書)
+        binaryを要求してJSONの音声が返ってきた場合は、コンテナが未対応と判断して以降はhexで取得する
+        """
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith("application/octet-stream"):
+            return {
+                "status": int(response.headers.get("X-Status", 200)),
+                "message": response.headers.get("X-Message", ""),
+                "max_index": response.headers["X-Max-Index"],
+                "segment_count": int(response.headers["X-Segment-Count"]),
+                "file_data": await response.read(),
+            }
+
+        res_json = json.loads(await response.text())
+        if "file_data" in res_json:
+            res_json["segment_count"] = len(res_json["file_data"])
+            if self.audio_format == AUDIO_FORMAT_BINARY:
+                logging.info("binary audio is not supported by the container. fallback to hex.")
+                self.audio_format = AUDIO_FORMAT_HEX
+        return res_json
+
+    def __handle_failure_conditions(self, pre_max_index, max_index, end_time) -> tuple[bool, float]:
         """
         音声の取得に失敗した場合に
         - 失敗した回数
         - 失敗の状況
         に応じて処理を分岐する関数
+        (終了するか, 次の取得までの待機秒数)を返す
         """
         # 待機時間の設定（60 * 5s）
         max_retries = 60
@@ -325,27 +367,27 @@ class ZoomBot:
         if self.fail_count > max_retries:
             self.status = "end"
             logging.info("bot end: cannot get new audio")
-            return True
+            return True, 0
 
         # 前回の失敗時から音声が更新されていない場合
         elif pre_max_index == max_index:
             logging.warning(f"retry: {self.fail_count}, reason: stop recording.")
             self.fail_count += 5
-            time.sleep(5)
-            return False
+            return False, 5
 
         # 音声は更新されているが、指定した長さではない場合
+        # 不足している秒数（max_indexがend_timeに届くまで）だけ待機する
         else:
             sleep_time = end_time - max_index if max_index < end_time else 1
             logging.warning(f"retry: {self.fail_count}")
             self.fail_count += 1
-            time.sleep(sleep_time)
-            return False
+            return False, sleep_time
 
-    def __handle_no_resource_file(self, res_json) -> bool:
+    def __handle_no_resource_file(self, res_json) -> tuple[bool, float]:
         """
         録音開始までの待機時間を超過しているか確認するための関数
         コンテナから正常レスポンスが返されなかった場合に呼び出される
+        (終了するか, 次の取得までの待機秒数)を返す
         """
         # 待機時間の設定（35 * 5s）
         max_retries = 35
@@ -359,13 +401,20 @@ class ZoomBot:
             if self.fail_count > max_retries:
                 self.status = "end"
                 logging.info("bot end: cannot start recording")
-                return True
+                return True, 0
             # 待機時間内
             logging.warning(f"init retry: {self.fail_count}")
             self.fail_count += 1
-            time.sleep(5)
-            return False
-        return False
+            return False, 5
+        return False, 0
+
+    @staticmethod
+    def __jitter(wait: float) -> float:
+        """
+        待機秒数に0~RETRY_JITTER_RATIOの割合の揺らぎを加える
+        同時に開始した会議の取得が同じタイミングに集中しないようにする（早めることはしない）
+        """
+        return wait * (1 + random.uniform(0, RETRY_JITTER_RATIO))
 
     def __update_time(self, max_index):
         self.time += INTERVAL
@@ -380,7 +429,11 @@ class ZoomBot:
             self.status = "end"
             logging.warning("bot end: WARNING!!")
 
-    def __convert_to_binary(self, file_data) -> bytearray:
+    def __convert_to_binary(self, file_data) -> bytes:
+        # binaryで取得した場合は変換不要
+        if isinstance(file_data, (bytes, bytearray)):
+            return file_data
+
         if isinstance(file_data, dict):
             file_data = [file_data[k] for k in sorted(file_data, key=int)]
 
@@ -643,7 +696,7 @@ def zoom_start(input: dict) -> dict:
 
 
 @zoom_bp.activity_trigger(input_name="input")
-def zoom_audio(input: dict) -> dict:
+async def zoom_audio(input: dict) -> dict:
     """
     音声を取得してblobに格納、blobの名前を送ってeventを起こす
     コンテナの生存確認を追記中
@@ -680,7 +733,7 @@ def zoom_audio(input: dict) -> dict:
     # blob_names: list= input["blob_names"]
 
     try:
-        binary_audio = bot.audio()  # .encode('utf-8')  # 文字列をバイト列に変換
+        binary_audio = await bot.audio()  # .encode('utf-8')  # 文字列をバイト列に変換
 
         # audio debug
         logging.debug(f"pre: {pre_max_index}, index: {bot.max_index}")
@@ -699,34 +752,21 @@ def zoom_audio(input: dict) -> dict:
         end_time = bot.time + TRAIL_MARGIN
         blob_name = f"{blob_prefix}/{bot.access_token}_{start_time}_{end_time}.pcm"
 
-        blob_service_client = BlobServiceClient.from_connection_string(
-            conn_str=BLOB_CONNECTION_STRING
-        )
         try:
-            # コンテナが存在しない場合は作成, 初回のみ
-            if start_time == 0:
-                try:
-                    # コンテナに接続
-                    container_client = blob_service_client.get_container_client(
-                        container=AUDIO_CONTAINER_NAME
-                    )
-                    container_client.create_container()
-                except Exception as e:
-                    logging.debug(
-                        f"Container already exists or error creating container: {e}"
-                    )
+            # コンテナが存在しない場合は作成（プロセス内で初回のみ確認）
+            container_client = await CLIENT_REGISTRY.ensure_async_blob_container(
+                AUDIO_CONTAINER_NAME
+            )
 
             # Blobクライアントを取得
-            blob_client = blob_service_client.get_blob_client(
-                container=AUDIO_CONTAINER_NAME, blob=blob_name
-            )
+            blob_client = container_client.get_blob_client(blob_name)
 
             # ファイルをアップロード
-            if blob_client.exists():
+            if await blob_client.exists():
                 # 例外
                 logging.critical("repeating!!")
             else:
-                blob_client.upload_blob(binary_audio, overwrite=False)
+                await blob_client.upload_blob(binary_audio, overwrite=False)
                 logging.info(f"'{blob_name}' uploaded to blob storage")
 
         except Exception as e: